@@ -26,11 +26,14 @@ When True, watershed segmentation is applied to improve the accuracy of cell seg
 Steps to follow to use the GUI:
 1. Run the code -> A pop-up window will appear with the GUI.
 2. Select an image directory.
-3. Select the minimum size object though the spin button, we recommend 0.5 for the provided image
+3. Select the minimum size object though the spin button, we recommend 0.5 for the provided image. The preview button
+   shows the cells found in the composite image as this and the threshold and diameter are changed
 4. Set the watershed parameter value, by default TRUE, (we recommend this option)
-5. Click submit and wait for the cell analysis to finish. A message will be displayed on the command window indicating
-   it.
-6. Visualize the results on the GUI.
+5. Click submit and wait for the cell analysis to finish. The progress bar advances as each file is counted, and the
+   run can be stopped between files with the cancel button. A message will be displayed on the command window
+   indicating when it has finished.
+6. Visualize the results on the GUI. Click a column header to sort the rows, and type in the filter box to show only
+   the rows containing that text.
 
 RESULTS:
 The results displayed in the GUI provide insights into the cell analysis performed on the images. Each column represents
@@ -44,16 +47,266 @@ a specific aspect of the analysis:
 - AutoCount_Counts: Cell counts obtained through automatic counting.
 - AutoCount_AvgCellArea: Average area of cells calculated during automatic counting.
 - Acc_Manual_over_AutoCounts: Accuracy measure indicating the ratio of manual counts over automatic counts.
+- Manual_Objects: Number of cells marked in the manual count mask (each dot or filled shape counts once).
+- AutoCount_Matched: Number of marked cells matched by a detected cell whose centroid lies within one cell diameter.
+- AutoCount_Precision: Fraction of the detected cells that match a marked cell.
+- AutoCount_Recall: Fraction of the marked cells that were detected.
+- AutoCount_F1: Harmonic mean of precision and recall.
 
 """
 
 
-from PySide2 import QtWidgets, QtCore
-from cell_counter_backend import getdirinfo, cellcounting_param_optimizer, cellcounting_batch
+from PySide2 import QtWidgets, QtCore, QtGui
+from cell_counter_backend import (getdirinfo, cellcounting_param_optimizer, cellcounting_batch, profile_summary,
+                                  load_preprocessed, open_image, preview_segmentation, scan_images)
+from skimage.filters import threshold_otsu
+from skimage.segmentation import find_boundaries
+import html
 import os
+import numpy as np
+import pandas as pd
+import threading
 import main
 
 
+class CountingWorker(QtCore.QObject):
+    """Runs the optimizer and the batch counting off the GUI thread."""
+
+    progress = QtCore.Signal(int, int, str)
+    finished = QtCore.Signal(object)
+    failed = QtCore.Signal(str)
+    cancelled = QtCore.Signal()
+
+    def __init__(self, working_directory, params, profile=None):
+        """Store the run settings; the work itself starts in run(). Stage profiles are appended to profile."""
+        super(CountingWorker, self).__init__()
+        self.working_directory = working_directory
+        self.params = params
+        self.profile = profile
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        """Request that the run stops before the next file. Safe to call from any thread."""
+        self._cancel.set()
+
+    def run(self):
+        """Optimize the parameters, count every file and emit the results."""
+        try:
+            dirinfo = {'main': self.working_directory}
+            dirinfo = getdirinfo(dirinfo)
+            params = self.params
+
+            optimal_diameter, optimal_threshold = cellcounting_param_optimizer(dirinfo, params)
+            if self._cancel.is_set():
+                self.cancelled.emit()
+                return
+
+            params['ch1_diam'] = optimal_diameter
+            params['ch1_thresh'] = optimal_threshold
+
+            output = cellcounting_batch(
+                dirinfo, "Ch1", params, save_intensities=True,
+                progress=lambda done, total, row: self.progress.emit(done, total, row['Ch1_FileNames']),
+                cancel=self._cancel, resume=True, profile=self.profile, prefetch=2
+            )
+        except Exception as error:
+            self.failed.emit(repr(error))
+            return
+
+        if self._cancel.is_set():
+            self.cancelled.emit()
+        else:
+            self.finished.emit(output)
+
+
+class PreviewWorker(QtCore.QObject):
+    """Segments the composite for the preview pane off the GUI thread, first coarsely and then at full resolution."""
+
+    loaded = QtCore.Signal(float, float, float)  # Lowest, highest and Otsu threshold of the coarse preprocessed image
+    ready = QtCore.Signal(int, object, int, int)  # Request number, RGB overlay, number of cells, downsampling
+    failed = QtCore.Signal(str)
+
+    PREVIEW_SIZE = 512  # Longest side of the image segmented for the first, coarse result
+
+    def __init__(self, image_file):
+        """Store the image to preview; it is loaded by load()."""
+        super(PreviewWorker, self).__init__()
+        self.image_file = image_file
+        self.latest = 0  # Number of the newest request; older requests still queued are skipped
+        self.coarse = None  # Downsampling of the coarse result, set by the first load()
+        self.display_range = None
+
+    def load(self, diam):
+        """Preprocess a downsampled copy of the image and report the range of thresholds that can be applied to it."""
+        try:
+            source = None
+            if self.coarse is None:
+                source = open_image(self.image_file)
+                self.coarse = 1
+                while max(source['pixels'].shape) // self.coarse > self.PREVIEW_SIZE:
+                    self.coarse *= 2
+            gauss = load_preprocessed(self.image_file, diam, image=source, scale=self.coarse)['gauss']
+            self.display_range = np.percentile(gauss, [0.5, 99.5])
+            self.loaded.emit(float(gauss.min()), float(gauss.max()), float(threshold_otsu(gauss)))
+        except Exception as error:
+            self.failed.emit(repr(error))
+
+    def compute(self, generation, diam, thresh, particle_min, use_watershed):
+        """Segment the image for request number generation, emitting a coarse and then a full-resolution result."""
+        for scale in sorted({self.coarse, 1}, reverse=True):
+            if generation != self.latest:
+                return
+            try:
+                preview = preview_segmentation(self.image_file, diam, thresh, particle_min, use_watershed, scale)
+            except Exception as error:
+                self.failed.emit(repr(error))
+                return
+            self.ready.emit(generation, self.overlay(preview), int(preview['nr_nuclei']), scale)
+
+    def overlay(self, preview):
+        """Draw the thresholded mask in green and the outlines of the cells in red over the image."""
+        low, high = self.display_range
+        gray = np.clip((preview['gauss'] - low) * (255 / max(high - low, 1e-6)), 0, 255).astype(np.uint8)
+        rgb = np.repeat(gray[:, :, None], 3, axis=2)
+        rgb[preview['thresh']] = rgb[preview['thresh']] // 2 + np.array([0, 100, 0], dtype=np.uint8)
+        rgb[find_boundaries(preview['cells'], mode='inner')] = (255, 60, 60)
+        return rgb
+
+
+class PreviewDialog(QtWidgets.QDialog):
+    """
+    Preview pane showing the composite image with the threshold mask and the outlines of the
+    cells found with the chosen threshold, diameter and the main window's minimum object size
+    and watershed settings. The result updates as the controls move.
+    """
+
+    requested = QtCore.Signal(int, int, float, float, bool)
+    load_requested = QtCore.Signal(int)
+
+    SLIDER_STEPS = 1000
+
+    def __init__(self, parent, image_file, size_spinbox, watershed_combobox):
+        """Build the pane and start preprocessing the image on a worker thread."""
+        super(PreviewDialog, self).__init__(parent)
+        self.setAttribute(QtCore.Qt.WA_DeleteOnClose)
+        self.setWindowTitle('Threshold preview - ' + os.path.basename(image_file))
+        self.resize(640, 720)
+        self.sizeobject_SB = size_spinbox
+        self.watershed_CB = watershed_combobox
+        self.limits = None
+        self.generation = 0
+        self.pixmap = None
+
+        self.image_L = QtWidgets.QLabel('Preprocessing image...')
+        self.image_L.setAlignment(QtCore.Qt.AlignCenter)
+        self.image_L.setMinimumSize(200, 200)
+        self.image_L.setSizePolicy(QtWidgets.QSizePolicy.Ignored, QtWidgets.QSizePolicy.Ignored)
+        self.thresh_S = QtWidgets.QSlider(QtCore.Qt.Horizontal)
+        self.thresh_S.setRange(0, self.SLIDER_STEPS)
+        self.thresh_S.setEnabled(False)
+        self.thresh_L = QtWidgets.QLabel()
+        self.thresh_L.setMinimumWidth(60)
+        self.diam_SB = QtWidgets.QSpinBox()
+        self.diam_SB.setRange(2, 200)
+        self.diam_SB.setValue(6)
+        self.count_L = QtWidgets.QLabel()
+
+        controls = QtWidgets.QHBoxLayout()
+        controls.addWidget(QtWidgets.QLabel('Threshold:'))
+        controls.addWidget(self.thresh_S)
+        controls.addWidget(self.thresh_L)
+        controls.addWidget(QtWidgets.QLabel('Diameter:'))
+        controls.addWidget(self.diam_SB)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.image_L)
+        layout.addLayout(controls)
+        layout.addWidget(self.count_L)
+
+        self.worker_thread = QtCore.QThread()
+        self.worker = PreviewWorker(image_file)
+        self.worker.moveToThread(self.worker_thread)
+        self.worker.loaded.connect(self.set_limits)
+        self.worker.ready.connect(self.show_preview)
+        self.worker.failed.connect(self.show_error)
+        self.requested.connect(self.worker.compute)
+        self.load_requested.connect(self.worker.load)
+        self.worker_thread.finished.connect(self.worker.deleteLater)
+        self.thresh_S.valueChanged.connect(self.request_preview)
+        self.diam_SB.valueChanged.connect(self.request_load)
+        self.sizeobject_SB.valueChanged.connect(self.request_preview)
+        self.watershed_CB.currentIndexChanged.connect(self.request_preview)
+        self.worker_thread.start()
+        self.request_load()
+
+    def request_load(self):
+        """Ask the worker to preprocess the image for the chosen diameter; the preview follows with its new limits."""
+        self.worker.latest = -1  # Skip the previews still queued for the previous diameter
+        self.load_requested.emit(self.diam_SB.value())
+
+    def threshold(self):
+        """Return the threshold selected with the slider."""
+        low, high = self.limits[:2]
+        return low + (high - low) * self.thresh_S.value() / self.SLIDER_STEPS
+
+    def set_limits(self, low, high, otsu):
+        """Set the slider to the image's range of thresholds, keeping the chosen threshold or starting at Otsu's."""
+        thresh = otsu if self.limits is None else min(max(self.threshold(), low), high)
+        self.limits = (low, high)
+        self.thresh_S.setEnabled(True)
+        self.thresh_S.blockSignals(True)
+        self.thresh_S.setValue(round((thresh - low) / max(high - low, 1e-6) * self.SLIDER_STEPS))
+        self.thresh_S.blockSignals(False)
+        self.request_preview()
+
+    def request_preview(self):
+        """Ask the worker to segment the image with the current settings, superseding earlier requests."""
+        if self.limits is None:
+            return
+        self.generation += 1
+        self.worker.latest = self.generation
+        thresh = self.threshold()
+        self.thresh_L.setText(f'{thresh:.1f}')
+        self.requested.emit(self.generation, self.diam_SB.value(), thresh, self.sizeobject_SB.value(),
+                            self.watershed_CB.currentText() == 'True')
+
+    def show_preview(self, generation, rgb, nr_nuclei, scale):
+        """Show a result of the worker unless newer settings have been requested since."""
+        if generation != self.generation:
+            return
+        image = QtGui.QImage(rgb.data, rgb.shape[1], rgb.shape[0], rgb.strides[0], QtGui.QImage.Format_RGB888)
+        self.pixmap = QtGui.QPixmap.fromImage(image.copy())
+        self.scale_pixmap()
+        if scale > 1:
+            self.count_L.setText(f'About {nr_nuclei} cells (at 1/{scale} resolution, refining...)')
+        else:
+            self.count_L.setText(f'{nr_nuclei} cells')
+
+    def show_error(self, message):
+        """Report an error raised by the worker."""
+        self.count_L.setText('Preview failed: ' + message)
+
+    def scale_pixmap(self):
+        """Fit the preview image to the pane."""
+        if self.pixmap is not None:
+            self.image_L.setPixmap(self.pixmap.scaled(self.image_L.size(), QtCore.Qt.KeepAspectRatio,
+                                                      QtCore.Qt.SmoothTransformation))
+
+    def resizeEvent(self, event):
+        """Refit the preview image when the pane is resized."""
+        super(PreviewDialog, self).resizeEvent(event)
+        self.scale_pixmap()
+
+    def closeEvent(self, event):
+        """Stop the worker thread when the pane is closed."""
+        self.worker.latest = -1
+        for signal, slot in ((self.sizeobject_SB.valueChanged, self.request_preview),
+                             (self.watershed_CB.currentIndexChanged, self.request_preview)):
+            signal.disconnect(slot)
+        self.worker_thread.quit()
+        self.worker_thread.wait()
+        super(PreviewDialog, self).closeEvent(event)
+
+
 class MyQtApp(main.Ui_MainWindow, QtWidgets.QMainWindow):
     """Class representing the main GUI window."""
 
@@ -62,7 +315,13 @@ class MyQtApp(main.Ui_MainWindow, QtWidgets.QMainWindow):
         super(MyQtApp, self).__init__()
         self.setupUi(self)
         self.submit_PB.clicked.connect(self.fill_form)
+        self.cancel_PB.clicked.connect(self.cancel_run)
+        self.preview_PB.clicked.connect(self.open_preview)
         self.browseimagepath_TB.clicked.connect(self.select_imagedir)
+        self.filter_LE.textChanged.connect(self.filter_results)
+        self.worker_thread = None
+        self.worker = None
+        self.profile = None
 
     def select_imagedir(self):
         """Open a dialog to select an image directory."""
@@ -70,6 +329,16 @@ class MyQtApp(main.Ui_MainWindow, QtWidgets.QMainWindow):
         if folder_path:
             self.image_LE.setText(folder_path)
 
+    def open_preview(self):
+        """Open the threshold preview of the working directory's composite image."""
+        composite = os.path.join(self.image_LE.text(), 'Composite')
+        fnames = list(scan_images(composite)) if os.path.isdir(composite) else []
+        if not self.image_LE.text() or not fnames:
+            QtWidgets.QMessageBox.warning(self, 'Warning', 'Please enter an image path with a Composite image')
+            return
+        preview = PreviewDialog(self, os.path.join(composite, fnames[0]), self.sizeobject_SB, self.watershed_CB)
+        preview.show()
+
     def fill_form(self):
         """Process the form data and initiate image processing."""
 
@@ -84,49 +353,147 @@ class MyQtApp(main.Ui_MainWindow, QtWidgets.QMainWindow):
         print(f'Minimum size object: {min_size}')
         print(f'Watershed: {watershed}')
 
-        dirinfo = {'main': working_directory}
-        dirinfo = getdirinfo(dirinfo)
-
         params = {'diam': 6,
                   'particle_min': min_size,
                   'UseWatershed': True
                   }
 
-        optimal_diameter, optimal_threshold = cellcounting_param_optimizer(dirinfo, params)
-
-        params['ch1_diam'] = optimal_diameter
-        params['ch1_thresh'] = optimal_threshold
-
-        output = cellcounting_batch(dirinfo, "Ch1", params, save_intensities=True)
+        # Run the optimizer and the batch on a worker thread so the window stays responsive
+        self.profile = [] if self.profile_CB.isChecked() else None
+        self.worker_thread = QtCore.QThread()
+        self.worker = CountingWorker(working_directory, params, self.profile)
+        self.worker.moveToThread(self.worker_thread)
+        self.worker_thread.started.connect(self.worker.run)
+        self.worker.progress.connect(self.update_progress)
+        self.worker.finished.connect(self.run_finished)
+        self.worker.failed.connect(self.run_failed)
+        self.worker.cancelled.connect(self.run_cancelled)
+        for signal in (self.worker.finished, self.worker.failed, self.worker.cancelled):
+            signal.connect(self.worker_thread.quit)
+        self.worker_thread.finished.connect(self.worker_thread.deleteLater)
+        self.worker_thread.finished.connect(self.worker.deleteLater)
+
+        self.submit_PB.setEnabled(False)
+        self.cancel_PB.setEnabled(True)
+        self.progress_PB.setRange(0, 0)  # Busy indicator until the first file is counted
+        self.statusbar.showMessage('Optimizing parameters...')
+        self.worker_thread.start()
+
+    def cancel_run(self):
+        """Ask the running worker to stop before the next file."""
+        if self.worker is not None:
+            self.worker.cancel()
+            self.cancel_PB.setEnabled(False)
+            self.statusbar.showMessage('Cancelling after the current file...')
+
+    def update_progress(self, done, total, fname):
+        """Advance the progress bar after each counted file."""
+        self.progress_PB.setRange(0, total)
+        self.progress_PB.setValue(done)
+        self.statusbar.showMessage(f'Counted {fname} ({done}/{total})')
+
+    def run_finished(self, output):
+        """Show the results once the worker has finished."""
         print(output)
         print('Image processing finished! View results in GUI')
-
+        self.reset_controls('Image processing finished!')
         self.display_data(output)  # Call display_data to show the output in QTableView
+        if self.profile:
+            self.display_profile(profile_summary(self.profile))
+
+    def run_failed(self, message):
+        """Report an error raised by the worker."""
+        self.reset_controls('Image processing failed')
+        QtWidgets.QMessageBox.critical(self, 'Error', message)
+
+    def run_cancelled(self):
+        """Report that the run was cancelled."""
+        self.reset_controls('Image processing cancelled')
+
+    def reset_controls(self, message):
+        """Re-enable the form after a run has ended."""
+        self.worker = None
+        self.progress_PB.setRange(0, max(self.progress_PB.maximum(), 1))
+        self.submit_PB.setEnabled(True)
+        self.cancel_PB.setEnabled(False)
+        self.statusbar.showMessage(message)
+
+    def display_profile(self, summary):
+        """Show the time and peak memory of each pipeline stage, summed over the counted files."""
+        text = summary.to_string(float_format='{:.3f}'.format)
+        print(text)
+        QtWidgets.QMessageBox.information(
+            self, 'Stage profile',
+            f'<pre>{html.escape(text)}</pre>Per-file details are saved to SavedOutput/Ch1_Profile.csv'
+        )
 
     def display_data(self, output):
         """Display the processed data in the QTableView."""
 
         model = PandasModel(output)
+        model.set_filter(self.filter_LE.text())
         self.qtable.setModel(model)
 
+        # Sorting starts from the original order; column widths are measured on a sample of rows
+        self.qtable.horizontalHeader().setSortIndicator(-1, QtCore.Qt.AscendingOrder)
+        self.qtable.setSortingEnabled(True)
+        self.qtable.horizontalHeader().setResizeContentsPrecision(200)
         self.qtable.resizeColumnsToContents()
 
+    def filter_results(self, pattern):
+        """Show only the result rows containing the text typed in the filter box."""
+        if self.qtable.model() is not None:
+            self.qtable.model().set_filter(pattern)
+
 class PandasModel(QtCore.QAbstractTableModel):
-    """Custom model for interfacing Pandas DataFrames with Qt Views."""
+    """
+    Custom model for interfacing Pandas DataFrames with Qt Views. Built for long tables such
+    as per-cell results: the columns are held as NumPy arrays, rows are handed to the view in
+    batches as it scrolls (canFetchMore/fetchMore), each shown value is formatted only once,
+    and sorting and filtering reorder an index of row numbers instead of copying the data.
+    """
+
+    FETCH_ROWS = 1000  # Rows added to the view per fetchMore
+    CACHE_SIZE = 100000  # Formatted values kept before the cache is cleared
 
     def __init__(self, data):
         """Initialize the model with the provided DataFrame."""
         super(PandasModel, self).__init__()
-        self._data = data
-        self._headers = data.columns.tolist()
+        self._headers = [str(column) for column in data.columns]
+        self._columns = [data[column].to_numpy() for column in data.columns]
+        # Lower-case text of the text columns, built when first filtering
+        self._texts = {column: None for column, name in enumerate(data.columns)
+                       if pd.api.types.is_string_dtype(data[name])}
+        self._order = np.arange(data.shape[0])  # Row numbers in sorted order
+        self._match = None  # Rows matching the filter, or None without a filter
+        self._rows = self._order  # Row numbers shown, in display order
+        self._fetched = min(len(self._rows), self.FETCH_ROWS)
+        self._formatted = {}
 
     def rowCount(self, parent=None):
-        """Return the number of rows in the DataFrame."""
-        return self._data.shape[0]
+        """Return the number of rows handed to the view so far."""
+        if parent is not None and parent.isValid():
+            return 0
+        return self._fetched
 
     def columnCount(self, parent=None):
         """Return the number of columns in the DataFrame."""
-        return self._data.shape[1]
+        if parent is not None and parent.isValid():
+            return 0
+        return len(self._columns)
+
+    def canFetchMore(self, parent):
+        """Return whether rows remain that the view has not been given yet."""
+        return not parent.isValid() and self._fetched < len(self._rows)
+
+    def fetchMore(self, parent):
+        """Hand the next batch of rows to the view."""
+        if parent.isValid():
+            return
+        count = min(self.FETCH_ROWS, len(self._rows) - self._fetched)
+        self.beginInsertRows(QtCore.QModelIndex(), self._fetched, self._fetched + count - 1)
+        self._fetched += count
+        self.endInsertRows()
 
     def headerData(self, section, orientation, role):
         """Return the header data for the specified section."""
@@ -137,11 +504,50 @@ class PandasModel(QtCore.QAbstractTableModel):
 
     def data(self, index, role=QtCore.Qt.DisplayRole):
         """Return the data for the specified index."""
-        if index.isValid():
-            if role == QtCore.Qt.DisplayRole:
-                return str(self._data.iloc[index.row(), index.column()])
+        if index.isValid() and role == QtCore.Qt.DisplayRole:
+            key = (int(self._rows[index.row()]), index.column())
+            text = self._formatted.get(key)
+            if text is None:
+                if len(self._formatted) >= self.CACHE_SIZE:
+                    self._formatted.clear()
+                text = self._formatted[key] = str(self._columns[key[1]][key[0]])
+            return text
         return None
 
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        """Sort the rows by a column (a negative column restores the original order)."""
+        self.beginResetModel()
+        if column < 0:
+            self._order = np.arange(len(self._order))
+        else:
+            self._order = np.argsort(self._columns[column], kind='stable')
+            if order == QtCore.Qt.DescendingOrder:
+                self._order = self._order[::-1]
+        self._show_rows()
+        self.endResetModel()
+
+    def set_filter(self, pattern=''):
+        """
+        Show only the rows with a text value (such as a filename) containing pattern, ignoring
+        case; an empty pattern shows all rows.
+        """
+        self.beginResetModel()
+        self._match = None
+        if pattern:
+            self._match = np.zeros(len(self._order), dtype=bool)
+            for column, text in self._texts.items():
+                if text is None:
+                    text = self._texts[column] = pd.Series(self._columns[column]).astype(str).str.lower()
+                self._match |= text.str.contains(pattern.lower(), regex=False).to_numpy()
+        self._show_rows()
+        self.endResetModel()
+
+    def _show_rows(self):
+        """Update the shown rows after the order or the filter changed."""
+        self._rows = self._order if self._match is None else self._order[self._match[self._order]]
+        self._fetched = min(len(self._rows), self.FETCH_ROWS)
+        self._formatted.clear()
+
 if __name__ == '__main__':
     app = QtWidgets.QApplication()
     qt_app = MyQtApp()
@@ -0,0 +1,85 @@
+"""
+Benchmark of image discovery in a nested plate/well/field tree.
+
+Builds a Ch1 subdirectory of plates, wells and fields (hard links to one small TIFF, so the tree
+is cheap to create) and times listing it with scan_images: the time until the first image is
+found, a full walk without a listing cache, a full walk that fills the cache, and a walk with an
+up-to-date cache. After one image is added, a cached walk must find it. It fails if any walk
+finds a different set of images.
+
+Usage:
+    python benchmarks/benchmark_discovery.py [--plates 4] [--wells 96] [--fields 16]
+"""
+
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cv2
+from cell_counter_backend import scan_images, load_listing_cache
+
+
+def timed(function):
+    """Calls function once; returns its result and the wall time."""
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--plates', type=int, default=4, help='Number of plates. Default: 4.')
+    parser.add_argument('--wells', type=int, default=96, help='Wells per plate. Default: 96.')
+    parser.add_argument('--fields', type=int, default=16, help='Fields per well. Default: 16.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        channel = os.path.join(directory, 'Ch1')
+        image = os.path.join(directory, 'image.tif')
+        cv2.imwrite(image, np.zeros((8, 8), dtype=np.uint8))
+        expected = []
+        for plate in range(args.plates):
+            for well in range(args.wells):
+                well_dir = os.path.join(channel, 'plate{:02d}'.format(plate), 'well{:03d}'.format(well))
+                os.makedirs(well_dir)
+                for field in range(args.fields):
+                    fname = 'field{:02d}.tif'.format(field)
+                    os.link(image, os.path.join(well_dir, fname))
+                    expected.append(os.path.relpath(os.path.join(well_dir, fname), channel))
+        print(f'{len(expected)} images in {args.plates * args.wells} well directories')
+        #Directories modified in the last two seconds are not cached
+        time.sleep(2.5)
+
+        cache_file = os.path.join(directory, 'Ch1_Listing.json')
+        failed = False
+        print(f"\n{'walk':<30}{'time (s)':>10}{'images':>8}")
+        first, first_s = timed(lambda: next(scan_images(channel)))
+        print(f"{'first image':<30}{first_s:>10.4f}{1:>8}")
+        runs = [('no cache', lambda: list(scan_images(channel))),
+                ('cold cache', lambda: list(scan_images(channel, cache=load_listing_cache(cache_file)))),
+                ('warm cache', lambda: list(scan_images(channel, cache=load_listing_cache(cache_file))))]
+        for label, walk in runs:
+            found, walk_s = timed(walk)
+            print(f"{label:<30}{walk_s:>10.4f}{len(found):>8}")
+            failed = failed or sorted(found) != sorted(expected)
+
+        added = os.path.join('plate00', 'well000', 'added.tif')
+        os.link(image, os.path.join(channel, added))
+        found, walk_s = timed(lambda: list(scan_images(channel, cache=load_listing_cache(cache_file))))
+        print(f"{'warm cache, one image added':<30}{walk_s:>10.4f}{len(found):>8}")
+        failed = failed or sorted(found) != sorted(expected + [added])
+
+    if failed:
+        print('MISMATCH: a walk found a different set of images')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark of open_image against decoding whole images with cv2.imread.
+
+Writes a large synthetic slide (see synthetic.py) as an uncompressed and as a deflate-compressed
+TIFF and times opening each: with cv2.imread, with open_image (memory-mapped for the uncompressed
+TIFF, decoded for the compressed one), and with open_image and an image cache on a first and a
+second open. It then counts the slide with tiled_cellcounter from the decoded array and from the
+memory-mapped source, checks that the labels are identical and reports the bytes read, and reads a
+preview-sized corner of the source to show that regions are read on demand. It fails if any result
+differs.
+
+Usage:
+    python benchmarks/benchmark_image_source.py [--size 8192] [--diam 12] [--tile-size 1024]
+"""
+
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cv2
+from skimage.filters import threshold_otsu
+from cell_counter_backend import open_image, read_region, tiled_cellcounter, preprocess_image
+from synthetic import make_nuclei_image
+
+
+def timed(function):
+    """Calls function once; returns its result and the wall time."""
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=8192, help='Side length of the slide in pixels. Default: 8192.')
+    parser.add_argument('--diam', type=int, default=12, help='Mean nucleus diameter in pixels. Default: 12.')
+    parser.add_argument('--tile-size', type=int, default=1024, help='Tile side length for counting. Default: 1024.')
+    parser.add_argument('--count-size', type=int, default=4096,
+                        help='Side length of the part of the slide that is counted. Default: 4096.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        image, _ = make_nuclei_image((args.size, args.size), density=1.0, diam=args.diam, dtype=np.uint16)
+        files = {'uncompressed': os.path.join(directory, 'slide.tif'),
+                 'deflate': os.path.join(directory, 'slide_deflate.tif')}
+        cv2.imwrite(files['uncompressed'], image, [cv2.IMWRITE_TIFF_COMPRESSION, 1])
+        cv2.imwrite(files['deflate'], image, [cv2.IMWRITE_TIFF_COMPRESSION, 8])
+        print(f'{args.size}x{args.size} uint16 slide, {image.nbytes / 2**20:.0f} MB of pixels')
+
+        failed = False
+        cache_dir = os.path.join(directory, 'cache')
+        print(f"\n{'open':<38}{'time (s)':>10}{'mapped':>8}{'read (MB)':>11}")
+        for name, image_file in files.items():
+            decoded, decode_s = timed(lambda: cv2.imread(image_file, cv2.IMREAD_ANYDEPTH))
+            print(f"{name + ', cv2.imread':<38}{decode_s:>10.3f}{'':>8}{os.path.getsize(image_file) / 2**20:>11.1f}")
+            runs = [('open_image', None), ('open_image, cache (1st)', cache_dir), ('open_image, cache (2nd)', cache_dir)]
+            for label, cache in runs:
+                source, open_s = timed(lambda: open_image(image_file, cache))
+                print(f"{name + ', ' + label:<38}{open_s:>10.3f}{str(source['mapped']):>8}"
+                      f"{source['bytes_read'] / 2**20:>11.1f}")
+                if not np.array_equal(read_region(source), decoded):
+                    print(f'MISMATCH: {name}, {label}')
+                    failed = True
+
+        #Counting a part of the slide from the decoded array and from the memory map
+        region = (slice(0, args.count_size), slice(0, args.count_size))
+        thresh = float(threshold_otsu(preprocess_image(image[:args.tile_size, :args.tile_size], args.diam)['gauss']))
+        expected, array_s = timed(lambda: tiled_cellcounter(
+            image[region], args.diam, thresh, 0.5, True, args.tile_size))
+        source = open_image(files['uncompressed'])
+        part = dict(source, pixels=source['pixels'][region])
+        result, source_s = timed(lambda: tiled_cellcounter(part, args.diam, thresh, 0.5, True, args.tile_size))
+        identical = result[1] == expected[1] and np.array_equal(result[0], expected[0])
+        failed = failed or not identical
+        print(f'\nTiled count of {args.count_size}x{args.count_size} px: {expected[1]} cells from the array in '
+              f'{array_s:.2f} s, {result[1]} from the memory map in {source_s:.2f} s '
+              f"({'identical' if identical else 'DIFFERENT'} labels), "
+              f"{part['bytes_read'] / 2**20:.1f} MB read including tile margins")
+
+        corner, corner_s = timed(lambda: np.array(read_region(source, (slice(0, 512), slice(0, 512)))))
+        print(f"512x512 corner read in {corner_s * 1000:.1f} ms, {source['bytes_read'] / 2**20:.2f} MB read")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
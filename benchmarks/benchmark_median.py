@@ -0,0 +1,94 @@
+"""
+Exactness check and benchmark of the median filter backends against scipy.ndimage.median_filter.
+
+Every backend of median_filter must reproduce the scipy output bit for bit. This script filters
+the Template composite and synthetic images of each supported dtype with a range of kernel sizes,
+fails if any backend differs from scipy, and reports the time each backend takes on the
+composite. Backends that do not apply to an image (and would fall back to scipy) are listed as
+'n/a'.
+
+Usage:
+    python benchmarks/benchmark_median.py [--kernels 3 9 21]
+"""
+
+
+import argparse
+import os
+import sys
+import time
+import zipfile
+import numpy as np
+import scipy.ndimage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cell_counter_backend import fast_median_filter, median_filter
+
+BACKENDS = ['opencv', 'histogram', 'auto']
+
+
+def template_composite():
+    """Decodes the composite image of Template.zip."""
+    import cv2
+    with zipfile.ZipFile(os.path.join(ROOT, 'Template.zip')) as archive:
+        data = np.frombuffer(archive.read('Template/Composite/composite.tif'), dtype=np.uint8)
+    return cv2.imdecode(data, cv2.IMREAD_ANYDEPTH)
+
+
+def test_images(composite):
+    """Images covering the dtypes and value ranges the backends handle differently."""
+    rng = np.random.default_rng(0)
+    crop = composite[:300, :260]
+    return {
+        'composite uint8': crop,
+        'uint16, <256 values': crop.astype(np.uint16)*13,
+        'uint16, <4096 values': rng.integers(0, 4000, (200, 170)).astype(np.uint16),
+        'uint16, full range': rng.integers(0, 65536, (120, 90)).astype(np.uint16),
+        'float32': (crop/3).astype(np.float32),
+        'float64': crop/3.0,
+    }
+
+
+def check_exact(images, kernels):
+    """Returns a list of (image, kernel, backend) combinations that differ from scipy."""
+    mismatches = []
+    for name, image in images.items():
+        for kernel_size in kernels:
+            reference = scipy.ndimage.median_filter(image, size=kernel_size)
+            for backend in BACKENDS:
+                result = median_filter(image, kernel_size, backend=backend)
+                if result.dtype != reference.dtype or not np.array_equal(result, reference):
+                    mismatches.append((name, kernel_size, backend))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--kernels', type=int, nargs='+', default=[3, 5, 9, 21],
+                        help='Odd kernel sizes to test. Default: 3 5 9 21.')
+    args = parser.parse_args()
+
+    composite = template_composite()
+    mismatches = check_exact(test_images(composite), args.kernels)
+    for name, kernel_size, backend in mismatches:
+        print(f'MISMATCH: {backend} backend, kernel {kernel_size}, {name}')
+    print('Exactness check: ' + ('FAILED' if mismatches else 'all backends match scipy'))
+
+    print(f"\n{'image':<22}{'kernel':>7}{'scipy (s)':>11}" + ''.join(f'{b + " (s)":>16}' for b in BACKENDS))
+    for name, image in (('composite uint8', composite), ('composite uint16', composite.astype(np.uint16)*13)):
+        for kernel_size in args.kernels:
+            start = time.perf_counter()
+            scipy.ndimage.median_filter(image, size=kernel_size)
+            line = f'{name:<22}{kernel_size:>7}{time.perf_counter() - start:>11.3f}'
+            for backend in BACKENDS:
+                start = time.perf_counter()
+                applies = fast_median_filter(image, kernel_size, backend) is not None
+                line += f'{time.perf_counter() - start:>16.3f}' if applies else f'{"n/a":>16}'
+            print(line)
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark of the parameter optimizer on several composite images and manual count masks.
+
+Writes a synthetic working directory (see synthetic.py) with several composite/mask pairs and
+times cellcounting_param_optimizer on one pair and on all of them, with one process and with
+one process per pair. Prints the diameter and threshold chosen for each composite and for the
+pooled data (from OptimizationPairs.csv) and fails if the serial and parallel runs disagree.
+
+Usage:
+    python benchmarks/benchmark_optimizer_pairs.py [--pairs 4] [--size 1024] [--mode sequential]
+"""
+
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cell_counter_backend as backend
+from synthetic import make_workspace
+
+
+def optimize(directory, args, workers):
+    """Runs the optimizer on a working directory; returns the parameters and the wall time."""
+    dirinfo = backend.getdirinfo({'main': directory})
+    params = {'diam': args.diam + 4, 'particle_min': 0.5, 'UseWatershed': args.watershed}
+    backend.clear_preprocess_cache()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        diam, thresh = backend.cellcounting_param_optimizer(dirinfo, params, mode=args.mode, workers=workers)
+    return (diam, thresh), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pairs', type=int, default=4, help='Number of composite/mask pairs. Default: 4.')
+    parser.add_argument('--size', type=int, default=1024, help='Side length of the composites in pixels. Default: 1024.')
+    parser.add_argument('--diam', type=int, default=12, help='Mean nucleus diameter in pixels. Default: 12.')
+    parser.add_argument('--mode', choices=['sequential', 'joint'], default='sequential',
+                        help='Optimizer mode. Default: sequential.')
+    parser.add_argument('--watershed', action=argparse.BooleanOptionalAction, default=True,
+                        help='Use watershed segmentation. Default: on.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        pooled = os.path.join(directory, 'pooled')
+        make_workspace(pooled, 0, (args.size, args.size), diam=args.diam, nr_composites=args.pairs)
+        single = os.path.join(directory, 'single')
+        for sub in ('Composite', 'ManualCounts', 'Ch1'):
+            os.makedirs(os.path.join(single, sub))
+        shutil.copy(os.path.join(pooled, 'Composite', 'composite_0.tif'), os.path.join(single, 'Composite'))
+        shutil.copy(os.path.join(pooled, 'ManualCounts', 'composite_0_Mask.tif'), os.path.join(single, 'ManualCounts'))
+
+        print(f"{args.mode} optimizer, {args.size}x{args.size} px composites, diam {args.diam}")
+        print(f"\n{'run':<28}{'time (s)':>10}{'diameter':>10}{'threshold':>11}")
+        runs = [('1 pair', single, 1), (f'{args.pairs} pairs, 1 process', pooled, 1),
+                (f'{args.pairs} pairs, {args.pairs} processes', pooled, args.pairs)]
+        results = {}
+        for label, workspace, workers in runs:
+            results[label], wall_s = optimize(workspace, args, workers)
+            print(f"{label:<28}{wall_s:>10.2f}{results[label][0]:>10}{results[label][1]:>11.1f}")
+
+        print()
+        table = pd.read_csv(os.path.join(pooled, 'SavedOutput', 'OptimizationPairs.csv'))
+        print(table.to_string(index=False, float_format='{:.3f}'.format))
+
+    serial, parallel = list(results.values())[1:]
+    if serial != parallel:
+        print('MISMATCH between the serial and parallel runs')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""
+Benchmark of the counting pipeline on synthetic nuclei images with known ground truth.
+
+Generates a working directory of synthetic images (see synthetic.py) with a configurable image
+size, nucleus density and fraction of touching nuclei, then times each pipeline stage on one
+image (read, median filter, background subtraction, Gaussian blur, thresholding with small part
+removal, labelling, watershed, cell intensities and writing the label image) followed by the
+parameter optimizer and the batch counter end to end. Counts are compared against the ground
+truth. Results are written as JSON so that runs can be compared with --compare. Runs offline and
+needs nothing beyond the pipeline's own dependencies.
+
+Usage:
+    python benchmarks/benchmark_pipeline.py [--size 2048] [--density 2] [--touching 0.3] [--output run.json]
+    python benchmarks/benchmark_pipeline.py --compare before.json after.json
+"""
+
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cv2
+import scipy.ndimage
+from skimage.filters import threshold_otsu
+import cell_counter_backend as backend
+from synthetic import make_workspace
+
+
+def timed(function, repeats):
+    """Calls function repeats times; returns the last result and the min and median wall times."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return result, {'min_s': min(times), 'median_s': float(np.median(times))}
+
+
+def time_stages(image_file, output_dir, diam, particle_min, repeats):
+    """Times each stage of cellcounter on one image with a fixed diameter and an Otsu threshold."""
+    stages = {}
+    image, stages['read'] = timed(lambda: backend.read_image(image_file), repeats)
+    median, stages['median'] = timed(lambda: backend.median_filter(image, diam//2), repeats)
+    work = median.astype('float32')
+    bg, stages['background'] = timed(lambda: backend.subtract_bg(work, diam*3, dtype='float32'), repeats)
+    gauss, stages['gaussian'] = timed(lambda: cv2.GaussianBlur(bg, (0,0), diam/6), repeats)
+    thresh = threshold_otsu(gauss)
+    mask, stages['threshold'] = timed(
+        lambda: backend.rm_smallparts(gauss > thresh, diam, particle_min), repeats
+    )
+    (cells, nr_label), stages['label'] = timed(lambda: scipy.ndimage.label(mask), repeats)
+    (ws_cells, nr_watershed), stages['watershed'] = timed(
+        lambda: backend.watershed(mask, diam, particle_min), repeats
+    )
+    _, stages['intensities'] = timed(lambda: backend.cell_intensities(ws_cells, gauss), repeats)
+    label_file = os.path.join(output_dir, 'stage_Counts.tif')
+    _, stages['write'] = timed(lambda: backend.save_labels(label_file, ws_cells), repeats)
+    counts = {'threshold': float(thresh), 'label': int(nr_label), 'watershed': int(nr_watershed)}
+    return stages, counts
+
+
+def run_benchmark(args):
+    """Builds the synthetic workspace, runs all timings and returns the results as a dict."""
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        truth = make_workspace(directory, args.files, (args.size, args.size), args.density,
+                               args.diam, args.touching, args.seed)
+        generate_s = time.perf_counter() - start
+
+        stages, stage_counts = time_stages(
+            os.path.join(directory, 'Ch1', 'synthetic_0000.tif'), directory,
+            args.diam, args.particle_min, args.repeats
+        )
+
+        dirinfo = backend.getdirinfo({'main': directory})
+        params = {'diam': args.diam, 'particle_min': args.particle_min, 'UseWatershed': args.watershed}
+        backend.clear_preprocess_cache()
+        with contextlib.redirect_stdout(io.StringIO()):
+            (diam, thresh), optimizer = timed(
+                lambda: backend.cellcounting_param_optimizer(dirinfo, params), 1
+            )
+            params['ch1_diam'], params['ch1_thresh'] = diam, thresh
+            output, batch = timed(
+                lambda: backend.cellcounting_batch(dirinfo, 'Ch1', params, save_intensities=True,
+                                                   workers=args.workers), 1
+            )
+
+    expected = np.array([truth[fname] for fname in output['Ch1_FileNames']])
+    counted = output['Ch1_Counts'].to_numpy(dtype=float)
+    return {
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'environment': environment(),
+        'ground_truth': {'composite': truth['composite.tif'], 'ch1_total': int(expected.sum())},
+        'generate_s': generate_s,
+        'stages': stages,
+        'stage_counts': stage_counts,
+        'end_to_end': {
+            'optimizer': dict(optimizer, diam=int(diam), thresh=float(thresh),
+                              diam_evals=params.get('diam_evals')),
+            'batch': dict(batch, files=len(output), files_per_s=len(output) / batch['min_s']),
+        },
+        'accuracy': {
+            'ch1_counted': float(np.nansum(counted)),
+            'mean_abs_rel_error': float(np.nanmean(np.abs(counted - expected) / expected)),
+        },
+    }
+
+
+def environment():
+    """Machine and library versions recorded with each run so that results are comparable."""
+    import scipy
+    import skimage
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'skimage': skimage.__version__,
+        'opencv': cv2.__version__,
+    }
+
+
+def flat_timings(result):
+    """Maps 'stage' and 'end_to_end' timing names to their minimum wall time."""
+    timings = {'stage ' + name: value['min_s'] for name, value in result['stages'].items()}
+    timings.update({name: value['min_s'] for name, value in result['end_to_end'].items()})
+    return timings
+
+
+def print_result(result):
+    """Prints the timing table and the counts of a benchmark run."""
+    config = result['config']
+    print(f"{config['files']} files of {config['size']}x{config['size']} px, density {config['density']}, "
+          f"diam {config['diam']}, touching {config['touching']} "
+          f"({result['ground_truth']['composite']} nuclei in the composite)")
+    print(f"\n{'timing':<22}{'min (s)':>10}{'median (s)':>12}")
+    for name, value in list(result['stages'].items()) + list(result['end_to_end'].items()):
+        print(f"{name:<22}{value['min_s']:>10.3f}{value['median_s']:>12.3f}")
+    optimizer = result['end_to_end']['optimizer']
+    print(f"\nOptimizer: diameter {optimizer['diam']}, threshold {optimizer['thresh']:.2f}")
+    print(f"Counted {result['accuracy']['ch1_counted']:.0f} of {result['ground_truth']['ch1_total']} nuclei, "
+          f"mean absolute relative error {result['accuracy']['mean_abs_rel_error']:.3f}")
+
+
+def compare(before_file, after_file):
+    """Prints the timings of two result files side by side."""
+    with open(before_file) as stream:
+        before = flat_timings(json.load(stream))
+    with open(after_file) as stream:
+        after = flat_timings(json.load(stream))
+    print(f"{'timing':<22}{'before (s)':>12}{'after (s)':>12}{'speedup':>10}")
+    for name in before:
+        if name in after:
+            print(f"{name:<22}{before[name]:>12.3f}{after[name]:>12.3f}{before[name] / after[name]:>9.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=1024, help='Side length of the images in pixels. Default: 1024.')
+    parser.add_argument('--density', type=float, default=2.0, help='Nuclei per 10,000 pixels. Default: 2.')
+    parser.add_argument('--diam', type=int, default=12, help='Mean nucleus diameter in pixels. Default: 12.')
+    parser.add_argument('--touching', type=float, default=0.2,
+                        help='Fraction of nuclei touching a neighbour. Default: 0.2.')
+    parser.add_argument('--files', type=int, default=4, help='Number of images counted by the batch. Default: 4.')
+    parser.add_argument('--particle-min', type=float, default=0.5,
+                        help='Minimum particle size as a fraction of the average cell area. Default: 0.5.')
+    parser.add_argument('--watershed', action=argparse.BooleanOptionalAction, default=True,
+                        help='Use watershed segmentation in the optimizer and batch. Default: on.')
+    parser.add_argument('--workers', type=int, default=1, help='Batch worker processes. Default: 1.')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed repetitions per stage. Default: 3.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the image generator. Default: 0.')
+    parser.add_argument('--output', default=None, help='JSON file to write the results to.')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='Compare the timings of two result files instead of running.')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    result = run_benchmark(args)
+    print_result(result)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(result, stream, indent=2)
+        print(f'\nResults saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
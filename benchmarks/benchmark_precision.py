@@ -0,0 +1,108 @@
+"""
+Benchmark of the preprocessing pipeline's memory use and speed on the Template composite.
+
+Compares the original allocation pattern of median filter -> background subtraction -> Gaussian
+blur (five float64 temporaries per image) with the current preprocess_image in float64 and float32.
+Each variant runs in a fresh process so that its peak resident set size (RSS) is not shared with
+the others.
+
+Usage:
+    python benchmarks/benchmark_precision.py [--repeats 5] [--image path/to/image.tif]
+"""
+
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+VARIANTS = ['legacy', 'float64', 'float32']
+
+
+def legacy_preprocess(image, cell_diam):
+    """The preprocessing steps as cellcounter ran them before buffers and float32 were added."""
+    import cv2
+    from cell_counter_backend import median_filter
+    median = median_filter(image, kernel_size = cell_diam//2)
+    image = median.astype('float')
+    bg = cv2.GaussianBlur(image, (0,0), cell_diam*3)
+    new_image = image - bg
+    new_image[new_image<0] = 0
+    return cv2.GaussianBlur(new_image.astype('float'), (0,0), cell_diam/6)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is in kB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_variant(variant, image_file, cell_diam, repeats):
+    """Times one variant in this process and returns its wall time and peak RSS."""
+    from cell_counter_backend import read_image, preprocess_image
+    image = read_image(image_file)
+    rss_before = peak_rss_mb()
+
+    times = []
+    buffers = {}
+    for _ in range(repeats):
+        start = time.perf_counter()
+        if variant == 'legacy':
+            legacy_preprocess(image, cell_diam)
+        else:
+            preprocess_image(image, cell_diam, precision=variant, buffers=buffers)
+        times.append(time.perf_counter() - start)
+
+    return {
+        'variant': variant,
+        'image_shape': list(image.shape),
+        'wall_time_s': min(times),
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_rss_increase_mb': peak_rss_mb() - rss_before
+    }
+
+
+def template_composite(directory):
+    """Extracts the composite image from Template.zip and returns its path."""
+    with zipfile.ZipFile(os.path.join(ROOT, 'Template.zip')) as archive:
+        return archive.extract('Template/Composite/composite.tif', directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--image', default=None, help='Image to preprocess. Default: the Template composite.')
+    parser.add_argument('--diam', type=int, default=20, help='Cell diameter used to size the kernels. Default: 20.')
+    parser.add_argument('--repeats', type=int, default=5, help='Timed repetitions per variant. Default: 5.')
+    parser.add_argument('--run', choices=VARIANTS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_variant(args.run, args.image, args.diam, args.repeats)))
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        image_file = args.image or template_composite(directory)
+        results = []
+        for variant in VARIANTS:
+            output = subprocess.run(
+                [sys.executable, __file__, '--run', variant, '--image', image_file,
+                 '--diam', str(args.diam), '--repeats', str(args.repeats)],
+                check=True, capture_output=True, text=True
+            ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{'variant':<10}{'wall time (s)':>15}{'peak RSS (MB)':>15}{'RSS increase (MB)':>20}")
+    for result in results:
+        print(f"{result['variant']:<10}{result['wall_time_s']:>15.3f}{result['peak_rss_mb']:>15.1f}"
+              f"{result['peak_rss_increase_mb']:>20.1f}")
+
+
+if __name__ == '__main__':
+    main()
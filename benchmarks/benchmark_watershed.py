@@ -0,0 +1,128 @@
+"""
+Equivalence check and benchmark of watershed() against the original seeding.
+
+The original watershed labelled the eroded cell shapes with measure.label, seeded them with
+peak_local_max, labelled the seeds again and ran the watershed on the whole image. This script
+keeps that version as a reference and checks that watershed() returns identical labels and seed
+counts on the Template images over a range of diameters, thresholds and minimum particle sizes,
+both for whole images and for regions of a larger image (as segmented by tiled_cellcounter). It
+fails if any result differs and reports the time of both versions.
+
+Usage:
+    python benchmarks/benchmark_watershed.py [--diams 4 6 10 20] [--particle-mins 0.2 0.5]
+"""
+
+
+import argparse
+import os
+import sys
+import time
+import zipfile
+import numpy as np
+import scipy.ndimage
+from skimage import measure
+from skimage.feature import peak_local_max
+from skimage.segmentation import watershed as skwatershed
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cell_counter_backend import preprocess_image, rm_smallparts, watershed
+
+
+def reference_watershed(image_current_thresholded, optimal_diameter, particle_min, origin=None, image_shape=None):
+    """watershed() as it was before the seeding was reworked."""
+    if image_current_thresholded.max() == True:
+        image_current_thresh_dist = scipy.ndimage.distance_transform_edt(image_current_thresholded)
+        image_current_thresh_dist_erd = image_current_thresh_dist > optimal_diameter*particle_min
+        image_current_thresh_dist_lbls = measure.label(image_current_thresh_dist_erd)
+
+        exclude_border = True
+        if image_shape is not None:
+            border = int(optimal_diameter)
+            near_edge = [
+                (np.arange(start, start+size) < border) | (np.arange(start, start+size) >= full_size-border)
+                for start, size, full_size in zip(origin, image_current_thresholded.shape, image_shape)
+            ]
+            image_current_thresh_dist_lbls[near_edge[0][:, None] | near_edge[1][None, :]] = 0
+            exclude_border = False
+
+        coords = peak_local_max(
+            image_current_thresh_dist,
+            min_distance = int(optimal_diameter),
+            labels = image_current_thresh_dist_lbls,
+            num_peaks_per_label = 1,
+            exclude_border = exclude_border
+        )
+        image_current_seeds = np.zeros(image_current_thresholded.shape, dtype=bool)
+        image_current_seeds[tuple(coords.T)] = True
+        image_current_seeds, nseeds = scipy.ndimage.label(image_current_seeds)
+        labels = skwatershed(-image_current_thresh_dist, image_current_seeds, mask=image_current_thresholded)
+    else:
+        labels = image_current_thresholded.astype(int)
+        nseeds = 0
+    return labels, nseeds
+
+
+def template_images():
+    """Decodes the composite and Ch1 images of Template.zip."""
+    import cv2
+    images = {}
+    with zipfile.ZipFile(os.path.join(ROOT, 'Template.zip')) as archive:
+        for name in ('Template/Composite/composite.tif', 'Template/Ch1/composite_Ch1.tif'):
+            data = np.frombuffer(archive.read(name), dtype=np.uint8)
+            images[os.path.basename(name)] = cv2.imdecode(data, cv2.IMREAD_ANYDEPTH)
+    return images
+
+
+def masks(image, diams, particle_mins):
+    """Thresholded masks over a range of diameters, thresholds and minimum particle sizes."""
+    for diam in diams:
+        gauss = np.array(preprocess_image(image, diam)['gauss'])
+        for thresh in np.percentile(gauss, [50, 75, 90]):
+            for particle_min in particle_mins:
+                yield diam, float(thresh), particle_min, rm_smallparts(gauss > thresh, diam, particle_min)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--diams', type=int, nargs='+', default=[2, 4, 6, 10, 20],
+                        help='Cell diameters to test. Default: 2 4 6 10 20.')
+    parser.add_argument('--particle-mins', type=float, nargs='+', default=[0.05, 0.2, 0.5],
+                        help='Minimum particle sizes to test. Default: 0.05 0.2 0.5.')
+    parser.add_argument('--region', type=int, default=400,
+                        help='Side length of the regions checked as parts of a larger image. Default: 400.')
+    args = parser.parse_args()
+
+    mismatches = []
+    times = {'reference': 0.0, 'watershed': 0.0}
+    nr_cases = 0
+    for name, image in template_images().items():
+        for diam, thresh, particle_min, mask in masks(image, args.diams, args.particle_mins):
+            cases = [(mask, {})]
+            for origin in ((0, 0), (mask.shape[0]//2, mask.shape[1]//3), (mask.shape[0]-args.region, 7)):
+                region = mask[origin[0]:origin[0]+args.region, origin[1]:origin[1]+args.region]
+                cases.append((region, {'origin': origin, 'image_shape': mask.shape}))
+
+            for case_mask, kwargs in cases:
+                start = time.perf_counter()
+                expected = reference_watershed(case_mask, diam, particle_min, **kwargs)
+                times['reference'] += time.perf_counter() - start
+                start = time.perf_counter()
+                result = watershed(case_mask, diam, particle_min, **kwargs)
+                times['watershed'] += time.perf_counter() - start
+                nr_cases += 1
+
+                if result[1] != expected[1] or not np.array_equal(result[0], expected[0]):
+                    mismatches.append((name, diam, thresh, particle_min, kwargs.get('origin')))
+                    print(f'MISMATCH: {name}, diam {diam}, thresh {thresh:.2f}, particle_min {particle_min}, '
+                          f"region {kwargs.get('origin', 'whole image')}: {result[1]} vs {expected[1]} seeds")
+
+    print(f'Equivalence check over {nr_cases} cases: ' + ('FAILED' if mismatches else 'identical labels and counts'))
+    print(f"Total time: reference {times['reference']:.2f} s, watershed {times['watershed']:.2f} s "
+          f"({times['reference'] / times['watershed']:.1f}x)")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
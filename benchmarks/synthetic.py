@@ -0,0 +1,134 @@
+"""
+Synthetic fluorescent-nuclei images with known ground truth, for benchmarking the counting pipeline
+offline.
+
+Nuclei are slightly elliptical blobs with soft edges and varying brightness on an uneven background
+with shot and read noise. A chosen fraction of nuclei is placed touching a neighbour so that the
+watershed step has work to do. make_workspace writes a working directory in the layout of
+Template.zip (Composite, ManualCounts with one marked pixel per nucleus, and Ch1).
+"""
+
+
+import os
+import numpy as np
+
+
+def make_nuclei_image(shape=(1024, 1024), density=2.0, diam=12, touching=0.2, seed=0, dtype=np.uint8):
+    """
+    Generates a synthetic nuclei image.
+
+    **Parameters**
+        shape: *tuple, int*
+            Image shape in pixels.
+        density: *float*
+            Number of nuclei per 10,000 pixels.
+        diam: *int*
+            Mean nucleus diameter in pixels.
+        touching: *float*
+            Fraction of nuclei placed in contact with another nucleus.
+        seed: *int*
+            Seed of the random generator.
+        dtype: *np.dtype*
+            Integer dtype of the returned image.
+
+    **Returns**
+        image: *np.ndarray*
+            The synthetic image.
+        centers: *np.ndarray*
+            (n, 2) array of nucleus centers (row, col); n is the ground-truth count.
+    """
+    rng = np.random.default_rng(seed)
+    nr_nuclei = int(round(density * shape[0] * shape[1] / 1e4))
+    radius = diam / 2
+    margin = int(radius) + 1
+
+    #Place isolated nuclei by rejection, then put the touching ones next to placed nuclei
+    centers = []
+    nr_touching = int(round(touching * nr_nuclei))
+    attempts = 0
+    while len(centers) < nr_nuclei - nr_touching and attempts < 50 * nr_nuclei:
+        attempts += 1
+        center = rng.uniform((margin, margin), (shape[0] - margin, shape[1] - margin))
+        if not centers or np.min(np.hypot(*(np.array(centers) - center).T)) > 1.4 * diam:
+            centers.append(center)
+    for _ in range(nr_touching):
+        if not centers:
+            break
+        angle = rng.uniform(0, 2 * np.pi)
+        center = centers[rng.integers(len(centers))] + diam * np.array([np.sin(angle), np.cos(angle)])
+        if margin <= center[0] < shape[0] - margin and margin <= center[1] < shape[1] - margin:
+            if np.min(np.hypot(*(np.array(centers) - center).T)) > 0.95 * diam:
+                centers.append(center)
+    centers = np.array(centers).reshape(-1, 2)
+
+    #Render soft-edged ellipses into local patches
+    signal = np.zeros(shape)
+    half = int(np.ceil(radius * 1.6)) + 2
+    offsets = np.arange(-half, half + 1)
+    for row, col in centers:
+        r0, c0 = int(row), int(col)
+        rr, cc = np.meshgrid(offsets + r0 - row, offsets + c0 - col, indexing='ij')
+        theta = rng.uniform(0, np.pi)
+        stretch = rng.uniform(0.85, 1.15)
+        u = (rr * np.cos(theta) + cc * np.sin(theta)) * stretch
+        v = (-rr * np.sin(theta) + cc * np.cos(theta)) / stretch
+        distance = np.hypot(u, v) / (radius * rng.uniform(0.9, 1.1))
+        blob = rng.uniform(0.6, 1.0) / (1 + np.exp((distance - 1) * 8))
+        rows = slice(max(r0 - half, 0), min(r0 + half + 1, shape[0]))
+        cols = slice(max(c0 - half, 0), min(c0 + half + 1, shape[1]))
+        np.maximum(signal[rows, cols], blob[rows.start - (r0 - half):rows.stop - (r0 - half),
+                                            cols.start - (c0 - half):cols.stop - (c0 - half)],
+                   out=signal[rows, cols])
+
+    #Uneven background plus shot and read noise
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]] / max(shape)
+    background = 0.15 + 0.1 * np.sin(2.5 * yy + 1.0) * np.cos(3.0 * xx)
+    peak = 0.8 * np.iinfo(dtype).max
+    image = rng.poisson((signal * 0.7 + background) * 400) / 400 * peak
+    image += rng.normal(0, 0.01 * peak, shape)
+    image = np.clip(image, 0, np.iinfo(dtype).max)
+    return image.astype(dtype), centers
+
+
+def make_workspace(directory, nr_files=4, shape=(1024, 1024), density=2.0, diam=12, touching=0.2, seed=0,
+                   dtype=np.uint8, nr_composites=1):
+    """
+    Writes a working directory in the layout of Template.zip filled with synthetic images.
+
+    **Parameters**
+        directory: *str*
+            Working directory to create.
+        nr_files: *int*
+            Number of images written to Ch1.
+        shape, density, diam, touching, seed, dtype:
+            Passed to make_nuclei_image.
+        nr_composites: *int*
+            Number of composite images and masks; several are named composite_0.tif,
+            composite_1.tif, ... with masks composite_0_Mask.tif, ...
+
+    **Returns**
+        truth: *dict*
+            Ground-truth nucleus counts keyed by filename (the composites and the Ch1 files).
+    """
+    import cv2
+    truth = {}
+    for sub in ('Composite', 'ManualCounts', 'Ch1'):
+        os.makedirs(os.path.join(directory, sub), exist_ok=True)
+
+    for composite in range(nr_composites):
+        name = 'composite' if nr_composites == 1 else 'composite_{}'.format(composite)
+        image, centers = make_nuclei_image(
+            shape, density, diam, touching, seed + (nr_files + composite if composite else 0), dtype
+        )
+        cv2.imwrite(os.path.join(directory, 'Composite', name + '.tif'), image)
+        mask = np.zeros(shape, dtype=np.uint8)
+        mask[tuple(np.round(centers).astype(int).T)] = 255
+        cv2.imwrite(os.path.join(directory, 'ManualCounts', name + '_Mask.tif'), mask)
+        truth[name + '.tif'] = len(centers)
+
+    for file in range(nr_files):
+        image, centers = make_nuclei_image(shape, density, diam, touching, seed + file + 1, dtype)
+        fname = 'synthetic_{:04d}.tif'.format(file)
+        cv2.imwrite(os.path.join(directory, 'Ch1', fname), image)
+        truth[fname] = len(centers)
+    return truth
@@ -18,20 +18,102 @@ experienced with programming and adjusting the parameters of scripts in text edi
 
 import os
 import fnmatch
+import hashlib
+import re
+import json
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from itertools import islice
 import cv2
 import numpy as np
 import mahotas as mh
 import pandas as pd
 import scipy as sp
+from scipy.spatial import cKDTree
 from skimage import filters
+from skimage.filters import rank
 from skimage.segmentation import watershed as skwatershed
 from skimage.feature import peak_local_max
-from skimage import measure
+from skimage.morphology import max_tree
 import warnings
 warnings.filterwarnings("ignore")
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+def fast_median_filter(image, kernel_size, backend='auto'):
+    """
+    Median filter that matches scipy.ndimage.median_filter bit for bit but avoids its cost
+    growing with the kernel area. The image is padded by reflection (as scipy does) and
+    filtered with OpenCV's medianBlur, which uses a constant-time histogram algorithm for
+    8-bit images, or with the sliding-histogram scikit-image rank median. Images of other
+    dtypes are first mapped to the ranks of their distinct values, which leaves the median
+    unchanged, when there are few enough distinct values for these filters.
 
+    **Parameters**
+        image: *np.ndarray*
+            A 2D array containing cell tissue image information.
+        kernel_size: *int*
+            Odd side length of the square median kernel.
+        backend: *str*
+            'opencv', 'histogram' (scikit-image), or 'auto' to pick the fastest that applies.
 
-def median_filter(image, kernel_size):
+    **Returns**
+        new_image: *np.ndarray*
+            The filtered image, or None if the backend cannot filter this image exactly.
+    """
+    if image.ndim != 2 or kernel_size < 3:
+        return None
+    radius = kernel_size//2
+    crop = (slice(radius, -radius), slice(radius, -radius))
+    use_opencv = backend in ('auto', 'opencv')
+    use_histogram = backend in ('auto', 'histogram')
+
+    #OpenCV filters 8-bit images at any kernel size but other depths only up to size 5
+    if use_opencv and (image.dtype == np.uint8 or (kernel_size <= 5 and image.dtype in (np.uint16, np.float32))):
+        return cv2.medianBlur(np.pad(image, radius, mode='symmetric'), kernel_size)[crop]
+    if use_histogram and image.dtype == np.uint8:
+        return rank.median(np.pad(image, radius, mode='symmetric'), np.ones((kernel_size, kernel_size)))[crop]
+
+    #The distinct values are counted before any sorting or padding, so that images with too
+    #many of them are turned down cheaply; 8- and 16-bit integers are counted in linear time
+    max_values = 4096 if use_histogram else 256 if use_opencv else 0
+    if image.dtype.kind in 'ui' and image.dtype.itemsize <= 2:
+        low = int(image.min())
+        shifted = image if image.dtype.kind == 'u' else image.astype(np.int32) - low
+        offset = 0 if image.dtype.kind == 'u' else low
+        present = np.flatnonzero(np.bincount(shifted.ravel()))
+        if len(present) > max_values:
+            return None
+        values = (present + offset).astype(image.dtype)
+        lookup = np.zeros(present[-1] + 1, dtype=np.uint16)
+        lookup[present] = np.arange(len(present))
+        ranks = lookup[shifted]
+    else:
+        values = np.unique(image)
+        if len(values) > max_values:
+            return None
+        ranks = np.searchsorted(values, image)
+    ranks = np.pad(ranks, radius, mode='symmetric')
+    if use_opencv and len(values) <= 256:
+        return values[cv2.medianBlur(ranks.astype(np.uint8), kernel_size)[crop]]
+    if use_histogram and len(values) <= 4096:
+        return values[rank.median(ranks.astype(np.uint16), np.ones((kernel_size, kernel_size)))[crop]]
+    return None
+
+
+def median_filter(image, kernel_size, output=None, backend='auto'):
     """
     Originally written by Zachary Pennington. Accepts an image and applies a median
     filter to remove noise using the scipy.ndimage median filter function.
@@ -42,17 +124,29 @@ def median_filter(image, kernel_size):
         kernel_size: *int*
             Kernel used to apply the Gaussian blur; specified outside the function
             as half the optimal average cell diameter.
+        output: *np.ndarray*
+            Optional preallocated array, of the image's shape and dtype, to write into.
+        backend: *str*
+            'scipy' for scipy.ndimage.median_filter, or 'opencv', 'histogram' or 'auto' to
+            use fast_median_filter where it applies, falling back to scipy otherwise.
         
     **Returns**
         new_image: *np.ndarray*
             An array containing intensity information after noise filtering.
     """
     kernel_size = (kernel_size-1) if (kernel_size%2 == 0) else kernel_size
-    image = sp.ndimage.median_filter(image, size=kernel_size)
+    if backend != 'scipy':
+        new_image = fast_median_filter(image, kernel_size, backend)
+        if new_image is not None:
+            if output is None:
+                return new_image
+            np.copyto(output, new_image)
+            return output
+    image = sp.ndimage.median_filter(image, size=kernel_size, output=output)
     return image
 
 
-def subtract_bg(image, kernel_size):
+def subtract_bg(image, kernel_size, dtype='float', out=None):
     """
     Originally written by Zachary Pennington. Accepts an image that was processed by
     a median filter to remove noise and subtracts away background using the openCV
@@ -64,18 +158,25 @@ def subtract_bg(image, kernel_size):
         kernel_size: *int*
             Kernal used to apply the Gaussian blur; specified outside the function
             as three times the optimal average cell diameter.
+        dtype: *str*
+            Floating point precision of the result; the image is only converted if its
+            dtype differs.
+        out: *np.ndarray*
+            Optional preallocated array, of the image's shape and the given dtype, that
+            receives the background and then the result in place.
         
     **Returns**
         new_image: *np.ndarray*
             An array containing intensity information after blur post-processing.
     """
 
-    image = image.astype('float')
-    bg = cv2.GaussianBlur(image,
+    image = image.astype(dtype, copy=False)
+    new_image = cv2.GaussianBlur(image,
                          (0,0),
-                         kernel_size)
-    new_image = image - bg
-    new_image[new_image<0] = 0
+                         kernel_size,
+                         dst=out)
+    np.subtract(image, new_image, out=new_image)
+    np.maximum(new_image, 0, out=new_image)
     return new_image
 
 
@@ -108,7 +209,662 @@ def rm_smallparts (image, optimal_diam, particle_min):
     image_current_thresholded = labeled != 0
     return image_current_thresholded
 
-def cellcounter(file,channel,params,dirinfo,use_watershed=False,save_intensities=False):
+
+def cell_intensities(cells, image):
+    """
+    Measures the size and mean intensity of every labelled cell. Pixels are grouped by
+    label with a single sort, and each cell's mean is taken over its pixels in image order
+    so the values are identical to masking the image one cell at a time.
+
+    **Parameters**
+        cells: *np.ndarray*
+            Labelled cell image, where 0 is background.
+        image: *np.ndarray*
+            Intensity image the same shape as cells.
+
+    **Returns**
+        cell_ids: *np.ndarray*
+            The labels present in cells, in ascending order.
+        cell_sizes: *np.ndarray*
+            Number of pixels in each cell.
+        cell_means: *np.ndarray*
+            Mean intensity of each cell.
+    """
+    flat_cells = cells.ravel()
+    pixels = np.flatnonzero(flat_cells)
+    pixels = pixels[np.argsort(flat_cells[pixels], kind='stable')]
+    sorted_ids = flat_cells[pixels]
+    sorted_values = image.ravel()[pixels]
+
+    starts = np.flatnonzero(np.diff(sorted_ids, prepend=sorted_ids[:1]-1)) if len(pixels) else pixels
+    stops = np.append(starts[1:], len(pixels))
+    cell_means = np.array([sorted_values[start:stop].mean(dtype=np.float64) for start, stop in zip(starts, stops)], dtype=float)
+    return sorted_ids[starts], stops - starts, cell_means
+
+
+def label_overlaps(cells_a, cells_b):
+    """
+    Builds the co-occurrence histogram of two label images of the same field in one pass:
+    every pair of overlapping cells and the number of pixels they share.
+
+    **Parameters**
+        cells_a, cells_b: *np.ndarray*
+            Labelled cell images of the same shape, where 0 is background.
+
+    **Returns**
+        labels_a: *np.ndarray*
+            Label in cells_a of each overlapping pair, in ascending order.
+        labels_b: *np.ndarray*
+            Label in cells_b of each pair.
+        nr_pixels: *np.ndarray*
+            Number of pixels shared by each pair.
+    """
+    if cells_a.shape != cells_b.shape:
+        raise ValueError("Cannot overlap label images of shapes {} and {}".format(cells_a.shape, cells_b.shape))
+    both = (cells_a != 0) & (cells_b != 0)
+    stride = np.uint64(cells_b.max(initial=0)) + np.uint64(1)
+    pairs, nr_pixels = np.unique(cells_a[both].astype(np.uint64) * stride + cells_b[both].astype(np.uint64),
+                                 return_counts=True)
+    return (pairs // stride).astype(np.int64), (pairs % stride).astype(np.int64), nr_pixels
+
+
+def cell_overlaps(cells_a, cells_b, cell_ids):
+    """
+    Measures how much of every cell of one channel is covered by the cells of another.
+
+    **Parameters**
+        cells_a, cells_b: *np.ndarray*
+            Labelled cell images of the same field in the two channels.
+        cell_ids: *np.ndarray*
+            Labels of the cells of cells_a to measure, e.g. as returned by cell_intensities.
+
+    **Returns**
+        overlap: *np.ndarray*
+            Fraction of each cell's pixels that lie in a cell of cells_b.
+        partner: *np.ndarray*
+            Label of the cell of cells_b sharing the most pixels with each cell; 0 if none.
+    """
+    labels_a, labels_b, nr_pixels = label_overlaps(cells_a, cells_b)
+    cell_ids = np.asarray(cell_ids, dtype=np.int64)
+    nr_labels = int(max(cell_ids.max(initial=0), labels_a.max(initial=0))) + 1
+    sizes = np.bincount(cells_a.ravel(), minlength=nr_labels)
+    shared = np.bincount(labels_a, weights=nr_pixels, minlength=nr_labels)
+
+    #The pairs are sorted by label; within each label the largest overlap is sorted last
+    order = np.lexsort((nr_pixels, labels_a))
+    last = order[np.append(labels_a[order][1:] != labels_a[order][:-1], True)] if len(order) else order
+    partners = np.zeros(nr_labels, dtype=np.int64)
+    partners[labels_a[last]] = labels_b[last]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return shared[cell_ids] / sizes[cell_ids], partners[cell_ids]
+
+
+# Preprocessed images keyed by (file, mtime, cell_diam, precision) so that repeated counts of the same
+# file at the same diameter (e.g. during threshold optimization) skip the filtering steps.
+_preprocess_cache = OrderedDict()
+_preprocess_cache_lock = threading.Lock()  # The GUI's preview and counting threads share the cache
+PREPROCESS_CACHE_SIZE = 2
+
+
+def reuse_buffer(buffers, name, shape, dtype):
+    """
+    Returns the array stored under name in buffers, replacing it first if its shape or
+    dtype do not match. With buffers set to None a new array is always returned.
+    """
+    if buffers is None:
+        return np.empty(shape, dtype)
+    if name not in buffers or buffers[name].shape != shape or buffers[name].dtype != np.dtype(dtype):
+        buffers[name] = np.empty(shape, dtype)
+    return buffers[name]
+
+
+@contextmanager
+def profile_stage(profile, stage):
+    """
+    Records the wall time of a stage of the counting pipeline in profile[stage + '_s'] and,
+    while tracemalloc is tracing, the peak memory allocated during the stage in MB in
+    profile[stage + '_MB']. Repeated stages add up their times and keep their largest peak.
+    With profile set to None nothing is measured.
+    """
+    if profile is None:
+        yield
+        return
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        start_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile[stage + '_s'] = profile.get(stage + '_s', 0.0) + time.perf_counter() - start
+        if tracing:
+            peak = (tracemalloc.get_traced_memory()[1] - start_memory) / 2**20
+            profile[stage + '_MB'] = max(profile.get(stage + '_MB', 0.0), peak)
+
+
+def profile_summary(profile):
+    """
+    Summarizes the per-file stage profiles collected by cellcounting_batch.
+
+    **Parameters**
+        profile: *list, dict*
+            One dictionary of stage times ('<stage>_s') and peak allocations ('<stage>_MB')
+            per file, as recorded by profile_stage.
+
+    **Returns**
+        summary: *df*
+            A pandas dataframe with one row per stage, in pipeline order, holding the total
+            and mean time over all files, the share of the total time and the largest peak
+            allocation.
+    """
+    table = pd.DataFrame(profile)
+    stages = [column[:-2] for column in table.columns if column.endswith('_s') and column != 'total_s']
+    times = table[[stage + '_s' for stage in stages]]
+    summary = pd.DataFrame(
+        {
+            'Total_s': times.sum().to_numpy(),
+            'Mean_s': times.mean().to_numpy(),
+            'Share_pct': 100*times.sum().to_numpy()/times.sum().sum(),
+            'Peak_MB': [table[stage + '_MB'].max() if stage + '_MB' in table else np.nan for stage in stages]
+        },
+        index=pd.Index(stages, name='Stage')
+    )
+    return summary
+
+
+def preprocess_image(image, cell_diam, precision='float32', buffers=None, median_backend='auto', profile=None):
+    """
+    Runs the threshold-independent part of the counting pipeline on an image: median
+    filter noise removal, background subtraction and Gaussian blur. The floating point
+    steps share two arrays of the requested precision, which can be reused across calls.
+
+    **Parameters**
+        image: *np.ndarray*
+            An array containing cell tissue image information.
+        cell_diam: *int*
+            The average cell diameter used to size the filter kernels.
+        precision: *str*
+            Floating point dtype of the 'bg' and 'gauss' images; 'float32' halves the memory
+            and bandwidth of 'float64'.
+        buffers: *dict, array*
+            Optional dictionary of arrays reused between calls (see reuse_buffer). The
+            returned images then live in these arrays and are overwritten by the next call.
+        median_backend: *str*
+            Median filter implementation; see median_filter.
+        profile: *dict*
+            Optional dictionary that receives the time and memory of each step; see
+            profile_stage.
+
+    **Returns**
+        images: *dict, array*
+            Dictionary containing the original image and the image after each step of
+            pre-processing ('image', 'median', 'bg' and 'gauss').
+    """
+    images = {'image' : image}
+    with profile_stage(profile, 'median'):
+        images['median'] = median_filter(
+            image, kernel_size = cell_diam//2,
+            output = None if buffers is None else reuse_buffer(buffers, 'median', image.shape, image.dtype),
+            backend = median_backend
+        )
+    with profile_stage(profile, 'background'):
+        work = reuse_buffer(buffers, 'work', image.shape, precision)
+        np.copyto(work, images['median'], casting='unsafe')
+        images['bg'] = subtract_bg(work, kernel_size = cell_diam*3, dtype = precision,
+                                   out = reuse_buffer(buffers, 'bg', image.shape, precision))
+    with profile_stage(profile, 'gaussian'):
+        images['gauss'] = cv2.GaussianBlur(images['bg'],(0,0),cell_diam/6,dst=work)
+    return images
+
+
+def read_image(image_file):
+    """Reads an image file at its native bit depth, raising an IOError if it cannot be decoded."""
+    image = cv2.imread(image_file,cv2.IMREAD_ANYDEPTH)
+    if image is None:
+        raise IOError("Could not read image file: " + image_file)
+    return image
+
+
+def read_images(image_files, read=read_image):
+    """Reads several image files, e.g. the channels of a field; image_files maps names to paths (None for none)."""
+    return {name: None if image_file is None else read(image_file) for name, image_file in image_files.items()}
+
+
+def image_cache_file(image_file, cache_dir):
+    """Path of the raw .npy copy of an image in cache_dir, named after the file's path, size and modification time."""
+    stat = os.stat(image_file)
+    key = '{}:{}:{}'.format(os.path.abspath(image_file), stat.st_size, stat.st_mtime_ns)
+    stem = os.path.splitext(os.path.basename(image_file))[0]
+    return os.path.join(os.path.normpath(cache_dir), stem + '_' + hashlib.sha1(key.encode()).hexdigest()[:12] + '.npy')
+
+
+def open_image(image_file, cache_dir=None):
+    """
+    Opens an image without reading its pixels where possible. Uncompressed TIFFs whose strips
+    or tiles are stored contiguously are memory-mapped, so only the regions that are used are
+    paged in from disk and opening even a very large slide takes next to no time. Other
+    images (e.g. compressed TIFFs) are decoded; given a cache_dir, the decoded pixels are
+    also saved there as a raw .npy file, which later opens of the unchanged file map instead.
+
+    **Parameters**
+        image_file: *str*
+            Path to the image.
+        cache_dir: *str*
+            Optional directory for the raw copies of images that cannot be mapped directly;
+            created if needed.
+
+    **Returns**
+        source: *lib*
+            A library holding the image 'file', its read-only 'pixels' (a memory map, or an
+            array if it was decoded), whether they are 'mapped', and 'bytes_read', the
+            number of bytes read from disk so far. Pass it to read_region to use its pixels.
+    """
+    source = {'file': image_file, 'pixels': None, 'mapped': True, 'bytes_read': 0}
+    if tifffile is not None and image_file.lower().endswith(('.tif', '.tiff')):
+        #Only the first page is read, as by cv2.imread, and only plain grayscale pixels in
+        #native byte order are used as they are stored
+        try:
+            with tifffile.TiffFile(image_file) as tiff:
+                page = tiff.pages[0]
+                mappable = (page.is_memmappable and page.samplesperpixel == 1
+                            and page.photometric == tifffile.PHOTOMETRIC.MINISBLACK)
+            pixels = tifffile.memmap(image_file, page=0, mode='r') if mappable else None
+        except (ValueError, tifffile.TiffFileError):
+            pixels = None
+        if pixels is not None and pixels.ndim == 2 and pixels.dtype.isnative:
+            source['pixels'] = pixels
+            return source
+
+    cached = None if cache_dir is None else image_cache_file(image_file, cache_dir)
+    if cached is None or not os.path.isfile(cached):
+        pixels = read_image(image_file)
+        source['bytes_read'] += os.path.getsize(image_file)
+        if cached is None:
+            pixels.flags.writeable = False
+            source['pixels'], source['mapped'] = pixels, False
+            return source
+        os.makedirs(os.path.normpath(cache_dir), exist_ok=True)
+        with open(cached + '.tmp', 'wb') as stream:
+            np.save(stream, pixels)
+        os.replace(cached + '.tmp', cached)
+    source['pixels'] = np.load(cached, mmap_mode='r')
+    return source
+
+
+def prefetch_image(image_file, cache_dir=None, load=True):
+    """
+    Opens an image with open_image for a read started ahead of time. With load, the pixels of
+    a memory-mapped image are read into memory here, so that reading from disk overlaps with
+    the work on the previous image instead of being paged in while this one is processed.
+    Without it (e.g. for tiled counting of slides larger than memory) the image stays mapped.
+    """
+    source = open_image(image_file, cache_dir)
+    if load and source['mapped']:
+        pixels = np.array(source['pixels'])
+        pixels.flags.writeable = False
+        source['pixels'], source['mapped'] = pixels, False
+        source['bytes_read'] += pixels.nbytes
+    return source
+
+
+def read_region(image, region=None):
+    """
+    Returns a region of an image (slices, e.g. from image_tiles; the whole image if None)
+    without copying it. image is an array or a source opened by open_image, whose
+    'bytes_read' then counts the pixel data of mapped regions as they are requested.
+    """
+    if not isinstance(image, dict):
+        return image if region is None else image[region]
+    pixels = image['pixels'] if region is None else image['pixels'][region]
+    if image['mapped']:
+        image['bytes_read'] += pixels.nbytes
+    return pixels
+
+
+def write_now(function, *args, **kwargs):
+    """Performs an output write immediately; the default write function of cellcounter."""
+    return function(*args, **kwargs)
+
+
+#Label image output formats: file suffix and TIFF compression tag (1 none, 5 LZW, 8 deflate)
+LABEL_FORMATS = {
+    'deflate': ('_Counts.tif', 8),
+    'lzw': ('_Counts.tif', 5),
+    'tiff': ('_Counts.tif', 1),
+    'rle': ('_Counts.npz', None),
+    'none': (None, None)
+}
+
+
+def label_dtype(nr_labels):
+    """Returns the smallest unsigned integer dtype that holds labels up to nr_labels."""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if nr_labels <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def label_file(output_dir, fname, label_format='deflate'):
+    """Returns the path of the label image written for fname, or None if the format writes none."""
+    suffix = LABEL_FORMATS[label_format][0]
+    if suffix is None:
+        return None
+    return os.path.splitext(os.path.join(os.path.normpath(output_dir), fname))[0] + suffix
+
+
+def encode_label_runs(cells):
+    """
+    Run-length encodes a label image object by object. Each run is a stretch of pixels of
+    one label along a row; the runs are grouped by label and in raster order within a label.
+
+    **Parameters**
+        cells: *np.ndarray*
+            Label image, 0 being background.
+
+    **Returns**
+        runs: *dict*
+            'shape' of the image and, for every run, its 'labels', its 'starts' (flat
+            pixel index) and its 'lengths'.
+    """
+    flat = cells.ravel()
+    #A run starts wherever the label changes or a new row begins
+    breaks = np.ones(flat.size, dtype=bool)
+    breaks[1:] = flat[1:] != flat[:-1]
+    breaks[::cells.shape[-1]] = True
+    starts = np.flatnonzero(breaks)
+    lengths = np.diff(np.append(starts, flat.size))
+    labels = flat[starts]
+    runs = labels > 0
+    order = np.argsort(labels[runs], kind='stable')
+    return {
+        'shape': np.array(cells.shape),
+        'labels': labels[runs][order].astype(label_dtype(flat.max(initial=0))),
+        'starts': starts[runs][order].astype(label_dtype(flat.size)),
+        'lengths': lengths[runs][order].astype(label_dtype(cells.shape[-1]))
+    }
+
+
+def decode_label_runs(runs):
+    """Rebuilds the label image from the output of encode_label_runs."""
+    cells = np.zeros(int(np.prod(runs['shape'])), dtype=runs['labels'].dtype)
+    lengths = runs['lengths'].astype(np.int64)
+    #Flat index of every labelled pixel: its run's start plus its offset within the run
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    cells[np.repeat(runs['starts'].astype(np.int64), lengths) + offsets] = np.repeat(runs['labels'], lengths)
+    return cells.reshape(tuple(runs['shape']))
+
+
+def save_labels(path, cells, label_format='deflate'):
+    """
+    Writes a label image in one of the LABEL_FORMATS, as the smallest unsigned integer
+    dtype that holds its largest label.
+
+    **Parameters**
+        path: *str*
+            Output file, as returned by label_file.
+        cells: *np.ndarray*
+            Label image, 0 being background.
+        label_format: *str*
+            'deflate', 'lzw' or 'tiff' (uncompressed) write a TIFF; 'rle' writes the runs
+            of encode_label_runs to a compressed .npz; 'none' writes nothing.
+    """
+    if label_format == 'none':
+        return
+    if label_format == 'rle':
+        np.savez_compressed(path, **encode_label_runs(cells))
+        return
+    cells = cells.astype(label_dtype(cells.max(initial=0)), copy=False)
+    if not cv2.imwrite(path, cells, [cv2.IMWRITE_TIFF_COMPRESSION, LABEL_FORMATS[label_format][1]]):
+        raise IOError("Could not write label image: " + path)
+
+
+def load_labels(path):
+    """Reads a label image written by save_labels in any of its formats."""
+    if path.endswith('.npz'):
+        with np.load(path) as runs:
+            return decode_label_runs(runs)
+    cells = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if cells is None:
+        raise IOError("Could not read label image: " + path)
+    return cells
+
+
+def load_preprocessed(image_file, cell_diam, use_cache=True, precision='float32', buffers=None, median_backend='auto', profile=None, image=None, cache_dir=None, scale=1):
+    """
+    Loads an image file and passes it through preprocess_image. Results are cached by
+    file path, modification time and cell diameter, so only the threshold-dependent steps
+    need to be rerun when the same file is counted again. The cached arrays are read-only.
+    The image is opened with open_image, so an uncompressed TIFF is filtered straight from
+    its memory map rather than from a decoded copy.
+
+    **Parameters**
+        image_file: *str*
+            Path to the image to be loaded.
+        cell_diam: *int*
+            The average cell diameter used to size the filter kernels.
+        use_cache: *bool*
+            Whether the result should be looked up in and stored to the cache.
+        precision: *str*
+            Floating point dtype of the preprocessed images.
+        buffers: *dict, array*
+            Optional arrays reused between calls when the cache is not used; see
+            preprocess_image.
+        median_backend: *str*
+            Median filter implementation; see median_filter.
+        profile: *dict*
+            Optional dictionary that receives the time and memory of reading and of each
+            preprocessing step; cache hits are not recorded. See profile_stage. The bytes
+            read from disk are added to profile['read_bytes'].
+        image: *np.ndarray or lib*
+            The contents of image_file if it has already been read, or its source as
+            opened by open_image.
+        cache_dir: *str*
+            Optional directory of raw image copies; see open_image.
+        scale: *int*
+            Downsampling factor. Above 1, the image is shrunk by this factor (averaging its
+            pixels) and preprocessed with the diameter scaled to match, which gives a quick,
+            approximate result, e.g. for a preview. It is cached apart from the full image.
+
+    **Returns**
+        images: *dict, array*
+            Dictionary containing the original image and the image after each step of
+            pre-processing ('image', 'median', 'bg' and 'gauss').
+    """
+    key = (os.path.abspath(image_file), os.stat(image_file).st_mtime_ns, cell_diam, precision, scale)
+    if use_cache:
+        with _preprocess_cache_lock:
+            if key in _preprocess_cache:
+                _preprocess_cache.move_to_end(key)
+                return _preprocess_cache[key]
+
+    if image is None:
+        with profile_stage(profile, 'read'):
+            image = open_image(image_file, cache_dir)
+    source = image if isinstance(image, dict) else None
+    image = read_region(image)
+    if scale > 1:
+        image = cv2.resize(np.asarray(image), (max(image.shape[1]//scale, 1), max(image.shape[0]//scale, 1)),
+                           interpolation=cv2.INTER_AREA)
+        cell_diam = max(int(round(cell_diam / scale)), 2)
+    images = preprocess_image(image, cell_diam, precision, buffers = None if use_cache else buffers,
+                              median_backend = median_backend, profile = profile)
+    if profile is not None and source is not None:
+        profile['read_bytes'] = profile.get('read_bytes', 0) + source['bytes_read']
+    if use_cache:
+        for image in images.values():
+            image.flags.writeable = False
+        with _preprocess_cache_lock:
+            _preprocess_cache[key] = images
+            while len(_preprocess_cache) > PREPROCESS_CACHE_SIZE:
+                _preprocess_cache.popitem(last=False)
+    return images
+
+
+def clear_preprocess_cache():
+    """Empties the cache of preprocessed images used by load_preprocessed."""
+    with _preprocess_cache_lock:
+        _preprocess_cache.clear()
+
+
+def preprocess_halo(cell_diam):
+    """
+    Returns the margin in pixels that preprocess_image needs around a tile for the tile's
+    interior to match the whole-image result: the radii of the median filter and of the
+    two Gaussian kernels (OpenCV sizes non-8-bit kernels as round(8*sigma + 1), made odd).
+    """
+    kernel_size = cell_diam//2
+    kernel_size = (kernel_size-1) if (kernel_size%2 == 0) else kernel_size
+    gaussian_radius = lambda sigma: int(round(sigma*8 + 1))//2
+    return kernel_size//2 + gaussian_radius(cell_diam*3) + gaussian_radius(cell_diam/6) + 1
+
+
+def image_tiles(shape, tile_size, halo):
+    """
+    Splits an image into square tiles with overlapping margins.
+
+    **Parameters**
+        shape: *tuple, int*
+            Shape of the image.
+        tile_size: *int*
+            Side length of the tiles, excluding the margins.
+        halo: *int*
+            Width of the margin added around each tile, clipped at the image edges.
+
+    **Returns**
+        tiles: *generator*
+            Yields (core, region, inner) slice tuples: the tile in image coordinates, the
+            tile plus its margin in image coordinates, and the tile within the region.
+    """
+    for row in range(0, shape[0], tile_size):
+        for col in range(0, shape[1], tile_size):
+            core = (slice(row, min(row+tile_size, shape[0])), slice(col, min(col+tile_size, shape[1])))
+            region = tuple(slice(max(s.start-halo, 0), min(s.stop+halo, size)) for s, size in zip(core, shape))
+            inner = tuple(slice(s.start-r.start, s.stop-r.start) for s, r in zip(core, region))
+            yield core, region, inner
+
+
+def tiled_cellcounter(image, cell_diam, thresh, particle_min, use_watershed=False, tile_size=None, precision='float32', median_backend='auto'):
+    """
+    Counts cells in an image too large to preprocess whole. The float preprocessing runs on
+    overlapping tiles whose margins cover the filter kernels, so only the thresholded mask
+    (one byte per pixel) and the label images are held at full size. Objects crossing tile
+    seams are joined by labelling the assembled mask. For watershed segmentation, each
+    group of touching objects is segmented by the tile holding its top-left corner, with
+    the peak search excluding the edges of the full image rather than of the tile. Counts
+    match cellcounter on the whole image.
+
+    **Parameters**
+        image: *np.ndarray or lib*
+            An array containing cell tissue image information, or an image source opened
+            by open_image, from which each tile is read as it is processed.
+        cell_diam: *int*
+            The average cell diameter used for counting.
+        thresh: *int/float*
+            Threshold applied to the preprocessed image.
+        particle_min:
+            User-specified minimum particle size fraction of the ideal average cell area;
+            below which cells are cut off.
+        use_watershed: *bool*
+            Whether touching cells are separated by the watershed algorithm.
+        tile_size: *int*
+            Side length of the tiles; defaults to four times the preprocessing margin.
+        precision: *str*
+            Floating point dtype used for preprocessing.
+        median_backend: *str*
+            Median filter implementation; see median_filter.
+
+    **Returns**
+        cells: *np.ndarray*
+            Labelled cell image.
+        nr_nuclei: *int*
+            Number of cells counted.
+        thresholded: *np.ndarray*
+            Boolean mask after thresholding and removal of small particles.
+    """
+    halo = preprocess_halo(cell_diam)
+    tile_size = tile_size or 4*halo
+    shape = (image['pixels'] if isinstance(image, dict) else image).shape
+
+    thresholded = np.zeros(shape, dtype=bool)
+    buffers = {}
+    for core, region, inner in image_tiles(shape, tile_size, halo):
+        thresholded[core] = preprocess_image(read_region(image, region), cell_diam, precision, buffers, median_backend)['gauss'][inner] > thresh
+    thresholded = rm_smallparts(thresholded, cell_diam, particle_min)
+
+    if not use_watershed:
+        cells, nr_nuclei = sp.ndimage.label(thresholded)
+        return cells, nr_nuclei, thresholded
+
+    #Touching objects share watershed seeds, so they are segmented together
+    groups, nr_groups = sp.ndimage.label(thresholded, structure=np.ones((3,3)))
+    bboxes = sp.ndimage.find_objects(groups)
+    tile_groups = {}
+    for group, bbox in enumerate(bboxes, start=1):
+        tile_groups.setdefault((bbox[0].start//tile_size, bbox[1].start//tile_size), []).append(group)
+
+    cells = np.zeros(shape, dtype=np.int32)
+    nr_nuclei = 0
+    for owned in tile_groups.values():
+        region = tuple(
+            slice(max(min(bboxes[group-1][d].start for group in owned)-1, 0),
+                  min(max(bboxes[group-1][d].stop for group in owned)+1, shape[d]))
+            for d in range(2)
+        )
+        region_mask = np.isin(groups[region], owned)
+        labels, nseeds = watershed(
+            region_mask, cell_diam, particle_min,
+            origin=(region[0].start, region[1].start), image_shape=shape
+        )
+        region_cells = cells[region]
+        region_cells[labels > 0] = labels[labels > 0] + nr_nuclei
+        nr_nuclei += nseeds
+    return cells, nr_nuclei, thresholded
+
+
+def tiled_cell_intensities(image, cells, cell_diam, tile_size=None, precision='float32', median_backend='auto'):
+    """
+    Tiled counterpart of cell_intensities: measures the size and mean preprocessed intensity
+    of every labelled cell, preprocessing the image one tile at a time.
+
+    **Parameters**
+        image: *np.ndarray or lib*
+            An array containing cell tissue image information, or an image source opened
+            by open_image.
+        cells: *np.ndarray*
+            Labelled cell image, where 0 is background.
+        cell_diam: *int*
+            The average cell diameter used for counting.
+        tile_size: *int*
+            Side length of the tiles; defaults to four times the preprocessing margin.
+        precision: *str*
+            Floating point dtype used for preprocessing.
+        median_backend: *str*
+            Median filter implementation; see median_filter.
+
+    **Returns**
+        cell_ids: *np.ndarray*
+            The labels present in cells, in ascending order.
+        cell_sizes: *np.ndarray*
+            Number of pixels in each cell.
+        cell_means: *np.ndarray*
+            Mean intensity of each cell.
+    """
+    halo = preprocess_halo(cell_diam)
+    tile_size = tile_size or 4*halo
+    nr_labels = int(cells.max()) + 1
+    sizes = np.bincount(cells.ravel(), minlength=nr_labels)
+    sums = np.zeros(nr_labels)
+    buffers = {}
+    shape = (image['pixels'] if isinstance(image, dict) else image).shape
+    for core, region, inner in image_tiles(shape, tile_size, halo):
+        gauss = preprocess_image(read_region(image, region), cell_diam, precision, buffers, median_backend)['gauss'][inner]
+        sums += np.bincount(cells[core].ravel(), weights=gauss.ravel(), minlength=nr_labels)
+    cell_ids = np.flatnonzero(sizes[1:]) + 1
+    return cell_ids, sizes[cell_ids], sums[cell_ids]/sizes[cell_ids]
+
+
+def cellcounter(file,channel,params,dirinfo,use_watershed=False,save_intensities=False,buffers=None,profile=None,image=None,write=write_now):
     """
     Originally written by Zachary Pennington, edited by Noah Smith. Presented with an image
     file which is passed through the same pre-processing pipeline as the mask before being
@@ -120,13 +876,20 @@ def cellcounter(file,channel,params,dirinfo,use_watershed=False,save_intensities
             The number file in an ordered list to be pulled from filenames_current for
             processing. Used as a key.
         channel: *str*
-            A string specifying the channel over which cells should be counted. The applet
-            is only configured for single-channel counting, but eventually multichannel
-            processing could be implemented using this parameter.
+            A string specifying the channel over which cells should be counted: a channel
+            subdirectory found by getdirinfo (e.g. "Ch1") or "Optim" for the composite.
         params: *lib, str/int*
             A library containing various parameters that are important for cell counting,
             including optimal diameter and threshold for picking and whether or not counting
-            should include watershed segmentation.
+            should include watershed segmentation. A channel "ChN" is counted with
+            params['chN_diam'] (default params['ch1_diam']) and params['chN_thresh']
+            (default: Otsu's threshold of the image). If params['tile_size'] is set (a tile
+            side length in pixels, or 'auto' to size tiles from the cell diameter), the image
+            is processed in tiles by tiled_cellcounter and no 'gauss' image is returned.
+            params['precision'] sets the floating point dtype of preprocessing (default
+            'float32') and params['median_backend'] the median filter implementation
+            (default 'auto', see median_filter). Images are opened with open_image, keeping
+            raw copies of images that cannot be memory-mapped in params['image_cache'] if set.
         dirinfo: *lib, str*
             A library containing the working directory and all pertinent subdirectories
             for the cell-count optimization and image processing.
@@ -134,68 +897,123 @@ def cellcounter(file,channel,params,dirinfo,use_watershed=False,save_intensities
             User-specified condition for whether or not the cell-counting process makes
             use of the watershed algorithm.
         save_intensities: *bool*
-            Switch to determine whether individual cell intensities are saved in .csv files;
+            Switch to determine whether individual cell intensities are measured and saved;
             for instance, they are saved during data processing but not during optimizations.
+            They are written to a _CellInfo.csv file if params['results_format'] is 'csv'
+            (the default); otherwise the caller stores the returned 'cell_info'.
+        buffers: *dict, array*
+            Optional arrays reused between calls for the preprocessing of uncached files;
+            the returned images are then overwritten by the next call (see preprocess_image).
+        profile: *dict*
+            Optional dictionary that receives the wall time and peak memory of each stage
+            (see profile_stage), and the bytes read from disk under 'read_bytes'. Nothing is
+            measured when it is None.
+        image: *np.ndarray or lib*
+            The decoded image file if it has already been read, e.g. ahead of time by
+            cellcounting_batch, or its source as opened by open_image.
+        write: *callable*
+            Function through which the _CellInfo.csv file is written, called as
+            write(function, *args, **kwargs); it may defer the write to another thread.
         
     **Returns**
         count_output: *lib, str/int/np.ndarray*
             A library containing data pertinent to the cell counting results; includes
             an image of the cells and several copies of the image after pre-processing;
-            also includes the number of cells and the size of the image.
+            also includes the number of cells, the size of the image, the threshold used
+            and, with save_intensities, the per-cell results as a dataframe under 'cell_info'.
     """
 
-    #Set function parameters in accordance with channel to be counted
-    if channel == "Ch1":
-        cell_diam = params['ch1_diam']
-        thresh = params['ch1_thresh']
-        directory_current = dirinfo['ch1']
-        filenames_current = dirinfo['ch1_fnames']
-        output = dirinfo['output_ch1']
-    elif channel == "Optim":
+    #Set function parameters in accordance with channel to be counted; channels other than Ch1 use
+    #its diameter unless given their own, and Otsu's threshold of each image unless given a threshold
+    if channel == "Optim":
         cell_diam = params['diam']
         thresh = params['thresh']
         directory_current = dirinfo['composite']
         filenames_current = dirinfo['composite_fnames']
-
-    #Load file
+    else:
+        key = channel.lower()
+        cell_diam = params.get(key + '_diam', params['ch1_diam'])
+        thresh = params.get(key + '_thresh')
+        directory_current = dirinfo[key]
+        filenames_current = dirinfo[key + '_fnames']
+        output = dirinfo['output_' + key]
+
+    #Load and preprocess file; the composite is cached since only the threshold changes between optimizer calls
     image_current_file = os.path.join(os.path.normpath(directory_current), filenames_current[file])
-    image_current_gray = cv2.imread(image_current_file,cv2.IMREAD_ANYDEPTH)
     if channel != "Optim":
         print("Processing: " + filenames_current[file])
-
-    #Process file
-    image_current_median = median_filter(image_current_gray, kernel_size = cell_diam//2)
-    image_current_BG = subtract_bg(image_current_median, kernel_size = cell_diam*3)
-    image_current_gaussian = cv2.GaussianBlur(image_current_BG.astype('float'),(0,0),cell_diam/6)
-    image_current_thresholded = rm_smallparts(image_current_gaussian > thresh, cell_diam, params['particle_min'])
-    roi_size = image_current_gray.size
-
-    if use_watershed == True:
-        image_current_cells, nr_nuclei = watershed(image_current_thresholded, cell_diam, params['particle_min'])
+    precision = params.get('precision', 'float32')
+    median_backend = params.get('median_backend', 'auto')
+    if params.get('tile_size') is not None:
+        tile_size = None if params['tile_size'] == 'auto' else params['tile_size']
+        if thresh is None:
+            raise ValueError("Tiled counting needs a threshold for channel " + channel)
+        #Tiles are read from the image source one at a time, so large images need not be read whole
+        if image is None:
+            with profile_stage(profile, 'read'):
+                image = open_image(image_current_file, params.get('image_cache'))
+        image_current_gray = image['pixels'] if isinstance(image, dict) else image
+        image_current_gaussian = None
+        with profile_stage(profile, 'tiled_count'):
+            image_current_cells, nr_nuclei, image_current_thresholded = tiled_cellcounter(
+                image, cell_diam, thresh, params['particle_min'], use_watershed, tile_size, precision, median_backend
+            )
     else:
-        image_current_cells, nr_nuclei = sp.ndimage.label(image_current_thresholded)
+        images = load_preprocessed(image_current_file, cell_diam, use_cache = channel == "Optim",
+                                   precision = precision, buffers = buffers, median_backend = median_backend,
+                                   profile = profile, image = image, cache_dir = params.get('image_cache'))
+        image_current_gray = images['image']
+        image_current_gaussian = images['gauss']
+        if thresh is None:
+            thresh = float(filters.threshold_otsu(image_current_gaussian))
+
+        #Process file
+        with profile_stage(profile, 'threshold'):
+            image_current_thresholded = np.greater(
+                image_current_gaussian, thresh,
+                out = None if buffers is None else reuse_buffer(buffers, 'mask', image_current_gaussian.shape, bool)
+            )
+            image_current_thresholded = rm_smallparts(image_current_thresholded, cell_diam, params['particle_min'])
+
+        if use_watershed == True:
+            with profile_stage(profile, 'watershed'):
+                image_current_cells, nr_nuclei = watershed(image_current_thresholded, cell_diam, params['particle_min'])
+        else:
+            with profile_stage(profile, 'label'):
+                image_current_cells, nr_nuclei = sp.ndimage.label(image_current_thresholded)
+    roi_size = image_current_gray.size
         
     if save_intensities:
-        cell_info = pd.DataFrame(columns=['{}_file'.format(channel),'cell_id','cell_size','cell_intensity'])
-        for cell_id in np.unique(image_current_cells[image_current_cells>0]):
-            cell_info_new = pd.DataFrame(
-                {
-                    '{}_file'.format(channel) : [filenames_current[file]],
-                    'cell_id' : [cell_id],
-                    'cell_size' : [len(image_current_cells[image_current_cells==cell_id])],
-                    'cell_intensity' : [image_current_gaussian[image_current_cells==cell_id].mean()]
-                },
-            )
-            cell_info = pd.concat([cell_info, cell_info_new], ignore_index = True)
-        cell_info.to_csv(
-            os.path.splitext(
-                os.path.join(
-                    os.path.normpath(output),
-                    filenames_current[file]
+        with profile_stage(profile, 'intensities'):
+            if image_current_gaussian is None:
+                cell_ids, cell_sizes, cell_means = tiled_cell_intensities(
+                    image, image_current_cells, cell_diam, tile_size, precision, median_backend
                 )
-            )[0] + '_CellInfo.csv', 
-            index=False
+            else:
+                cell_ids, cell_sizes, cell_means = cell_intensities(image_current_cells, image_current_gaussian)
+        cell_info = pd.DataFrame(
+            {
+                '{}_file'.format(channel) : [filenames_current[file]]*len(cell_ids),
+                'cell_id' : cell_ids,
+                'cell_size' : cell_sizes,
+                'cell_intensity' : cell_means
+            },
         )
+    if save_intensities and params.get('results_format', 'csv') == 'csv':
+        with profile_stage(profile, 'csv_write'):
+            write(
+                cell_info.to_csv,
+                os.path.splitext(
+                    os.path.join(
+                        os.path.normpath(output),
+                        filenames_current[file]
+                    )
+                )[0] + '_CellInfo.csv', 
+                index=False
+            )
+
+    if profile is not None and image_current_gaussian is None and isinstance(image, dict):
+        profile['read_bytes'] = profile.get('read_bytes', 0) + image['bytes_read']
 
     count_output = {
         'cells' : image_current_cells,
@@ -203,53 +1021,347 @@ def cellcounter(file,channel,params,dirinfo,use_watershed=False,save_intensities
         'roi_size' : roi_size,
         'image' : image_current_gray,
         'gauss' : image_current_gaussian,
-        'thresh' : image_current_thresholded
+        'thresh' : image_current_thresholded,
+        'threshold' : thresh,
+        'cell_info' : cell_info if save_intensities else None
     }
     return count_output
 
 
+def preview_segmentation(image_file, cell_diam, thresh, particle_min, use_watershed=True, scale=1):
+    """
+    Segments an image with the given parameters for an interactive preview. The preprocessed
+    image comes from the cache of load_preprocessed, so changing the threshold or the minimum
+    particle size only reruns the thresholding, labelling and watershed steps. With scale
+    above 1 the image is downsampled by that factor before it is preprocessed (with the
+    diameter scaled to match), so that even a new diameter gives a quick, approximate first
+    result.
+
+    **Parameters**
+        image_file: *str*
+            Path to the image, e.g. the composite.
+        cell_diam: *int*
+            The average cell diameter.
+        thresh: *float*
+            Threshold applied to the preprocessed image.
+        particle_min: *float*
+            Minimum particle size as a fraction of the average cell area.
+        use_watershed: *bool*
+            Whether touching cells are separated by watershed segmentation.
+        scale: *int*
+            Downsampling factor; 1 segments the image at full resolution.
+
+    **Returns**
+        preview: *lib, str/int/np.ndarray*
+            A library containing the (downsampled) preprocessed image 'gauss', the
+            thresholded mask 'thresh', the labelled cells 'cells' and their number 'nr_nuclei'.
+    """
+    gauss = load_preprocessed(image_file, cell_diam, scale=scale)['gauss']
+    cell_diam = cell_diam / scale
+    thresholded = rm_smallparts(gauss > thresh, cell_diam, particle_min)
+    if use_watershed:
+        cells, nr_nuclei = watershed(thresholded, cell_diam, particle_min)
+    else:
+        cells, nr_nuclei = sp.ndimage.label(thresholded)
+    return {'gauss': gauss, 'thresh': thresholded, 'cells': cells, 'nr_nuclei': nr_nuclei}
+
+
+# Filename patterns of the images found by getdirinfo, matched regardless of case. OME-TIFFs
+# (.ome.tif) match '*.tif'.
+IMAGE_PATTERNS = ('*.tif', '*.tiff')
+
+
+def load_listing_cache(cache_file, patterns=IMAGE_PATTERNS):
+    """
+    Reads the directory listings saved by scan_images. A missing or unreadable cache, or one
+    listed with other filename patterns, gives an empty cache.
+
+    **Parameters**
+        cache_file: *str*
+            Path of the cache, e.g. SavedOutput/Ch1_Listing.json.
+        patterns: *list, str*
+            The filename patterns the listings are made with.
+
+    **Returns**
+        cache: *lib*
+            A library holding the listing of each directory, keyed by its path relative to
+            the scanned directory, as [modification time, subdirectories, images].
+    """
+    cache = {'path': cache_file, 'patterns': list(patterns), 'dirs': {}, 'changed': False}
+    try:
+        with open(cache_file) as stream:
+            saved = json.load(stream)
+    except (OSError, ValueError):
+        return cache
+    if saved.get('patterns') == cache['patterns']:
+        cache['dirs'] = saved.get('dirs', {})
+    return cache
+
+
+def save_listing_cache(cache):
+    """Writes a listing cache loaded by load_listing_cache if scan_images changed it."""
+    if not cache['changed']:
+        return
+    with open(cache['path'] + '.tmp', 'w') as stream:
+        json.dump({'patterns': cache['patterns'], 'dirs': cache['dirs']}, stream)
+    os.replace(cache['path'] + '.tmp', cache['path'])
+    cache['changed'] = False
+
+
+def scan_images(directory, patterns=IMAGE_PATTERNS, cache=None):
+    """
+    Walks a directory and its subdirectories (e.g. plate/well/field trees) with os.scandir and
+    yields the images it holds as they are found, so that work can start before the walk
+    completes. Entries are visited in name order, which for a flat directory gives its images
+    sorted by filename. Hidden files and subdirectories (names starting with '.') are skipped.
+
+    Given a cache, a directory whose modification time is unchanged since it was listed is
+    not listed again; only its subdirectories are visited. Adding, removing or renaming an
+    entry updates the modification time of the directory holding it. Directories modified in
+    the last two seconds are not cached, as a change within the same clock tick could go
+    unnoticed. The cache is saved once the walk completes.
+
+    **Parameters**
+        directory: *str*
+            The directory to walk.
+        patterns: *list, str*
+            Filename patterns of the images, matched regardless of case.
+        cache: *lib*
+            Optional listing cache from load_listing_cache.
+
+    **Yields**
+        fname: *str*
+            Path of each image relative to directory.
+    """
+    patterns = [pattern.lower() for pattern in patterns]
+    started = time.time_ns()
+    listed = {}
+
+    def walk(relative):
+        path = os.path.join(directory, relative)
+        mtime = os.stat(path).st_mtime_ns
+        listing = cache['dirs'].get(relative) if cache is not None else None
+        if listing is None or listing[0] != mtime:
+            subdirs, fnames = [], []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                    elif any(fnmatch.fnmatchcase(entry.name.lower(), pattern) for pattern in patterns):
+                        fnames.append(entry.name)
+            listing = [mtime, subdirs, fnames]
+            if cache is not None and started - mtime > 2e9:
+                cache['dirs'][relative] = listing
+                cache['changed'] = True
+        listed[relative] = listing
+        for name, is_dir in sorted([(name, True) for name in listing[1]] + [(name, False) for name in listing[2]]):
+            if is_dir:
+                yield from walk(os.path.join(relative, name))
+            else:
+                yield os.path.join(relative, name)
+
+    yield from walk('')
+    if cache is not None:
+        #Directories that no longer exist are dropped from the cache
+        if any(relative not in listed for relative in cache['dirs']):
+            cache['dirs'] = {relative: listing for relative, listing in cache['dirs'].items() if relative in listed}
+            cache['changed'] = True
+        save_listing_cache(cache)
+
+
+def channel_images(dirinfo, channel):
+    """
+    Yields the images of a channel subdirectory, as paths relative to it, as scan_images finds
+    them. The listing is cached in the output directory (e.g. SavedOutput/Ch1_Listing.json)
+    unless dirinfo['listing_cache'] is False.
+    """
+    patterns = dirinfo.get('patterns', IMAGE_PATTERNS)
+    cache = None
+    if dirinfo.get('listing_cache', True):
+        cache = load_listing_cache(os.path.join(os.path.normpath(dirinfo['output']), channel + "_Listing.json"), patterns)
+    return scan_images(dirinfo[channel.lower()], patterns, cache)
+
 
-def getdirinfo(dirinfo):
+def getdirinfo(dirinfo, patterns=IMAGE_PATTERNS, lazy=False):
     """
     Originally written by Zachary Pennington, edited by Noah Smith. Parses subdirectories
     according to the naming scheme detailed in the readme.txt, allowing composite, mask,
     and data-containing images to be located by the script. Also generates an output
-    subdirectory where the files generated by the script are saved.
+    subdirectory where the files generated by the script are saved. Images in nested
+    subdirectories of a channel (e.g. Ch1/plate1/A01/field1.tif) are found as well, and
+    named by their path relative to the channel subdirectory (see scan_images).
 
     **Parameters**
         dirinfo: *lib, str*
             A library containing the working directory under which all of the image-containing
             subdirectories are stored.
+        patterns: *list, str*
+            Filename patterns of the images, matched regardless of case.
+        lazy: *bool*
+            Leave the channels' filename lists (e.g. 'ch1_fnames') as None instead of listing
+            the channel subdirectories; cellcounting_batch then counts the images as they
+            are found (see discover_fields).
         
     **Returns**
         dirinfo: *lib, str*
             A library containing the working directory and all pertinent subdirectories
-            for the cell-count optimization and image processing.
+            for the cell-count optimization and image processing. 'channels' lists the
+            channel subdirectories (Ch1, Ch2, ...) found in the working directory.
     """
     dirinfo['composite'] = os.path.join(os.path.normpath(dirinfo['main']), "Composite")
     dirinfo['manual'] = os.path.join(os.path.normpath(dirinfo['main']), "ManualCounts")
     dirinfo['output'] = os.path.join(os.path.normpath(dirinfo['main']), "SavedOutput")
     if not os.path.isdir(dirinfo['output']): os.mkdir(dirinfo['output'])
-    dirinfo['composite_fnames'] = sorted(os.listdir(dirinfo['composite']))
-    dirinfo['composite_fnames'] = fnmatch.filter(dirinfo['composite_fnames'], '*.tif')
-    dirinfo['manual_fnames'] = sorted(os.listdir(dirinfo['manual']))
-    dirinfo['manual_fnames'] = fnmatch.filter(dirinfo['manual_fnames'], '*.tif')
+    dirinfo['patterns'] = list(patterns)
+    dirinfo['composite_fnames'] = list(scan_images(dirinfo['composite'], patterns))
+    dirinfo['manual_fnames'] = list(scan_images(dirinfo['manual'], patterns))
 
     #Define subdirectories
     dirinfo['ch1'] = os.path.join(os.path.normpath(dirinfo['main']), "Ch1")
     dirinfo['output'] = os.path.join(os.path.normpath(dirinfo['main']), "SavedOutput")
 
-    #Get filenames and create output subdirectories based upon usage
+    #Get filenames and create output subdirectories based upon usage; every Ch<number>
+    #subdirectory is a channel, with keys named after it in lower case (e.g. 'ch2_fnames')
     if not os.path.exists(dirinfo['output']): os.mkdir(dirinfo['output'])
-    if os.path.isdir(dirinfo['ch1']):
-        dirinfo['ch1_fnames'] = sorted(os.listdir(dirinfo['ch1']))
-        dirinfo['ch1_fnames'] = fnmatch.filter(dirinfo['ch1_fnames'], '*.tif')
-        dirinfo['output_ch1'] = os.path.join(os.path.normpath(dirinfo['output']), "Ch1")
-        if not os.path.isdir(dirinfo['output_ch1']): os.mkdir(dirinfo['output_ch1'])
+    dirinfo['channels'] = sorted(
+        (subdir for subdir in os.listdir(os.path.normpath(dirinfo['main']))
+         if re.fullmatch(r'Ch\d+', subdir) and os.path.isdir(os.path.join(os.path.normpath(dirinfo['main']), subdir))),
+        key=lambda channel: int(channel[2:])
+    )
+    for channel in dirinfo['channels']:
+        key = channel.lower()
+        dirinfo[key] = os.path.join(os.path.normpath(dirinfo['main']), channel)
+        dirinfo[key + '_fnames'] = None if lazy else list(channel_images(dirinfo, channel))
+        dirinfo['output_' + key] = os.path.join(os.path.normpath(dirinfo['output']), channel)
+        if not os.path.isdir(dirinfo['output_' + key]): os.mkdir(dirinfo['output_' + key])
 
     return dirinfo
 
-def image_preprocessing(dirinfo,params):
+
+def field_name(fname, channel):
+    """
+    Returns the name of the field an image belongs to: its filename without extension and
+    channel tag. Only a tag standing as a word of the filename is removed ('slide1_Ch1' and
+    'Ch1-slide1' give 'slide1', 'batch1' and 'stitch1' are kept), and only its last occurrence.
+    """
+    directory, stem = os.path.split(os.path.splitext(fname)[0])
+    tags = list(re.finditer(r'(?:^|[_\-. ]){}(?![0-9A-Za-z])'.format(re.escape(channel)), stem, flags=re.IGNORECASE))
+    if tags:
+        start, end = tags[-1].span()
+        #A leading tag takes the separator after it along
+        if start == 0 and stem[0] not in '_-. ' and stem[end:end+1] in ('_', '-', '.', ' '):
+            end += 1
+        stem = stem[:start] + stem[end:] or stem
+    return os.path.join(directory, stem)
+
+
+def field_files(dirinfo, channels):
+    """
+    Groups the images of several channels by field, i.e. the images of one view taken in each
+    channel. Images are matched by filename once the channel tag is removed, so that
+    Ch1/slide1_Ch1.tif and Ch2/slide1_Ch2.tif (or Ch1/slide1.tif and Ch2/slide1.tif) form
+    the field 'slide1'.
+
+    **Parameters**
+        dirinfo: *lib, str*
+            A library of the working directory's subdirectories, as returned by getdirinfo.
+        channels: *list, str*
+            The channels to group, e.g. dirinfo['channels'].
+
+    **Returns**
+        fields: *list, tuple*
+            (field name, files) pairs in field name order, where files maps each channel
+            to the index of the field's image in that channel's filename list, or None if
+            the channel has no image of the field. With a single channel, every image is
+            its own field and keeps its filename as the field name.
+    """
+    if len(channels) == 1:
+        return [(fname, {channels[0]: file}) for file, fname in enumerate(dirinfo[channels[0].lower() + '_fnames'])]
+    fields = {}
+    named = {}
+    for channel in channels:
+        for file, fname in enumerate(dirinfo[channel.lower() + '_fnames']):
+            #Images with the same filename in several channels always form one field
+            field = named.setdefault(fname, field_name(fname, channel))
+            fields.setdefault(field, dict.fromkeys(channels))[channel] = file
+    return sorted(fields.items())
+
+
+def discover_fields(dirinfo, channels):
+    """
+    Yields the fields of one or more channels in the order of field_files, as (field name,
+    filenames) pairs where filenames maps each channel to the field's image path relative to
+    the channel subdirectory, or None. Channels that getdirinfo left unlisted (lazy=True) are
+    listed with channel_images; a single such channel is not listed up front, its images
+    are yielded as they are found.
+
+    **Parameters**
+        dirinfo: *lib, str*
+            A library of the working directory's subdirectories, as returned by getdirinfo.
+        channels: *list, str*
+            The channels to group, e.g. dirinfo['channels'].
+
+    **Yields**
+        field: *tuple*
+            The field name and the filename of its image in each channel.
+    """
+    listed = {channel: dirinfo[channel.lower() + '_fnames'] for channel in channels}
+    if len(channels) == 1:
+        fnames = listed[channels[0]]
+        for fname in channel_images(dirinfo, channels[0]) if fnames is None else fnames:
+            yield fname, {channels[0]: fname}
+        return
+
+    #Images of other channels may belong to any field, so every channel is listed first
+    for channel, fnames in listed.items():
+        if fnames is None:
+            listed[channel] = list(channel_images(dirinfo, channel))
+    fields = field_files(dict(dirinfo, **{channel.lower() + '_fnames': fnames for channel, fnames in listed.items()}), channels)
+    for field, files in fields:
+        yield field, {channel: None if file is None else listed[channel][file] for channel, file in files.items()}
+
+
+def composite_pairs(dirinfo):
+    """
+    Pairs each composite image with its manual count mask. A mask is matched to the composite
+    of the same name, optionally followed by a mask tag (composite.tif and composite_Mask.tif);
+    composites and masks left over are then paired in filename order, so a single composite
+    is always paired with a single mask.
+
+    **Parameters**
+        dirinfo: *lib, str*
+            A library of the working directory's subdirectories, as returned by getdirinfo.
+
+    **Returns**
+        pairs: *list, tuple*
+            (composite index, mask index) pairs into dirinfo['composite_fnames'] and
+            dirinfo['manual_fnames'], in composite filename order.
+
+    **Raises**
+        ValueError: if no composite image has a manual count mask.
+    """
+    stem = lambda fname: os.path.splitext(fname)[0].lower()
+    masks = {re.sub(r'[_\-. ]?mask$', '', stem(fname)): index for index, fname in enumerate(dirinfo['manual_fnames'])}
+    pairs = {}
+    for index, fname in enumerate(dirinfo['composite_fnames']):
+        if stem(fname) in masks:
+            pairs[index] = masks.pop(stem(fname))
+
+    #Composites and masks without a name match are paired in filename order
+    unpaired = [index for index in range(len(dirinfo['composite_fnames'])) if index not in pairs]
+    pairs.update(zip(unpaired, sorted(masks.values())))
+    for index in unpaired[len(masks):]:
+        print("No manual count mask for composite " + dirinfo['composite_fnames'][index])
+    if not pairs:
+        raise ValueError("No manual count mask in {} for the composite images: {}".format(
+            dirinfo['manual'], ", ".join(dirinfo['composite_fnames']) or "(none found)"
+        ))
+    return sorted(pairs.items())
+
+
+def image_preprocessing(dirinfo,params,pair=(0, 0)):
     """
     Originally written by Zachary Pennington, edited by Noah Smith. Calculates auto-counted
     cells at varying threshold value to determine the appropriate threshold for a particular
@@ -263,13 +1375,17 @@ def image_preprocessing(dirinfo,params):
             A library containing various parameters that are important for cell counting,
             including optimal diameter and threshold for picking and whether or not counting
             should include watershed segmentation.
+        pair: *tuple, int*
+            The composite image and manual count mask to use, as indices into
+            dirinfo['composite_fnames'] and dirinfo['manual_fnames'] (see composite_pairs).
 
 
     **Returns**
         images: *dict, array*
             Dictionary containing numpy arrays of all of the image data of the composite
             image after each step of pre-processing, including median filter noise removal, 
-            background subtraction, and gaussian blur.
+            background subtraction, and gaussian blur, and a KD-tree of the manually marked
+            cells under 'manual_objects' (see manual_objects).
         params: *lib, str/int*
             A library containing various parameters that are important for cell counting,
             including optimal diameter and threshold for picking and whether or not counting
@@ -277,20 +1393,25 @@ def image_preprocessing(dirinfo,params):
             given composite image.
     """
 
+    preprocessed = load_preprocessed(
+        os.path.join(os.path.normpath(dirinfo['composite']), dirinfo['composite_fnames'][pair[0]]),
+        params['diam'],
+        precision = params.get('precision', 'float32'),
+        median_backend = params.get('median_backend', 'auto'),
+        cache_dir = params.get('image_cache')
+    )
     images = {
-        'manual' : cv2.imread(
-            os.path.join(os.path.normpath(dirinfo['manual']), dirinfo['manual_fnames'][0]),
-            cv2.IMREAD_ANYDEPTH
-        ),
-        'composite' : cv2.imread(
-            os.path.join(os.path.normpath(dirinfo['composite']), dirinfo['composite_fnames'][0]),
-            cv2.IMREAD_ANYDEPTH
-        )
+        'manual' : read_region(open_image(
+            os.path.join(os.path.normpath(dirinfo['manual']), dirinfo['manual_fnames'][pair[1]]),
+            params.get('image_cache')
+        )),
+        'composite' : preprocessed['image'],
+        'median' : preprocessed['median'],
+        'bg' : preprocessed['bg'],
+        'gauss' : preprocessed['gauss']
     }
-    images['median'] = median_filter(images['composite'], kernel_size = params['diam']//2)
-    images['bg'] = subtract_bg(images['median'], kernel_size = params['diam']*3)
-    images['gauss'] = cv2.GaussianBlur(images['bg'],(0,0),params['diam']/6)
     params['counts'] = (images['manual']>0).sum()
+    images['manual_objects'] = manual_objects(images['manual'])
     params['otsu'] = filters.threshold_otsu(image=images['gauss'].astype('int64'))
     params['thresh'] = params['otsu']
     
@@ -299,17 +1420,175 @@ def image_preprocessing(dirinfo,params):
     return images, params
 
 
-def threshold_optimizer(images, dirinfo, params, interv=1):
+def object_centroids(labels):
+    """Returns the (row, col) centroids of the labelled objects of an image, in label order; unused labels are skipped."""
+    pixels = np.flatnonzero(labels)
+    ids = labels.ravel()[pixels]
+    rows, cols = np.divmod(pixels, labels.shape[1])
+    sizes = np.bincount(ids)
+    present = np.flatnonzero(sizes[1:]) + 1
+    return np.column_stack((np.bincount(ids, rows)[present], np.bincount(ids, cols)[present])) / sizes[present, None]
+
+
+def manual_objects(manual):
+    """
+    Labels a manual count mask, in which each counted cell is marked by a dot or a filled
+    shape, and returns a KD-tree of the centroids of the marks for match_centroids.
+    """
+    labels, _ = sp.ndimage.label(manual > 0, structure=np.ones((3,3)))
+    return cKDTree(object_centroids(labels).reshape(-1, 2))
+
+
+def match_centroids(manual, centroids, max_distance):
+    """
+    Matches detected cells to the manually marked cells of a KD-tree built by manual_objects.
+    Returns, for each centroid, the index of the nearest marked cell no further than
+    max_distance away, or -1 if there is none.
+    """
+    centroids = np.asarray(centroids, dtype=float).reshape(-1, 2)
+    if manual.n == 0 or len(centroids) == 0:
+        return np.full(len(centroids), -1)
+    distance, index = manual.query(centroids, distance_upper_bound=max_distance)
+    return np.where(np.isfinite(distance), index, -1)
+
+
+def object_accuracy(nr_found, nr_detected, nr_manual):
+    """
+    Precision, recall and F1 score of a count in which nr_found of the nr_manual marked cells
+    were matched by one of nr_detected detected cells; nan where undefined. Accepts arrays.
+    """
+    nr_found = np.asarray(nr_found, dtype=float)
+    nr_detected = np.asarray(nr_detected, dtype=float)
+    nr_manual = np.asarray(nr_manual, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(nr_detected > 0, nr_found / nr_detected, np.nan)
+        recall = np.where(nr_manual > 0, nr_found / nr_manual, np.nan)
+        f1 = np.where(nr_detected + nr_manual > 0, 2*nr_found / (nr_detected + nr_manual), np.nan)
+    return precision, recall, f1
+
+
+def threshold_sweep(image, thresholds, optimal_diam, particle_min, manual=None, max_distance=None):
+    """
+    Counts the objects left by rm_smallparts(image > thresh, ...) for every threshold in a
+    single pass. The image is quantized to the threshold grid and a max-tree of its upper
+    level sets is built; every node of the tree is a connected component that exists for a
+    contiguous range of thresholds, so counts and areas follow from the node areas alone.
+    Given manually marked cells, the centroid of every node is accumulated along with its
+    area and matched once, which gives the matched cells at every threshold as well.
+
+    **Parameters**
+        image: *np.ndarray*
+            An array containing intensity information after noise filtering and blur.
+        thresholds: *list, int/float*
+            Ascending threshold values to evaluate.
+        optimal_diam: *int*
+            The average cell diameter used to size the particle filter.
+        particle_min:
+            User-specified minimum particle size fraction of the ideal average cell area;
+            below which cells are cut off.
+        manual: *cKDTree*
+            Optional KD-tree of the manually marked cells, as built by manual_objects.
+        max_distance: *float*
+            Largest distance between the centroid of an object and a marked cell that
+            still counts as a match; see match_centroids.
+
+    **Returns**
+        counts: *np.ndarray*
+            Number of objects remaining at each threshold.
+        avg_areas: *np.ndarray*
+            Average object area in pixels at each threshold; nan where no objects remain.
+        found: *np.ndarray*
+            Number of marked cells matched by an object at each threshold, each counted
+            once however many objects lie near it; None without manual.
+    """
+    thresholds = np.asarray(thresholds)
+    nr_thresh = len(thresholds)
+
+    #A pixel is above thresholds[k] exactly when its level is greater than k
+    levels = np.searchsorted(thresholds, image, side='left').astype(np.int32)
+    parent, _ = max_tree(levels, connectivity=1)
+    parent = parent.ravel()
+    levels = levels.ravel()
+
+    #Canonical pixels represent a tree node; all other pixels point at the canonical pixel
+    #of their node
+    pixel_ids = np.arange(levels.size)
+    is_root = parent == pixel_ids
+    canonical = is_root | (levels[parent] != levels)
+    members = np.flatnonzero(~canonical)
+    member_parents = parent[members]
+    area = np.bincount(member_parents, minlength=levels.size) + 1
+    if manual is not None:
+        #Row and column sums of the pixels of each node, accumulated like the areas
+        member_rows, member_cols = np.divmod(members, image.shape[1])
+        row_sums = np.bincount(member_parents, weights=member_rows, minlength=levels.size)
+        col_sums = np.bincount(member_parents, weights=member_cols, minlength=levels.size)
+        canonical_ids = np.flatnonzero(canonical)
+        row_sums[canonical_ids] += canonical_ids // image.shape[1]
+        col_sums[canonical_ids] += canonical_ids % image.shape[1]
+
+    #Accumulate node areas from the highest level down to the root
+    nodes = np.flatnonzero(canonical & ~is_root)
+    nodes = nodes[np.argsort(-levels[nodes], kind='stable')]
+    bounds = np.flatnonzero(np.diff(levels[nodes])) + 1
+    for level_nodes in np.split(nodes, bounds):
+        np.add.at(area, parent[level_nodes], area[level_nodes])
+        if manual is not None:
+            np.add.at(row_sums, parent[level_nodes], row_sums[level_nodes])
+            np.add.at(col_sums, parent[level_nodes], col_sums[level_nodes])
+
+    #Each node is a component of image > thresholds[k] for parent level <= k < node level
+    nodes = np.flatnonzero(canonical)
+    nodes = nodes[area[nodes] >= optimal_diam*optimal_diam*particle_min]
+    start = np.where(is_root[nodes], 0, levels[parent[nodes]])
+    stop = levels[nodes]
+    counts = np.cumsum(
+        np.bincount(start, minlength=nr_thresh+1) - np.bincount(stop, minlength=nr_thresh+1)
+    )[:nr_thresh]
+    total_areas = np.cumsum(
+        np.bincount(start, weights=area[nodes], minlength=nr_thresh+1)
+        - np.bincount(stop, weights=area[nodes], minlength=nr_thresh+1)
+    )[:nr_thresh]
+    avg_areas = np.full(nr_thresh, np.nan)
+    np.divide(total_areas, counts, out=avg_areas, where=counts > 0)
+    if manual is None:
+        return counts, avg_areas, None
+
+    #A marked cell is found over the union of the threshold ranges of the nodes matching it;
+    #at equal thresholds ranges open before they close, so touching ranges are joined
+    centroids = np.column_stack((row_sums[nodes], col_sums[nodes])) / area[nodes, None]
+    matched = match_centroids(manual, centroids, max_distance)
+    hit = matched >= 0
+    owners = np.concatenate((matched[hit], matched[hit]))
+    ends = np.concatenate((start[hit], stop[hit]))
+    steps = np.concatenate((np.ones(hit.sum(), int), -np.ones(hit.sum(), int)))
+    order = np.lexsort((-steps, ends, owners))
+    ends, steps = ends[order], steps[order]
+    cover = np.cumsum(steps)
+    opens = ends[(steps == 1) & (cover == 1)]
+    closes = ends[(steps == -1) & (cover == 0)]
+    found = np.cumsum(
+        np.bincount(opens, minlength=nr_thresh+1) - np.bincount(closes, minlength=nr_thresh+1)
+    )[:nr_thresh]
+    return counts, avg_areas, found
+
+
+def threshold_optimizer(images, dirinfo, params, interv=1, file=0):
     """
     Originally written by Zachary Pennington, edited by Noah Smith. Calculates auto-counted
     cells at varying threshold value to determine the appropriate threshold for a particular
-    set of cell tissue images.
+    set of cell tissue images. Counts for every threshold are taken from threshold_sweep;
+    when watershed segmentation is used, the full counter only runs at thresholds where
+    objects remain. Besides the ratio of the automatic to the manual count, each threshold
+    is scored object by object: detected cells are matched to the manually marked cells
+    within params['match_distance'] cell diameters (default 1) of their centroid, giving
+    the precision, recall and F1 score of the count.
 
     **Parameters**
         images: *dict, array*
             Dictionary containing numpy arrays of all of the image data of the composite
             image after each step of pre-processing, including median filter noise removal, 
-            background subtraction, and gaussian blur.
+            background subtraction, and gaussian blur, as returned by image_preprocessing.
         dirinfo: *lib, str*
             A library containing the working directory and all pertinent subdirectories
             for the cell-count optimization and image processing.
@@ -320,6 +1599,8 @@ def threshold_optimizer(images, dirinfo, params, interv=1):
         interv: *int*
             An interval value that defines the step between threshold values tested by the
             optimizer.
+        file: *int*
+            The index of the composite image in dirinfo['composite_fnames'].
 
     **Returns**
         optimization_data: *df*
@@ -327,18 +1608,41 @@ def threshold_optimizer(images, dirinfo, params, interv=1):
             optimization process. 
     """
     channel = 'Optim'
-    file = 0 #Should always be zero because only one composite image
 
     #Initialize Arrays to Store Data In
     list_auto_counts = []
     list_cell_areas = []
     list_acc_auto_over_manual_counts = []
+    list_found = []
+
+    #Sweep all thresholds at once on the composite preprocessed at the current diameter
+    gauss = load_preprocessed(
+        os.path.join(os.path.normpath(dirinfo['composite']), dirinfo['composite_fnames'][file]),
+        params['diam'],
+        precision = params.get('precision', 'float32'),
+        median_backend = params.get('median_backend', 'auto')
+    )['gauss']
 
     #Define maximum threshold value and create series of thresholds to cycle through
     thresh_min = 0 #params['otsu']
-    thresh_max = int(images['gauss'].max()//1) #Get maximum value in array.  Threshold can't go beyond this
+    thresh_max = int(gauss.max()//1) #Get maximum value in array.  Threshold can't go beyond this
     list_thresh_values = list(np.arange(thresh_min,thresh_max,interv))
-    for thresh in list_thresh_values:
+
+    manual = images['manual_objects']
+    max_distance = params.get('match_distance', 1.0)*params['diam']
+    sweep_counts, sweep_areas, sweep_found = threshold_sweep(
+        gauss, list_thresh_values, params['diam'], params['particle_min'], manual, max_distance
+    )
+
+    for i, thresh in enumerate(list_thresh_values):
+
+        if not params['UseWatershed'] or sweep_counts[i] == 0:
+            list_auto_counts.append(sweep_counts[i])
+            list_cell_areas.append(sweep_areas[i])
+            list_found.append(sweep_found[i])
+            accuracy_over_manual_counts = sweep_counts[i]/params['counts'] if sweep_counts[i] > 0 else np.nan
+            list_acc_auto_over_manual_counts.append(accuracy_over_manual_counts)
+            continue
 
         params['thresh']=thresh
         #with suppress_stdout():
@@ -353,10 +1657,16 @@ def threshold_optimizer(images, dirinfo, params, interv=1):
             cell_area = float('nan')
         list_cell_areas.append(cell_area)
 
+        #Match the watershed cells to the marked cells
+        matched = match_centroids(manual, object_centroids(count_out['cells']), max_distance)
+        list_found.append(len(np.unique(matched[matched >= 0])))
+
         #Calculate Accuracies
         accuracy_over_manual_counts = count_out['nr_nuclei']/params['counts'] if count_out['nr_nuclei'] > 0 else np.nan
         list_acc_auto_over_manual_counts.append(accuracy_over_manual_counts)
     
+    precision, recall, f1 = object_accuracy(list_found, list_auto_counts, manual.n)
+
     #Create Dataframe
     optimization_data = pd.DataFrame(
         {
@@ -368,19 +1678,93 @@ def threshold_optimizer(images, dirinfo, params, interv=1):
             'AutoCount_Counts': list_auto_counts,
             'AutoCount_AvgCellArea': list_cell_areas,
             'Acc_Manual_over_AutoCounts': list_acc_auto_over_manual_counts,
-
+            'Manual_Objects': np.ones(len(list_thresh_values))*manual.n,
+            'AutoCount_Matched': list_found,
+            'AutoCount_Precision': precision,
+            'AutoCount_Recall': recall,
+            'AutoCount_F1': f1
         }
     )
     return optimization_data
 
 
-def watershed(image_current_thresholded, optimal_diameter, particle_min):
+def watershed_seeds(distance, seed_labels, nr_labels, min_distance, split_labels=()):
+    """
+    Places one seed per labelled object at the position peak_local_max (with
+    num_peaks_per_label=1 and labels=seed_labels) would choose: the first pixel in raster
+    order that holds the object's largest distance value, if that value exceeds the
+    minimum of the distance image. All objects are handled in one pass over the labelled
+    pixels. peak_local_max seeds objects whose pixels all share one value at their first
+    isolated pixel instead (one not kept by a binary opening), which differs only for
+    objects of five or more pixels; these, and objects that may have been split into
+    pieces, are passed to peak_local_max itself.
+
+    **Parameters**
+        distance: *np.ndarray*
+            Distance transform of the thresholded image.
+        seed_labels: *np.ndarray*
+            8-connected labels of the region that may hold seeds; excluded pixels are 0.
+        nr_labels: *int*
+            Number of labels in seed_labels.
+        min_distance: *int*
+            Minimum distance between peaks, as in peak_local_max.
+        split_labels: *array, int*
+            Labels whose objects lost pixels to the exclusion of edge pixels.
+
+    **Returns**
+        seeds: *np.ndarray*
+            Flat indices of the seeds in raster order.
+    """
+    pixels = np.flatnonzero(seed_labels)
+    labels = seed_labels.ravel()[pixels]
+    values = distance.ravel()[pixels]
+    maxima = np.zeros(nr_labels + 1)
+    np.maximum.at(maxima, labels, values)
+    at_max = values == maxima[labels]
+    labels_at_max, first = np.unique(labels[at_max], return_index=True)
+    threshold = distance.min()
+    seeds = pixels[at_max][first][maxima[labels_at_max] > threshold]
+    labels_at_max = labels_at_max[maxima[labels_at_max] > threshold]
+
+    #Large objects of a single value, and split objects, need peak_local_max's own handling
+    sizes = np.bincount(labels, minlength=nr_labels + 1)
+    irregular = (np.bincount(labels[at_max], minlength=nr_labels + 1) == sizes) & (sizes >= 5)
+    irregular[np.asarray(split_labels, dtype=int)] = True
+    irregular &= sizes > 0
+    irregular[0] = False
+    if irregular.any():
+        seeds = [seeds[~irregular[labels_at_max]]]
+        objects = sp.ndimage.find_objects(seed_labels, nr_labels)
+        for label in np.flatnonzero(irregular):
+            roi = objects[label-1]
+            coords = peak_local_max(
+                distance[roi],
+                min_distance = min_distance,
+                threshold_abs = threshold,
+                labels = (seed_labels[roi] == label).astype(int),
+                num_peaks_per_label = 1,
+                exclude_border = False
+            )
+            coords += [s.start for s in roi]
+            seeds.append(np.ravel_multi_index(tuple(coords.T), distance.shape))
+        seeds = np.concatenate(seeds)
+    return np.sort(seeds)
+
+
+def watershed(image_current_thresholded, optimal_diameter, particle_min, origin=None, image_shape=None):
     """
     Originally written by Zachary Pennington, edited by Noah Smith. A watershed
     segmentation algorithm that improves the accuracy of the counting algorithm by 
     handling and separating shapes that are touching. Makes use of scikitimage and 
     scipy to locate local maxima.
 
+    Each cell shape is eroded to the pixels further than optimal_diameter*particle_min
+    from its edge, and each eroded part is seeded at its distance maximum (see
+    watershed_seeds); seeds closer than optimal_diameter to the image edges are
+    discarded. When no shape holds more than one seed, each shape takes the label of its
+    seed and the watershed itself is skipped. The watershed is otherwise run on the whole
+    image, as its tie-breaking between equal seeds depends on every seed it is given.
+
     **Parameters**
         image_current_thresholded: *np.ndarray*
             Cell tissue image after pre-processing that contains touching cells in need 
@@ -391,6 +1775,11 @@ def watershed(image_current_thresholded, optimal_diameter, particle_min):
         particle_min:
             User-specified minimum particle size fraction of the ideal average cell area;
             below which cells are cut off.
+        origin: *tuple, int*
+            Position of the array within a larger image, when only a region is segmented.
+        image_shape: *tuple, int*
+            Shape of the larger image; seeds are then excluded near its edges instead of
+            near the edges of the region, as they would be when segmenting the whole image.
 
     **Returns**
         labels: *np.ndarray*
@@ -404,29 +1793,448 @@ def watershed(image_current_thresholded, optimal_diameter, particle_min):
     if image_current_thresholded.max() == True:
 
         image_current_thresh_dist = sp.ndimage.distance_transform_edt(image_current_thresholded)
-        image_current_thresh_dist_erd = image_current_thresh_dist > optimal_diameter*particle_min
-        image_current_thresh_dist_lbls = measure.label(image_current_thresh_dist_erd)
-        
-        coords = peak_local_max(
-            image_current_thresh_dist, 
-            min_distance = int(optimal_diameter),
-            labels = image_current_thresh_dist_lbls,
-            num_peaks_per_label = 1
+        image_current_thresh_dist_lbls, nr_lbls = sp.ndimage.label(
+            image_current_thresh_dist > optimal_diameter*particle_min, structure = np.ones((3,3))
         )
-        image_current_seeds = np.zeros(image_current_thresholded.shape, dtype=bool)
-        image_current_seeds[tuple(coords.T)] = True
-        image_current_seeds, nseeds = sp.ndimage.label(image_current_seeds)
-        labels = skwatershed(-image_current_thresh_dist, image_current_seeds, mask=image_current_thresholded)
+
+        #Exclude seeds near the edges of the (larger) image
+        border = int(optimal_diameter)
+        if image_shape is None:
+            origin, image_shape = (0, 0), image_current_thresholded.shape
+        near_rows, near_cols = [
+            (np.arange(start, start+size) < border) | (np.arange(start, start+size) >= full_size-border)
+            for start, size, full_size in zip(origin, image_current_thresholded.shape, image_shape)
+        ]
+        split_lbls = np.union1d(image_current_thresh_dist_lbls[near_rows].ravel(),
+                                image_current_thresh_dist_lbls[:, near_cols].ravel())
+        image_current_thresh_dist_lbls[near_rows] = 0
+        image_current_thresh_dist_lbls[:, near_cols] = 0
+
+        seeds = watershed_seeds(image_current_thresh_dist, image_current_thresh_dist_lbls, nr_lbls,
+                                int(optimal_diameter), split_lbls)
+        nseeds = len(seeds)
+
+        #Without a shape holding several seeds, each shape simply takes the label of its seed
+        shapes, nr_shapes = sp.ndimage.label(image_current_thresholded)
+        seed_shapes = shapes.ravel()[seeds]
+        if np.bincount(seed_shapes, minlength=nr_shapes + 1).max() > 1:
+            image_current_seeds = np.zeros(image_current_thresholded.shape, dtype=np.int32)
+            image_current_seeds.ravel()[seeds] = np.arange(1, nseeds + 1)
+            labels = skwatershed(-image_current_thresh_dist, image_current_seeds, mask=image_current_thresholded)
+        else:
+            shape_labels = np.zeros(nr_shapes + 1, dtype=np.int32)
+            shape_labels[seed_shapes] = np.arange(1, nseeds + 1)
+            labels = shape_labels[shapes]
     
     elif image_current_thresholded.max() == False:
         labels = image_current_thresholded.astype(int)
         nseeds = 0
     return labels, nseeds
 
-def cellcounting_param_optimizer(dirinfo, params):
+
+def diameter_search(dirinfo, params, diam_min=2, file=0):
+    """
+    Finds the largest average diameter, at or below params['diam'], at which the automatic
+    count of the composite reaches the manual count. Rather than stepping down one diameter
+    at a time, the search steps down in doubling strides until the count is reached and then
+    bisects the bracket, so it agrees with the one-at-a-time walk whenever the counts fall
+    with increasing diameter. The search never goes below diam_min.
+
+    **Parameters**
+        dirinfo: *lib, str*
+            A library containing the working directory and all pertinent subdirectories
+            for the cell-count optimization and image processing.
+        params: *lib, str/int*
+            A library containing various parameters that are important for cell counting;
+            'diam' is the starting diameter and 'thresh' and 'counts' must be set.
+        diam_min: *int*
+            Smallest diameter to try; below 2 the median filter kernel vanishes.
+        file: *int*
+            The index of the composite image in dirinfo['composite_fnames'].
+
+    **Returns**
+        optimal_diameter: *int*
+            The largest diameter that reaches the manual count, or diam_min if none does.
+        nr_evaluations: *int*
+            Number of times the counting pipeline was run.
+    """
+    counts = {}
+    def reaches_counts(diam):
+        if diam not in counts:
+            counts[diam] = cellcounter(
+                file,
+                "Optim",
+                dict(params, diam=diam),
+                dirinfo,
+                use_watershed=params['UseWatershed']
+            )['nr_nuclei']
+        return counts[diam] >= params['counts']
+
+    #Bracket: step down in doubling strides until the manual counts are reached
+    diam_max = params['diam']
+    if reaches_counts(diam_max) or diam_max <= diam_min:
+        return diam_max, len(counts)
+    step = 1
+    while True:
+        diam = max(diam_max - step, diam_min)
+        if reaches_counts(diam):
+            break
+        diam_max = diam
+        if diam == diam_min:
+            print("Manual counts not reached above the minimum diameter of " + str(diam_min))
+            return diam_min, len(counts)
+        step *= 2
+
+    #Bisect: diam reaches the manual counts and diam_max does not
+    while diam_max - diam > 1:
+        diam_mid = (diam + diam_max)//2
+        if reaches_counts(diam_mid):
+            diam = diam_mid
+        else:
+            diam_max = diam_mid
+    return diam, len(counts)
+
+
+def diameter_surface(dirinfo, params, diam, interv=10, pair=(0, 0)):
+    """
+    Runs the threshold sweep of the composite at a single diameter. The composite is
+    preprocessed once and shared by every threshold. Runs in the worker processes of
+    joint_param_optimizer.
+
+    **Parameters**
+        dirinfo: *lib, str*
+            A library containing the working directory and all pertinent subdirectories
+            for the cell-count optimization and image processing.
+        params: *lib, str/int*
+            A library containing various parameters that are important for cell counting.
+        diam: *int*
+            The average cell diameter to evaluate.
+        interv: *int*
+            Step between the threshold values tested.
+        pair: *tuple, int*
+            The composite image and manual count mask to use; see composite_pairs.
+
+    **Returns**
+        optimization_data: *df*
+            The threshold_optimizer dataframe for this diameter.
+    """
+    images, params = image_preprocessing(dirinfo, dict(params, diam=diam), pair)
+    return threshold_optimizer(images, dirinfo, params, interv=interv, file=pair[0])
+
+
+def sequential_threshold(data):
+    """
+    Returns the index of the threshold chosen by the sequential optimizer from threshold_optimizer
+    data: the lowest threshold above which the automatic counts stay below the manual counts.
+    Thresholds without any cells (nan accuracy) count as below the manual counts. If no
+    threshold reaches the manual counts, the lowest threshold, which counts the most cells, is
+    chosen; if even the highest threshold reaches them, the highest is chosen.
+    """
+    reached = np.flatnonzero(data['Acc_Manual_over_AutoCounts'].to_numpy() >= 1)
+    if len(reached) == 0:
+        return 0
+    return min(reached[-1]+1, len(data)-1)
+
+
+def pair_optimizer(dirinfo, params, pair, interv):
+    """
+    Runs the sequential optimization (see cellcounting_param_optimizer) on one composite image
+    and manual count mask. Runs in the worker processes of pooled_param_optimizer.
+
+    **Parameters**
+        dirinfo: *lib, str*
+            A library containing the working directory and all pertinent subdirectories
+            for the cell-count optimization and image processing.
+        params: *lib, str/int*
+            A library containing various parameters that are important for cell counting.
+        pair: *tuple, int*
+            The composite image and manual count mask to use; see composite_pairs.
+        interv: *int*
+            Step between the threshold values tested.
+
+    **Returns**
+        optimization_data: *df*
+            The threshold_optimizer dataframe at the diameter found for this composite.
+        optimal_diameter: *int*
+            The diameter found by diameter_search.
+        nr_evaluations: *int*
+            Number of times diameter_search ran the counting pipeline.
+    """
+    images, params = image_preprocessing(dirinfo, dict(params), pair)
+    optimal_diameter, nr_evaluations = diameter_search(dirinfo, params, diam_min=params.get('diam_min', 2), file=pair[0])
+    params['diam'] = optimal_diameter
+    data = threshold_optimizer(images, dirinfo, params, interv=interv, file=pair[0])
+    return data, optimal_diameter, nr_evaluations
+
+
+def pool_optimization_data(curves):
+    """
+    Pools the threshold_optimizer data of several composite images into the data of one
+    composite holding all their cells. At every diameter and threshold the automatic, manual
+    and matched counts of the composites are summed, and the accuracy, precision, recall, F1
+    score and average cell area are recomputed from the sums. A composite without a given
+    threshold (above its brightest pixel) contributes no automatic cells there.
+
+    **Parameters**
+        curves: *list, df*
+            The optimization data of each composite, with a 'Composite' column naming it.
+
+    **Returns**
+        pooled: *df*
+            Data in the same columns, with 'Composite' set to 'Pooled', in order of diameter
+            and threshold. Otsu's threshold, which differs between composites, is nan.
+    """
+    data = pd.concat(curves, ignore_index=True)
+    data['Cell_Area'] = (data['AutoCount_AvgCellArea']*data['AutoCount_Counts']).fillna(0)
+    pooled = data.groupby(['Manual_CellDiam', 'AutoCount_Thresh'], as_index=False)[
+        ['AutoCount_Counts', 'AutoCount_Matched', 'Cell_Area']
+    ].sum()
+
+    #Every composite's marked cells count at every threshold of the diameters it was swept at
+    manual = data.groupby(['Manual_CellDiam', 'Composite'])[['Manual_Counts', 'Manual_Objects']].first()
+    manual = manual.groupby(level='Manual_CellDiam').sum()
+    pooled = pooled.join(manual, on='Manual_CellDiam')
+
+    counts = pooled['AutoCount_Counts'].to_numpy(dtype=float)
+    precision, recall, f1 = object_accuracy(pooled['AutoCount_Matched'], counts, pooled['Manual_Objects'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        avg_areas = np.where(counts > 0, pooled['Cell_Area'] / counts, np.nan)
+        accuracies = np.where(counts > 0, counts / pooled['Manual_Counts'], np.nan)
+    return pd.DataFrame(
+        {
+            'Composite': 'Pooled',
+            'AutoCount_Thresh': pooled['AutoCount_Thresh'],
+            'OTSU_Thresh': np.nan,
+            'Manual_CellDiam': pooled['Manual_CellDiam'],
+            'Manual_Counts': pooled['Manual_Counts'],
+            'AutoCount_UseWatershed': data['AutoCount_UseWatershed'].iloc[0],
+            'AutoCount_Counts': pooled['AutoCount_Counts'],
+            'AutoCount_AvgCellArea': avg_areas,
+            'Acc_Manual_over_AutoCounts': accuracies,
+            'Manual_Objects': pooled['Manual_Objects'],
+            'AutoCount_Matched': pooled['AutoCount_Matched'],
+            'AutoCount_Precision': precision,
+            'AutoCount_Recall': recall,
+            'AutoCount_F1': f1
+        }
+    )
+
+
+def report_pairs(dirinfo, curves, bests):
+    """
+    Prints the parameters chosen for each composite image and for the pooled data, and saves
+    them to OptimizationPairs.csv in the output directory.
+
+    **Parameters**
+        dirinfo: *lib, str*
+            A library containing the working directory and its output directory.
+        curves: *list, df*
+            The optimization data of each composite followed by the pooled data.
+        bests: *list, int*
+            The index of the chosen row of each dataframe in curves.
+    """
+    columns = ['Composite', 'Manual_CellDiam', 'AutoCount_Thresh', 'Manual_Counts', 'AutoCount_Counts',
+               'Acc_Manual_over_AutoCounts', 'AutoCount_Precision', 'AutoCount_Recall', 'AutoCount_F1']
+    table = pd.DataFrame([curve.loc[best, columns] for curve, best in zip(curves, bests)]).reset_index(drop=True)
+    table.to_csv(os.path.join(os.path.normpath(dirinfo['output']), "OptimizationPairs.csv"), index=False)
+    print(table.to_string(index=False, float_format='{:.3f}'.format))
+
+
+def pooled_param_optimizer(dirinfo, params, pairs, workers=None):
+    """
+    Runs the sequential optimization on several composite images and manual count masks, each
+    in its own process. The diameter of the pooled data is the median of the diameters found
+    for each composite (the lower one for an even number of composites); composites optimized
+    at another diameter are swept again at it. The threshold curves are then pooled (see
+    pool_optimization_data) and the threshold is chosen from the pooled curve as for a single
+    composite. Saves the curves of every composite and the pooled curve to
+    OptimizationSummary.csv and the parameters chosen for each to OptimizationPairs.csv.
+
+    **Parameters**
+        dirinfo: *lib, str*
+            A library containing the working directory and all pertinent subdirectories
+            for the cell-count optimization and image processing.
+        params: *lib, str/int*
+            A library containing various parameters that are important for cell counting.
+        pairs: *list, tuple*
+            The composite images and manual count masks to use; see composite_pairs.
+        workers: *int*
+            Number of processes used to optimize composites in parallel; None uses one
+            process per CPU.
+
+    **Returns**
+        optimal_diameter: *int*
+            The median of the diameters found for each composite.
+        optimal_threshold: *int*
+            The threshold chosen from the pooled curve at that diameter.
+    """
+    interv = 10 if params['UseWatershed'] else 1
+    workers = os.cpu_count() if workers is None else workers
+    names = [dirinfo['composite_fnames'][pair[0]] for pair in pairs]
+    print("...Optimizing average diameter and threshold on {} composite images...".format(len(pairs)))
+
+    pool = ProcessPoolExecutor(max_workers=min(workers, len(pairs))) if workers > 1 else None
+    try:
+        if pool is None:
+            results = [pair_optimizer(dirinfo, params, pair, interv) for pair in pairs]
+        else:
+            futures = [pool.submit(pair_optimizer, dirinfo, params, pair, interv) for pair in pairs]
+            results = [future.result() for future in futures]
+        curves = [data for data, _, _ in results]
+        diameters = [diam for _, diam, _ in results]
+        optimal_diameter = int(sorted(diameters)[(len(diameters)-1)//2])
+        print("Diameters found: {}; pooled diameter {}".format(
+            ", ".join("{} {}".format(name, diam) for name, diam in zip(names, diameters)), optimal_diameter
+        ))
+
+        #Composites optimized at another diameter are swept again at the pooled one
+        resweep = [i for i, diam in enumerate(diameters) if diam != optimal_diameter]
+        if pool is None:
+            resweeps = [diameter_surface(dirinfo, params, optimal_diameter, interv, pairs[i]) for i in resweep]
+        else:
+            futures = [pool.submit(diameter_surface, dirinfo, params, optimal_diameter, interv, pairs[i]) for i in resweep]
+            resweeps = [future.result() for future in futures]
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    for name, data in zip(names, curves):
+        data.insert(0, 'Composite', name)
+    for i, data in zip(resweep, resweeps):
+        data.insert(0, 'Composite', names[i])
+    at_optimum = list(curves)
+    for i, data in zip(resweep, resweeps):
+        at_optimum[i] = data
+    pooled = pool_optimization_data(at_optimum)
+    data = pd.concat(curves + resweeps + [pooled], ignore_index=True)
+    data.to_csv(os.path.join(os.path.normpath(dirinfo['output']), "OptimizationSummary.csv"))
+
+    status = "...Optimizing average threshold..."
+    print(status)
+    best = sequential_threshold(pooled)
+    report_pairs(dirinfo, curves + [pooled], [sequential_threshold(curve) for curve in curves] + [best])
+    print_object_accuracy(pooled, best)
+    optimal_threshold = pooled['AutoCount_Thresh'][best]
+    params['diam'] = optimal_diameter
+    params['thresh'] = optimal_threshold
+    params['counts'] = pooled['Manual_Counts'][best]
+    params['diam_evals'] = sum(nr_evaluations for _, _, nr_evaluations in results)
+    return optimal_diameter, optimal_threshold
+
+
+def joint_param_optimizer(dirinfo, params, diams=None, interv=None, workers=None):
+    """
+    Evaluates the composite over a grid of diameters and thresholds together, instead of
+    freezing the diameter before the threshold sweep. Each diameter is swept in its own
+    process. The full surface is saved to OptimizationSummary.csv and the pair whose
+    automatic count is closest to the manual count is returned. With several composite
+    images (see composite_pairs), every composite and diameter is swept in its own process
+    and the surfaces are pooled (see pool_optimization_data); the best grid point of each
+    composite is reported and that of the pooled surface is returned.
+
+    **Parameters**
+        dirinfo: *lib, str*
+            A library containing the working directory and all pertinent subdirectories
+            for the cell-count optimization and image processing.
+        params: *lib, str/int*
+            A library containing various parameters that are important for cell counting.
+        diams: *list, int*
+            Diameters to evaluate; defaults to every diameter from params['diam_min'] (or 2)
+            up to params['diam'].
+        interv: *int*
+            Step between the threshold values tested at each diameter; defaults to 10 with
+            watershed segmentation and 1 without.
+        workers: *int*
+            Number of processes used to evaluate diameters in parallel; None uses one
+            process per CPU.
+
+    **Returns**
+        optimal_diameter: *int*
+            The diameter of the best grid point.
+        optimal_threshold: *int*
+            The threshold of the best grid point.
+
+    **Raises**
+        ValueError: if no cells are counted at any grid point (of the pooled data with
+        several composite images).
+    """
+    if diams is None:
+        diams = range(params.get('diam_min', 2), params['diam']+1)
+    diams = list(diams)
+    if interv is None:
+        interv = 10 if params['UseWatershed'] else 1
+    workers = os.cpu_count() if workers is None else workers
+
+    pairs = composite_pairs(dirinfo)
+    tasks = [(pair, diam) for pair in pairs for diam in diams]
+
+    status = "...Optimizing diameter and threshold over {} diameters...".format(len(diams))
+    if len(pairs) > 1:
+        status = "...Optimizing diameter and threshold over {} diameters on {} composite images...".format(len(diams), len(pairs))
+    print(status)
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            futures = [pool.submit(diameter_surface, dirinfo, params, diam, interv, pair) for pair, diam in tasks]
+            surfaces = [future.result() for future in futures]
+    else:
+        surfaces = [diameter_surface(dirinfo, params, diam, interv, pair) for pair, diam in tasks]
+
+    if len(pairs) > 1:
+        for (pair, diam), surface in zip(tasks, surfaces):
+            surface.insert(0, 'Composite', dirinfo['composite_fnames'][pair[0]])
+        curves = [pd.concat(surfaces[i:i+len(diams)], ignore_index=True) for i in range(0, len(surfaces), len(diams))]
+        pooled = pool_optimization_data(curves)
+        #A composite in which no cells were counted at any setting is reported with its first row
+        bests = [closest_to_manual(curve) for curve in curves]
+        bests = [0 if index is None else index for index in bests]
+        data = pd.concat(curves + [pooled], ignore_index=True)
+        data.to_csv(os.path.join(os.path.normpath(dirinfo['output']), "OptimizationSummary.csv"))
+        best = closest_to_manual(pooled)
+        if best is not None:
+            report_pairs(dirinfo, curves + [pooled], bests + [best])
+        data = pooled
+    else:
+        data = pd.concat(surfaces, ignore_index=True)
+        data.to_csv(os.path.join(os.path.normpath(dirinfo['output']), "OptimizationSummary.csv"))
+        best = closest_to_manual(data)
+    if best is None:
+        raise ValueError("No cells were counted in the composite images at any diameter from {} to {} and "
+                         "any threshold; check the images and the starting diameter".format(diams[0], diams[-1]))
+    optimal_diameter = int(data['Manual_CellDiam'][best])
+    optimal_threshold = data['AutoCount_Thresh'][best]
+    print_object_accuracy(data, best)
+    params['diam'] = optimal_diameter
+    params['thresh'] = optimal_threshold
+    params['counts'] = data['Manual_Counts'][best]
+    return optimal_diameter, optimal_threshold
+
+
+def closest_to_manual(data):
+    """
+    Returns the index of the row of optimization data whose automatic counts are closest to
+    the manual counts, or None if no cells were counted in any row (nan accuracy throughout).
+    """
+    distance = (data['Acc_Manual_over_AutoCounts'] - 1).abs()
+    if distance.isna().all():
+        return None
+    return distance.idxmin()
+
+
+def print_object_accuracy(data, best):
+    """Prints the object-level scores of the chosen row of the optimization data."""
+    print("Matched {:.0f} of {:.0f} manually marked cells: precision {:.3f}, recall {:.3f}, F1 {:.3f}".format(
+        data['AutoCount_Matched'][best], data['Manual_Objects'][best], data['AutoCount_Precision'][best],
+        data['AutoCount_Recall'][best], data['AutoCount_F1'][best]
+    ))
+
+
+def cellcounting_param_optimizer(dirinfo, params, mode='sequential', workers=None):
     """
     Utilizes a composite image and mask to determine the optimal diameter and threshold
-    for cell counting within a set of images.
+    for cell counting within a set of images. With several composite images and masks (see
+    composite_pairs), every pair is optimized in its own process and the parameters are
+    chosen from their pooled data (see pooled_param_optimizer).
 
     **Parameters**
 
@@ -437,134 +2245,837 @@ def cellcounting_param_optimizer(dirinfo, params):
             A library containing various parameters that are important for cell counting,
             including optimal diameter and threshold for picking and whether or not counting
             should include watershed segmentation.
+        mode: *str*
+            'sequential' tunes the diameter at Otsu's threshold and then sweeps the threshold;
+            'joint' evaluates diameters and thresholds together with joint_param_optimizer.
+        workers: *int*
+            Number of processes used by the 'joint' mode and for several composite images;
+            None uses one process per CPU.
 
 
     **Returns**
 
         optimal_diameter: *int*
-            An average cell diameter deemed 'optimal' by iterating down in diameter until the
-            automatic counts exceed manual counts.
+            An average cell diameter deemed 'optimal' by searching down in diameter until the
+            automatic counts exceed manual counts (see diameter_search). The number of
+            pipeline runs the search took is stored in params['diam_evals'].
         optimal_threshold: *int*
             An cell-picking threshold deemed 'optimal' by up in threshold by 10 until the
             automatic counts exceed manual counts. The penultimate threshold (before auto-counts
             exceed manual counts) is deemed optimal.
     """
     
-    # Determines the manual and auto counts using preset Otsu threshold.
-    images, params = image_preprocessing(dirinfo,params)
-    count_output = cellcounter(
-        0,
-        "Optim",
-        params,
-        dirinfo,
-        use_watershed=params['UseWatershed']
-    )
+    if mode == 'joint':
+        return joint_param_optimizer(dirinfo, params, workers=workers)
+    pairs = composite_pairs(dirinfo)
+    if len(pairs) > 1:
+        return pooled_param_optimizer(dirinfo, params, pairs, workers=workers)
+    pair = pairs[0]
+
+    # Determines the manual counts and the preset Otsu threshold.
+    images, params = image_preprocessing(dirinfo,params,pair)
 
-    # Gradually decreases the average diameter until the manual counts exceed the manual counts.
+    # Searches down in diameter until the auto counts reach the manual counts.
     # Serves as a rough optimization which is smoothened by auto-thresholding.
     status = "...Optimizing average diameter..."
     print(status)
 
-    while count_output['nr_nuclei'] < params['counts']:
-        params['diam'] = params['diam']-1
-        count_output = cellcounter(
-        0,
-        "Optim",
-        params,
-        dirinfo,
-        use_watershed=params['UseWatershed']
-        )
-    
-    optimal_diameter = params['diam']
+    optimal_diameter, params['diam_evals'] = diameter_search(dirinfo, params, diam_min=params.get('diam_min', 2), file=pair[0])
+    params['diam'] = optimal_diameter
+    print("Optimal diameter {} found in {} pipeline runs".format(optimal_diameter, params['diam_evals']))
 
 
-    # Collects data on cell-counting at different threshold values.
-    data = threshold_optimizer(images, dirinfo, params, interv=10)
+    # Collects data on cell-counting at different threshold values. Without watershed every
+    # threshold comes from a single sweep, so the full threshold range can be tested.
+    data = threshold_optimizer(images, dirinfo, params, interv=10 if params['UseWatershed'] else 1, file=pair[0])
     data.to_csv(os.path.join(os.path.normpath(dirinfo['output']), "OptimizationSummary.csv"))
 
     # Determines the optimum threshold value.
     status = "...Optimizing average threshold..."
     print(status)
-    i = len(data)-1
-    while data['Acc_Manual_over_AutoCounts'][i] < 1:
-        i-=1
-    optimal_threshold = data['AutoCount_Thresh'][i+1]
+    best = sequential_threshold(data)
+    optimal_threshold = data['AutoCount_Thresh'][best]
+    print_object_accuracy(data, best)
 
     return optimal_diameter, optimal_threshold
 
 
-def cellcounting_batch(dirinfo, channel, params, save_intensities=False):
+# Preprocessing arrays reused by every file a batch process counts; files of the same size
+# then need no new float allocations.
+_batch_buffers = {}
+
+
+def write_labels(cells, file, channel, params, dirinfo, write=write_now, profile=None):
+    """Saves the labelled cells of a counted file in the format params['label_format'] (see save_labels)."""
+    label_format = params.get('label_format', 'deflate')
+    if label_format != 'none':
+        key = channel.lower()
+        with profile_stage(profile, 'label_write'):
+            write(save_labels, label_file(dirinfo['output_' + key], dirinfo[key + '_fnames'][file], label_format),
+                  cells, label_format)
+
+
+def count_file(file, channel, params, dirinfo, save_intensities=False, profile=False, read=None, write=write_now):
     """
-    Iterates through all applicable files in the Ch1 subdirectory and passes them to the
-    cellcounter function.
+    Counts a single file of a channel and saves its labelled cell image to the channel's
+    output subdirectory, in the format params['label_format'] (see save_labels; default
+    'deflate'). Runs in the worker processes of cellcounting_batch.
 
     **Parameters**
+        file: *int*
+            The number file in the channel's ordered list of filenames.
+        channel: *str*
+            A string specifying the channel over which cells should be counted.
+        params: *lib, str/int*
+            A library containing various parameters that are important for cell counting,
+            including optimal diameter and threshold for picking and whether or not counting
+            should include watershed segmentation.
+        dirinfo: *lib, str*
+            A library containing the working directory and all pertinent subdirectories
+            for the cell-count optimization and image processing.
+        save_intensities: *bool*
+            Switch to determine whether individual cell intensities are saved, to a .csv file
+            or, with params['results_format'] set to 'parquet', returned as cell_info.
+        profile: *bool*
+            Whether to record the time and memory of each stage. Memory is only measured
+            while tracemalloc is tracing, which this function starts if needed.
+        read: *callable*
+            Optional function returning the decoded image or its source (see open_image),
+            e.g. from a read started ahead of time; the time it takes is profiled as the
+            'read' stage. By default the file is read by cellcounter.
+        write: *callable*
+            Function through which the output files are written; see cellcounter.
+
+    **Returns**
+        nr_nuclei: *int*
+            Number of cells counted in the file.
+        roi_size: *int*
+            Size of the image in pixels.
+        file_profile: *dict*
+            The stage profile of the file (see profile_stage), or None without profiling.
+        cell_info: *df*
+            The per-cell results when they are saved to a Parquet store by the caller
+            (params['results_format'] is 'parquet'), otherwise None.
+    """
+    file_profile = None
+    if profile:
+        file_profile = {}
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+    start = time.perf_counter()
+
+    image = None
+    if read is not None:
+        with profile_stage(file_profile, 'read'):
+            image = read()
+
+    count_out = cellcounter(
+        file,
+        channel,
+        params,
+        dirinfo,
+        use_watershed=params['UseWatershed'],
+        save_intensities=save_intensities,
+        buffers=_batch_buffers,
+        profile=file_profile,
+        image=image,
+        write=write
+        )
+
+    write_labels(count_out['cells'], file, channel, params, dirinfo, write, file_profile)
+    if profile:
+        file_profile['total_s'] = time.perf_counter() - start
+    cell_info = count_out['cell_info'] if params.get('results_format', 'csv') == 'parquet' else None
+    return count_out['nr_nuclei'], count_out['roi_size'], file_profile, cell_info
+
 
+
+def count_field(field, files, params, dirinfo, save_intensities=False, profile=False, read=None, write=write_now):
+    """
+    Counts every channel of one field and measures the colocalization of their cells. Each
+    image is read and preprocessed once; the overlaps between the label images of all
+    channel pairs are then taken from their co-occurrence histograms (see cell_overlaps).
+    Runs in the worker processes of cellcounting_batch.
+
+    **Parameters**
+        field: *str*
+            Name of the field (see field_files).
+        files: *lib, int*
+            The index of the field's image in each channel's filename list; None for
+            channels without an image of the field.
+        params: *lib, str/int*
+            A library of counting parameters, as for cellcounter. A cell of one channel
+            counts as lying in a cell of another when at least params['coloc_min']
+            (default 0.5) of its pixels overlap cells of the other channel.
         dirinfo: *lib, str*
             A library containing the working directory and all pertinent subdirectories
             for the cell-count optimization and image processing.
+        save_intensities: *bool*
+            Switch to determine whether individual cell intensities are saved. Each cell's
+            row also holds, for every other channel, the fraction of its pixels that overlap
+            that channel's cells ('overlap_<channel>') and the label of the cell it overlaps
+            most ('partner_<channel>').
+        profile: *bool*
+            Whether to record the time and memory of each stage, summed over the channels.
+        read: *callable*
+            Optional function returning the decoded image or source of each channel (see
+            read_images).
+        write: *callable*
+            Function through which the output files are written; see cellcounter.
+
+    **Returns**
+        row: *dict*
+            The field's row of the summary table (see field_summary_row).
+        field_profile: *dict*
+            The stage profile of the field, or None without profiling.
+        cell_info: *lib, df*
+            The per-cell results of each channel when they are saved to Parquet stores by
+            the caller (params['results_format'] is 'parquet'), otherwise None.
+    """
+    field_profile = None
+    if profile:
+        field_profile = {}
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+    start = time.perf_counter()
+
+    images = {}
+    if read is not None:
+        with profile_stage(field_profile, 'read'):
+            images = read()
+
+    #Per-cell results are written here, once the overlaps are known
+    channel_params = dict(params, results_format=None)
+    counted = {}
+    for channel, file in files.items():
+        if file is not None:
+            counted[channel] = cellcounter(
+                file, channel, channel_params, dirinfo, use_watershed=params['UseWatershed'],
+                save_intensities=save_intensities, buffers=_batch_buffers, profile=field_profile,
+                image=images.get(channel), write=write
+            )
+            counted[channel]['image'] = counted[channel]['gauss'] = counted[channel]['thresh'] = None
+            write_labels(counted[channel]['cells'], file, channel, params, dirinfo, write, field_profile)
+
+    colocalized = {}
+    with profile_stage(field_profile, 'colocalization'):
+        for channel_a, count_a in counted.items():
+            cell_ids = np.unique(count_a['cells'])[1:] if count_a['cell_info'] is None else count_a['cell_info']['cell_id'].to_numpy()
+            for channel_b, count_b in counted.items():
+                if channel_a != channel_b:
+                    overlap, partner = cell_overlaps(count_a['cells'], count_b['cells'], cell_ids)
+                    colocalized[(channel_a, channel_b)] = int((overlap >= params.get('coloc_min', 0.5)).sum())
+                    if count_a['cell_info'] is not None:
+                        count_a['cell_info']['overlap_' + channel_b] = overlap
+                        count_a['cell_info']['partner_' + channel_b] = partner
+            #Channels without an image of the field have no cells to overlap
+            if count_a['cell_info'] is not None:
+                for channel_b in files:
+                    if channel_b not in counted:
+                        count_a['cell_info']['overlap_' + channel_b] = 0.0
+                        count_a['cell_info']['partner_' + channel_b] = 0
+
+    cell_info = None
+    if save_intensities and params.get('results_format', 'csv') == 'parquet':
+        cell_info = {channel: count['cell_info'] for channel, count in counted.items()}
+    elif save_intensities:
+        with profile_stage(field_profile, 'csv_write'):
+            for channel, count in counted.items():
+                key = channel.lower()
+                write(count['cell_info'].to_csv, os.path.splitext(os.path.join(
+                    os.path.normpath(dirinfo['output_' + key]), dirinfo[key + '_fnames'][files[channel]]
+                ))[0] + '_CellInfo.csv', index=False)
+
+    row = field_summary_row(
+        field,
+        {channel: None if file is None else dirinfo[channel.lower() + '_fnames'][file] for channel, file in files.items()},
+        params,
+        {channel: (count['nr_nuclei'], count['roi_size'], count['threshold']) for channel, count in counted.items()},
+        colocalized
+    )
+    if profile:
+        field_profile['total_s'] = time.perf_counter() - start
+    return row, field_profile, cell_info
+
+def pipelined_count(files, image_file, count, file_done, depth, cancel=None, read=read_image):
+    """
+    Counts files on the calling thread while one background thread reads the next images
+    and another writes the outputs of the files already counted, so that reading and
+    writing overlap with the computation. At most depth images are read ahead and at most
+    depth files wait for their outputs to be written, which bounds the memory used.
+
+    **Parameters**
+        files: *iterable, int*
+            The numbers of the files to count, in order. It may be a generator, e.g. of files
+            still being discovered; it is advanced as images are read ahead.
+        image_file: *callable*
+            Returns the image path of a file, or the paths read by read.
+        count: *callable*
+            Called as count(file, read, write) to count a file, where read() returns its
+            decoded image and write(function, *args, **kwargs) queues an output write.
+        file_done: *callable*
+            Called as file_done(file, get_result) in file order once a file's outputs
+            are written; get_result() returns the result of count or raises its error.
+        depth: *int*
+            Number of images read ahead, and of counted files whose writes may be pending.
+        cancel: *threading.Event*
+            Optional event checked between files; once set, no further files are counted.
+        read: *callable*
+            Function reading or opening (see open_image) the image_file of a file, e.g.
+            with read_images for the channels of a field.
+    """
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as writer:
+        files = iter(files)
+        reads = deque((file, reader.submit(read, image_file(file))) for file in islice(files, depth))
+        pending = deque()
+
+        def finish(file, get_result, writes):
+            def get_written_result():
+                result = get_result()
+                for write in writes:
+                    write.result()
+                return result
+            file_done(file, get_written_result)
+
+        try:
+            while reads:
+                if cancel is not None and cancel.is_set():
+                    break
+                file, image = reads.popleft()
+                for file_ahead in islice(files, 1):
+                    reads.append((file_ahead, reader.submit(read, image_file(file_ahead))))
+
+                writes = []
+                try:
+                    result = count(file, image.result,
+                                   lambda function, *args, **kwargs: writes.append(writer.submit(function, *args, **kwargs)))
+                except Exception as error:
+                    def get_result(error=error):
+                        raise error
+                else:
+                    get_result = lambda result=result: result
+                pending.append((file, get_result, writes))
+
+                #Report files whose writes are done; wait for the oldest once depth files are pending
+                while pending and (len(pending) > depth or all(write.done() for write in pending[0][2])):
+                    finish(*pending.popleft())
+        finally:
+            for file, image in reads:
+                image.cancel()
+            while pending:
+                finish(*pending.popleft())
+
+
+def summary_row(channel, fname, params, nr_nuclei, roi_size, thresh=None):
+    """
+    Builds the row of the batch summary table describing one counted file.
+
+    **Parameters**
         channel: *str*
-            A string specifying the channel over which cells should be counted. The applet
-            is only configured for single-channel counting, but eventually multichannel
-            processing could be implemented using this parameter.
+            A string specifying the channel over which cells were counted.
+        fname: *str*
+            Name of the counted file.
         params: *lib, str/int*
-            A library containing various parameters that are important for cell counting,
-            including optimal diameter and threshold for picking and whether or not counting
-            should include watershed segmentation.
+            A library containing the parameters used for counting.
+        nr_nuclei: *int*
+            Number of cells counted in the file; nan if the file could not be counted.
+        roi_size: *int*
+            Size of the image in pixels; nan if the file could not be counted.
+        thresh: *float*
+            The threshold used, if it was not set in params (see cellcounter).
 
+    **Returns**
+        row: *dict*
+            Dictionary keyed by the columns of the batch summary table.
+    """
+    key = channel.lower()
+    if thresh is None:
+        thresh = params.get(key + '_thresh')
+    row = {
+        '{}_FileNames'.format(channel): fname,
+        '{}_Thresh'.format(channel) : np.nan if thresh is None else float(thresh),
+        '{}_AvgCellDiam'.format(channel) : float(params.get(key + '_diam', params['ch1_diam'])),
+        '{}_ParticleMin'.format(channel) : float(params['particle_min']),
+        '{}_Counts'.format(channel): nr_nuclei,
+        '{}_ROIsize'.format(channel): roi_size
+    }
+    return row
+
+
+def field_summary_row(field, fnames, params, counts=None, colocalized=None):
+    """
+    Builds the row of the multichannel batch summary table describing one field.
+
+    **Parameters**
+        field: *str*
+            Name of the field (see field_files).
+        fnames: *lib, str*
+            The field's filename in each channel; None for channels without an image.
+        params: *lib, str/int*
+            A library containing the parameters used for counting.
+        counts: *lib, tuple*
+            (nr_nuclei, roi_size, thresh) of each counted channel; channels left out get
+            empty counts.
+        colocalized: *lib, int*
+            Number of cells of channel a lying in a cell of channel b, keyed by (a, b).
 
     **Returns**
+        row: *dict*
+            Dictionary keyed by the columns of the summary table: the field, the
+            summary_row columns of each channel and a '<a>_in_<b>' column per channel pair.
+    """
+    counts = counts or {}
+    colocalized = colocalized or {}
+    row = {'Field': field}
+    for channel, fname in fnames.items():
+        row.update(summary_row(channel, fname, params, *counts.get(channel, (np.nan, np.nan, None))))
+    for channel_a in fnames:
+        for channel_b in fnames:
+            if channel_a != channel_b:
+                row['{}_in_{}'.format(channel_a, channel_b)] = colocalized.get((channel_a, channel_b), np.nan)
+    return row
+
+
+def file_signature(image_file):
+    """Returns the (size, modification time) pair used to detect changed input files."""
+    stat = os.stat(image_file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def manifest_params(params, save_intensities, channels=('Ch1',)):
+    """Returns the parameters that determine a file's counting output, as recorded in the run manifest."""
+    run_params = {
+        'ch1_diam' : float(params['ch1_diam']),
+        'ch1_thresh' : float(params['ch1_thresh']),
+        'particle_min' : float(params['particle_min']),
+        'UseWatershed' : bool(params['UseWatershed']),
+        'tile_size' : params.get('tile_size'),
+        'precision' : params.get('precision', 'float32'),
+        'label_format' : params.get('label_format', 'deflate'),
+        'save_intensities' : bool(save_intensities),
+        'results_format' : params.get('results_format', 'csv')
+    }
+    for channel in channels:
+        if channel != 'Ch1':
+            key = channel.lower()
+            run_params[key + '_diam'] = float(params.get(key + '_diam', params['ch1_diam']))
+            run_params[key + '_thresh'] = params.get(key + '_thresh')
+    if len(channels) > 1:
+        run_params['coloc_min'] = float(params.get('coloc_min', 0.5))
+    return run_params
 
-        Ch1_Counts: *df*
-            A pandas dataframe containing a summary of the counting performed on each
-            channel one file within the Ch1 subdirectory. 
+
+def load_manifest(manifest_file):
     """
+    Reads a run manifest written by cellcounting_batch. The manifest holds one JSON line per
+    counted file; later lines replace earlier ones and an incomplete last line (from an
+    interrupted run) is ignored.
 
-    fnames = dirinfo['ch1_fnames']
-    output = dirinfo['output_ch1']
-    diam = params['ch1_diam']
-    thresh = params['ch1_thresh']
+    **Parameters**
+        manifest_file: *str*
+            Path to the manifest.
 
-    counts = []
-    roi_size = []
+    **Returns**
+        manifest: *dict*
+            Dictionary of manifest entries keyed by filename.
+    """
+    manifest = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as lines:
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                manifest[entry['file']] = entry
+    return manifest
+
+
+def results_format(requested='csv'):
+    """
+    Resolves the format in which per-cell results are saved: 'csv' (the default) writes a
+    _CellInfo.csv per image and 'parquet' one consolidated Parquet store per channel (see
+    open_cell_store). 'auto' picks 'parquet' when pyarrow is installed and 'csv' otherwise.
+    """
+    if requested == 'auto':
+        return 'csv' if pq is None else 'parquet'
+    if requested == 'parquet' and pq is None:
+        raise ImportError("Saving results as Parquet requires pyarrow (pip install pyarrow)")
+    return requested
+
+
+def cell_store_schema(channel, overlaps=()):
+    """The columns of the cell store of a channel; see open_cell_store."""
+    return pa.schema([
+        ('{}_file'.format(channel), pa.string()),
+        ('cell_id', pa.int64()),
+        ('cell_size', pa.int64()),
+        ('cell_intensity', pa.float64())
+    ] + [
+        (column + other, column_type) for other in overlaps
+        for column, column_type in (('overlap_', pa.float64()), ('partner_', pa.int64()))
+    ])
+
+
+def cell_store_files(store_file, schema=None):
+    """
+    Returns the filenames held by a cell store, one per row group in order, or [] if there is
+    none or, given a schema, if the store's columns differ from it.
+    """
+    if pq is None or not os.path.isfile(store_file):
+        return []
+    existing = pq.ParquetFile(store_file)
+    if schema is not None and not existing.schema_arrow.equals(schema):
+        return []
+    metadata = existing.metadata.metadata or {}
+    return json.loads(metadata.get(b'files', b'[]'))
 
-    for file in range(len(fnames)):
-        count_out = cellcounter(
-            file,
-            "Ch1",
-            params,
-            dirinfo,
-            use_watershed=params['UseWatershed'],
-            save_intensities=save_intensities
-            )
 
-        counts.append(count_out['nr_nuclei'])
-        roi_size.append(count_out['roi_size'])
-        cv2.imwrite(
-            filename = os.path.splitext(
-                os.path.join(
-                    os.path.normpath(output),
-                    fnames[file]
-                )
-            )[0] + '_Counts.tif',
-            img = count_out['cells'].astype(np.uint16)
-        )
+def open_cell_store(store_file, channel, keep=(), overlaps=()):
+    """
+    Starts writing the Parquet store that holds the per-cell results of a channel, with one
+    row group per image. The store is written to a temporary file and only replaces
+    store_file when closed by close_cell_store; a run that fails or is interrupted (e.g. by
+    KeyboardInterrupt) discards it, leaving the previous store intact.
+
+    **Parameters**
+        store_file: *str*
+            Path of the store, e.g. SavedOutput/Ch1_CellInfo.parquet.
+        channel: *str*
+            The channel whose results are stored; names the filename column.
+        keep: *iterable, str*
+            Filenames whose row groups are copied over from the existing store_file, if it
+            has the same columns; more can be copied later with keep_cell_rows.
+        overlaps: *list, str*
+            Other channels whose overlaps with each cell are stored (see count_field).
+
+    **Returns**
+        store: *lib*
+            A library holding the open writer, to be passed to append_cell_store and
+            close_cell_store.
+    """
+    schema = cell_store_schema(channel, overlaps)
+    store = {'path': store_file, 'schema': schema, 'files': [],
+             'writer': pq.ParquetWriter(store_file + '.tmp', schema), 'previous': None, 'previous_files': {}}
+    previous = cell_store_files(store_file, schema)
+    if previous:
+        store['previous'] = pq.ParquetFile(store_file)
+        store['previous_files'] = {fname: row_group for row_group, fname in enumerate(previous)}
+    for fname in keep:
+        keep_cell_rows(store, fname)
+    return store
+
+
+def keep_cell_rows(store, fname):
+    """Copies the row group of fname from the store being replaced into the store, if it has one."""
+    row_group = store['previous_files'].get(fname)
+    if row_group is not None:
+        store['writer'].write_table(store['previous'].read_row_group(row_group))
+        store['files'].append(fname)
+
+
+def append_cell_store(store, fname, cell_info):
+    """Writes the per-cell results of one image (as built by cellcounter) as a row group of the store."""
+    store['writer'].write_table(pa.Table.from_pandas(cell_info, schema=store['schema'], preserve_index=False))
+    store['files'].append(fname)
+
+
+def close_cell_store(store, discard=False):
+    """
+    Finishes a store opened by open_cell_store, recording its filenames, and moves it into
+    place; with discard, the temporary file is deleted instead and store_file is left as it was.
+    """
+    if not discard:
+        store['writer'].add_key_value_metadata({'files': json.dumps(store['files'])})
+    store['writer'].close()
+    if store['previous'] is not None:
+        store['previous'].close()
+    if discard:
+        os.remove(store['path'] + '.tmp')
+    else:
+        os.replace(store['path'] + '.tmp', store['path'])
+
+
+def load_cell_info(store_file, fnames=None, columns=None):
+    """
+    Reads per-cell results from a cell store without loading the rest of it.
+
+    **Parameters**
+        store_file: *str*
+            Path of the store, e.g. SavedOutput/Ch1_CellInfo.parquet.
+        fnames: *list, str*
+            Images whose cells to read; only their row groups are read. Default: all.
+        columns: *list, str*
+            Columns to read. Default: all.
+
+    **Returns**
+        cell_info: *df*
+            A pandas dataframe with one row per cell.
+    """
+    store = pq.ParquetFile(store_file)
+    row_groups = [row_group for row_group, fname in enumerate(cell_store_files(store_file))
+                  if fnames is None or fname in fnames]
+    return store.read_row_groups(row_groups, columns=columns).to_pandas()
+
+
+def cellcounting_batch(dirinfo, channel, params, save_intensities=False, workers=1, progress=None, cancel=None, resume=False, profile=None, prefetch=0):
+    """
+    Iterates through all applicable files in the Ch1 subdirectory and passes them to the
+    cellcounter function. Files are independent, so with more than one worker they are
+    counted in a process pool. A file that fails is reported and left with empty counts
+    instead of stopping the batch. Given several channels, the batch works through fields
+    instead (see field_files and count_field): all channels of a field are counted
+    together and their cells colocalized, giving one summary row per field. Files are
+    counted as discover_fields finds them, so when getdirinfo was called with lazy=True
+    counting starts before the channel subdirectory has been fully listed.
+
+    **Parameters**
+
+        dirinfo: *lib, str*
+            A library containing the working directory and all pertinent subdirectories
+            for the cell-count optimization and image processing.
+        channel: *str or list, str*
+            A string specifying the channel over which cells should be counted (e.g. "Ch1"),
+            or a list of channels (e.g. dirinfo['channels']) to count field by field. Output
+            files named after the channel below are then named "Fields" instead.
+        params: *lib, str/int*
+            A library containing various parameters that are important for cell counting,
+            including optimal diameter and threshold for picking and whether or not counting
+            should include watershed segmentation. See cellcounter for the diameter and
+            threshold of each channel and count_field for params['coloc_min'].
+        save_intensities: *bool*
+            Switch to determine whether individual cell intensities are saved, in the format
+            params['results_format'] (see results_format; default 'csv'). As 'parquet', the
+            cells of all files of a channel go to one store, e.g. Ch1_CellInfo.parquet in
+            the output directory, with a row group per file appended as each file finishes
+            (see open_cell_store and load_cell_info), and the summary table is saved to
+            Ch1_Counts.parquet.
+        workers: *int*
+            Number of processes used to count files in parallel; 1 counts serially and
+            None uses one process per CPU. Two files per process are queued at a time.
+        progress: *callable*
+            Optional function called as progress(nr_done, nr_files, row) each time a file
+            finishes, where row is that file's summary_row and nr_files the number of files
+            found so far.
+        cancel: *threading.Event*
+            Optional event checked between files; once set, no further files are started
+            and the remaining files found so far are left with empty counts.
+        resume: *bool*
+            Keep a run manifest (Ch1_Manifest.jsonl in the output directory) of every counted
+            file's size, modification time, counting parameters and summary row. Files
+            whose entry still matches, and whose output files exist, are not counted again;
+            an interrupted run therefore resumes where it stopped.
+        profile: *list*
+            Optional list that receives, in the order of the summary, a dictionary of the wall time
+            and peak memory of each stage for every file counted in this run (files reused
+            from the manifest are not profiled; see profile_stage and profile_summary). The
+            same table is saved to Ch1_Profile.csv in the output directory. Without it no
+            measurements are taken.
+        prefetch: *int*
+            When files are counted in this process, the number of images opened ahead on a
+            background thread while the current one is counted (see pipelined_count and
+            prefetch_image; with params['tile_size'] set, memory-mapped images are instead
+            paged in as their tiles are used); the output files are then also written on a
+            background thread, and the 'read' stage of a profile is the time spent waiting
+            for the image. 0 reads and writes each file in turn. Worker processes always
+            read their own files.
+
+
+    **Returns**
+
+        counts: *df*
+            A pandas dataframe containing a summary of the counting performed on each
+            channel one file within the Ch1 subdirectory, in the order found by scan_images
+            (filename order for a flat subdirectory); or, for several channels, on each field
+            in field name order (see field_summary_row).
+    """
+
+    channels = [channel] if isinstance(channel, str) else list(channel)
+    multichannel = len(channels) > 1
+    prefix = "Fields" if multichannel else channels[0]
+    workers = os.cpu_count() if workers is None else workers
+    params = dict(params, results_format=results_format(params.get('results_format', 'csv')) if save_intensities else None)
+
+    def empty_row(unit):
+        if multichannel:
+            return field_summary_row(fields[unit], fnames[unit], params)
+        return summary_row(channels[0], fields[unit], params, np.nan, np.nan)
+
+    #Fields are numbered in the order they are found (see discover_fields)
+    fields = []
+    fnames = []
+    rows = []
+    profiles = {}
+    nr_done = 0
+
+    manifest_file = os.path.join(os.path.normpath(dirinfo['output']), prefix + "_Manifest.jsonl")
+    manifest = load_manifest(manifest_file) if resume else {}
+    run_params = manifest_params(params, save_intensities, channels)
+    store_files = {ch: os.path.join(os.path.normpath(dirinfo['output']), ch + "_CellInfo.parquet") for ch in channels}
+    stored = {ch: set(cell_store_files(store_files[ch], cell_store_schema(ch, [other for other in channels if other != ch])))
+                  if resume and params['results_format'] == 'parquet' else set()
+              for ch in channels}
+    signatures = {}
+    output_subdirs = set()
+
+    def discover():
+        #Yields the fields to count as they are found, reusing the rows of files whose inputs
+        #and parameters are unchanged since the last run
+        nonlocal nr_done
+        for field, unit_fnames in discover_fields(dirinfo, channels):
+            unit = len(fields)
+            fields.append(field)
+            fnames.append(unit_fnames)
+            rows.append(empty_row(unit))
+            for ch, fname in unit_fnames.items():
+                subdir = None if fname is None else os.path.join(os.path.normpath(dirinfo['output_' + ch.lower()]), os.path.dirname(fname))
+                if subdir is not None and subdir not in output_subdirs:
+                    os.makedirs(subdir, exist_ok=True)
+                    output_subdirs.add(subdir)
+            if resume:
+                paths = {ch: os.path.join(os.path.normpath(dirinfo[ch.lower()]), fname)
+                         for ch, fname in unit_fnames.items() if fname is not None}
+                signatures[unit] = ({ch: file_signature(path) for ch, path in paths.items()} if multichannel
+                                    else file_signature(paths[channels[0]]))
+                entry = manifest.get(field)
+                outputs = []
+                for ch, fname in unit_fnames.items():
+                    if fname is not None:
+                        outputs.append(label_file(dirinfo['output_' + ch.lower()], fname, run_params['label_format']))
+                        if params['results_format'] == 'csv':
+                            outputs.append(os.path.splitext(os.path.join(os.path.normpath(dirinfo['output_' + ch.lower()]), fname))[0] + '_CellInfo.csv')
+                if (entry is not None and entry['signature'] == signatures[unit] and entry['params'] == run_params
+                        and all(os.path.isfile(output) for output in outputs if output is not None)
+                        and (params['results_format'] != 'parquet'
+                             or all(fname in stored[ch] for ch, fname in unit_fnames.items() if fname is not None))):
+                    rows[unit] = entry['row']
+                    #Per-cell results of reused files are carried over into the new stores
+                    for ch, fname in unit_fnames.items():
+                        if stores and fname is not None:
+                            keep_cell_rows(stores[ch], fname)
+                    nr_done += 1
+                    if progress is not None:
+                        progress(nr_done, len(fields), rows[unit])
+                    continue
+            yield unit
+
+    def count_task(unit):
+        #The counting function and its arguments, which worker processes must be able to unpickle.
+        #Only the unit's own filenames are passed on, not the filename lists of whole channels.
+        unit_dirinfo = dict(dirinfo, **{ch.lower() + '_fnames': [fname] for ch, fname in fnames[unit].items()})
+        if multichannel:
+            files = {ch: None if fname is None else 0 for ch, fname in fnames[unit].items()}
+            return count_field, (fields[unit], files, params, unit_dirinfo, save_intensities, profiling)
+        return count_file, (0, channels[0], params, unit_dirinfo, save_intensities, profiling)
+
+    def count_unit(unit, read=None, write=write_now):
+        function, args = count_task(unit)
+        return function(*args, read, write)
+
+    def file_done(unit, get_result):
+        nonlocal nr_done
+        nr_done += 1
+        field = fields[unit]
+        try:
+            if multichannel:
+                row, file_profile, cell_info = get_result()
+            else:
+                nr_nuclei, roi_size, file_profile, cell_info = get_result()
+                row = summary_row(channels[0], field, params, nr_nuclei, roi_size)
+                cell_info = {channels[0]: cell_info}
+            if stores:
+                with profile_stage(file_profile, 'store_write'):
+                    for ch, channel_info in cell_info.items():
+                        append_cell_store(stores[ch], fnames[unit][ch], channel_info)
+            rows[unit] = row
+        except Exception as error:
+            print("Failed: " + field + " (" + repr(error) + ")")
+        else:
+            if file_profile is not None:
+                name_column = 'Field' if multichannel else '{}_FileNames'.format(channels[0])
+                profiles[unit] = dict({name_column: field}, **file_profile)
+            if resume:
+                with open(manifest_file, 'a') as manifest_out:
+                    entry = {'file': field, 'signature': signatures[unit], 'params': run_params, 'row': rows[unit]}
+                    manifest_out.write(json.dumps(entry, default=lambda value: value.item()) + '\n')
+        if progress is not None:
+            progress(nr_done, len(fields), rows[unit])
+
+    def image_file(unit):
+        paths = {ch: None if fname is None else os.path.join(os.path.normpath(dirinfo[ch.lower()]), fname)
+                 for ch, fname in fnames[unit].items()}
+        return paths if multichannel else paths[channels[0]]
+
+    #Memory is traced only while profiling; worker processes start tracing themselves
+    parallel = workers > 1
+    profiling = profile is not None
+    start_tracing = profiling and not parallel and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start()
+
+    stores = {}
+    if params['results_format'] == 'parquet':
+        for ch in channels:
+            stores[ch] = open_cell_store(store_files[ch], ch, overlaps=[other for other in channels if other != ch])
+
+    try:
+        if parallel:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {}
+
+                def finish_futures():
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        unit = futures.pop(future)
+                        if not future.cancelled():
+                            file_done(unit, future.result)
+
+                #A few files per worker are queued; discovery continues as they finish
+                for unit in discover():
+                    if cancel is not None and cancel.is_set():
+                        break
+                    function, args = count_task(unit)
+                    futures[pool.submit(function, *args)] = unit
+                    while len(futures) >= 2*workers:
+                        finish_futures()
+                while futures:
+                    if cancel is not None and cancel.is_set():
+                        for pending in futures:
+                            pending.cancel()
+                    finish_futures()
+        elif prefetch > 0:
+            #Images are read ahead; with tiles, memory-mapped ones are paged in as tiles are used
+            read = lambda image_file: prefetch_image(image_file, params.get('image_cache'), params.get('tile_size') is None)
+            pipelined_count(discover(), image_file, count_unit, file_done, prefetch, cancel,
+                            (lambda image_files: read_images(image_files, read)) if multichannel else read)
+        else:
+            for unit in discover():
+                if cancel is not None and cancel.is_set():
+                    break
+                file_done(unit, lambda: count_unit(unit))
+    except BaseException:
+        #A failed or interrupted run leaves the previous stores in place
+        for store in stores.values():
+            close_cell_store(store, discard=True)
+        raise
+    for store in stores.values():
+        close_cell_store(store)
+
+    if start_tracing:
+        tracemalloc.stop()
+    if profiling and profiles:
+        profiles = [profiles[unit] for unit in sorted(profiles)]
+        profile.extend(profiles)
+        pd.DataFrame(profiles).to_csv(os.path.join(os.path.normpath(dirinfo['output']), prefix + "_Profile.csv"), index=False)
 
     #Create DataFrame
-    if channel == "Ch1":
-        Ch1_Counts = pd.DataFrame(
-        {'Ch1_FileNames': fnames,
-         'Ch1_Thresh' : np.ones(len(fnames))*thresh,
-         'Ch1_AvgCellDiam' : np.ones(len(fnames))*diam,
-         'Ch1_ParticleMin' : np.ones(len(fnames))*params['particle_min'],
-         'Ch1_Counts': counts,
-         'Ch1_ROIsize': roi_size
-        })
-        
+    counts = pd.DataFrame(rows)
     
-    # Ch1_Counts.to_csv(os.path.join(os.path.normpath(dirinfo['output']), "Ch1_Counts.csv"))
+    # counts.to_csv(os.path.join(os.path.normpath(dirinfo['output']), prefix + "_Counts.csv"))
+    if params['results_format'] == 'parquet':
+        counts.to_parquet(os.path.join(os.path.normpath(dirinfo['output']), prefix + "_Counts.parquet"), index=False)
 
-    return Ch1_Counts
+    return counts
 
 # if __name__ == "__main__":
 #     working_directory, particle_min, use_watershed = "/Users/noahsmith/Documents/Hopkins Documents/Courses/S24 Courses/Software Carpentry/Final Project/ref code cell counting ZachPenn github", 0.2, True #get input parameters from gui
@@ -0,0 +1,216 @@
+"""
+Final project - cell counting GUI
+
+Authors: Noah Daniel Smith, Valentina Matos Romero
+
+Note: Headless command-line entry point for the cell counting pipeline, for machines without a
+display or PySide2. It runs the same steps as the GUI (getdirinfo, the parameter optimizer and
+the batch counter) on a working directory laid out as in Template.zip; images may be nested in
+subdirectories of the channel subdirectories. Each file's summary row is written to stdout and
+to the summary .csv as soon as that file is counted; status messages go to stderr. With
+--channels, the images of several channels are counted field by field and their cells
+colocalized.
+
+Example:
+    python cell_counter_cli.py /path/to/Template --particle-min 0.5 --workers 8
+    python cell_counter_cli.py /path/to/Template --diam 6 --thresh 40 --no-watershed
+    python cell_counter_cli.py /path/to/Template --channels all --channel-thresh Ch2=55
+"""
+
+
+import argparse
+import contextlib
+import csv
+import os
+import sys
+from cell_counter_backend import (getdirinfo, cellcounting_param_optimizer, cellcounting_batch, profile_summary,
+                                  IMAGE_PATTERNS, LABEL_FORMATS)
+
+
+def channel_value(text):
+    """Parses a CHANNEL=VALUE argument, e.g. 'Ch2=55'."""
+    channel, sep, value = text.partition('=')
+    if not sep or not channel:
+        raise argparse.ArgumentTypeError(f"expected CHANNEL=VALUE, got '{text}'")
+    try:
+        return channel, float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a number")
+
+
+@contextlib.contextmanager
+def stdout_to_stderr():
+    """
+    Sends everything printed to stdout to stderr instead, including the output of worker
+    processes, so that stdout only holds the summary rows; yields a stream to the real stdout.
+    """
+    sys.stdout.flush()
+    saved = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        with os.fdopen(os.dup(saved), 'w') as rows_out:
+            yield rows_out
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def parse_args(argv=None):
+    """Parse the command-line arguments."""
+    parser = argparse.ArgumentParser(description='Count cells in the Ch1 images of a working directory.')
+    parser.add_argument('directory', help='Working directory containing Composite, ManualCounts and Ch1 subdirectories.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to count files and to optimize several composite '
+                             'images (0 uses one per CPU). Default: 1.')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='With one worker, number of images read ahead while the current one is counted; '
+                             'outputs are then written in the background as well (0 disables). Default: 2.')
+    parser.add_argument('--diam', type=int, default=6,
+                        help='Average cell diameter; the starting point of the optimizer, or the diameter used '
+                             'as-is when --thresh is given. Default: 6.')
+    parser.add_argument('--thresh', type=float, default=None,
+                        help='Counting threshold. When given, the optimizer is skipped.')
+    parser.add_argument('--particle-min', type=float, default=0.5,
+                        help='Minimum particle size as a fraction of the average cell area. Default: 0.5.')
+    parser.add_argument('--watershed', action=argparse.BooleanOptionalAction, default=True,
+                        help='Use watershed segmentation to separate touching cells. Default: on.')
+    parser.add_argument('--optimizer', choices=['sequential', 'joint'], default='sequential',
+                        help='Parameter optimizer mode. Default: sequential.')
+    parser.add_argument('--channels', nargs='+', default=['Ch1'],
+                        help="Channels to count, e.g. Ch1 Ch2, or 'all' for every Ch<number> subdirectory. "
+                             "With several channels the images of each field (same filename once the channel "
+                             "tag is removed) are counted together, and the summary holds one row per field "
+                             "with the number of cells of each channel lying in cells of the others. The "
+                             "optimizer always tunes Ch1. Default: Ch1.")
+    parser.add_argument('--channel-thresh', type=channel_value, action='append', default=[], metavar='CHANNEL=VALUE',
+                        help="Counting threshold of a channel other than Ch1; channels without one are "
+                             "thresholded per image with Otsu's method. Can be repeated.")
+    parser.add_argument('--channel-diam', type=channel_value, action='append', default=[], metavar='CHANNEL=VALUE',
+                        help='Cell diameter of a channel other than Ch1. Default: the Ch1 diameter.')
+    parser.add_argument('--coloc-min', type=float, default=0.5,
+                        help='Fraction of its pixels a cell must share with cells of another channel to count '
+                             'as colocalized. Default: 0.5.')
+    parser.add_argument('--save-intensities', action=argparse.BooleanOptionalAction, default=True,
+                        help='Save per-cell sizes and intensities. Default: on.')
+    parser.add_argument('--results-format', choices=['csv', 'parquet', 'auto'], default='csv',
+                        help="Save per-cell results to a _CellInfo.csv per image ('csv'), or to one store, "
+                             "SavedOutput/Ch1_CellInfo.parquet ('parquet', needs pyarrow); 'auto' uses Parquet "
+                             "when pyarrow is installed. Default: csv.")
+    parser.add_argument('--precision', choices=['float32', 'float64'], default='float32',
+                        help='Floating point precision of the preprocessing steps. Default: float32.')
+    parser.add_argument('--median-backend', choices=['auto', 'scipy', 'opencv', 'histogram'], default='auto',
+                        help='Median filter implementation; all give identical results. Default: auto.')
+    parser.add_argument('--tile-size', default=None,
+                        help="Process images in tiles of this many pixels per side ('auto' sizes them from the "
+                             "diameter), for images too large to process whole. Default: off.")
+    parser.add_argument('--image-cache', default=None, metavar='DIR',
+                        help='Directory in which images that cannot be memory-mapped (e.g. compressed TIFFs) are '
+                             'kept as raw .npy copies, so that later runs map them instead of decoding them '
+                             'again; uncompressed TIFFs are always mapped. Default: off.')
+    parser.add_argument('--label-format', choices=list(LABEL_FORMATS), default='deflate',
+                        help="Format of the labelled cell images: compressed TIFF ('deflate' or 'lzw'), "
+                             "uncompressed 'tiff', run-length encoded objects in a .npz ('rle'), or 'none' "
+                             "to skip them. Default: deflate.")
+    parser.add_argument('--patterns', nargs='+', default=list(IMAGE_PATTERNS), metavar='PATTERN',
+                        help='Filename patterns of the images to count, matched regardless of case. '
+                             "Default: {}.".format(' '.join(IMAGE_PATTERNS)))
+    parser.add_argument('--listing-cache', action=argparse.BooleanOptionalAction, default=True,
+                        help='Keep the listing of the channel subdirectories in SavedOutput/Ch1_Listing.json, '
+                             'so that later runs only list again the directories that changed. Default: on.')
+    parser.add_argument('--resume', action=argparse.BooleanOptionalAction, default=True,
+                        help='Skip files already counted with the same parameters in a previous run. Default: on.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Record the time and peak memory of each pipeline stage for every file to '
+                             'SavedOutput/Ch1_Profile.csv and print a summary.')
+    parser.add_argument('--csv', default=None,
+                        help='Summary .csv to write. Default: SavedOutput/Ch1_Counts.csv in the working directory '
+                             '(Fields_Counts.csv for several channels).')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Run the optimizer and batch counter from the command line; returns the exit status: 0 if
+    every file was counted, 1 if any failed, and 2 if a channel subdirectory is missing or holds
+    no images.
+    """
+    args = parse_args(argv)
+    workers = None if args.workers == 0 else args.workers
+
+    # Channel subdirectories are walked while the batch runs, so counting starts with the first image found
+    dirinfo = {'main': args.directory, 'listing_cache': args.listing_cache}
+    dirinfo = getdirinfo(dirinfo, patterns=args.patterns, lazy=True)
+    channels = dirinfo['channels'] if args.channels == ['all'] else args.channels
+    missing = [channel for channel in channels if channel not in dirinfo['channels']]
+    if missing:
+        print(f"No {', '.join(missing)} subdirectory in {args.directory}", file=sys.stderr)
+        return 2
+
+    params = {'diam': args.diam,
+              'particle_min': args.particle_min,
+              'UseWatershed': args.watershed,
+              'precision': args.precision,
+              'median_backend': args.median_backend,
+              'label_format': args.label_format,
+              'results_format': args.results_format,
+              'coloc_min': args.coloc_min,
+              'image_cache': args.image_cache
+              }
+    for channel, thresh in args.channel_thresh:
+        params[channel.lower() + '_thresh'] = thresh
+    for channel, diam in args.channel_diam:
+        params[channel.lower() + '_diam'] = int(diam)
+
+    # Status messages of the optimizer and the batch go to stderr, so that stdout holds only the summary rows
+    with stdout_to_stderr() as rows_out:
+        if args.thresh is None:
+            optimal_diameter, optimal_threshold = cellcounting_param_optimizer(
+                dirinfo, params, mode=args.optimizer, workers=workers
+            )
+        else:
+            optimal_diameter, optimal_threshold = args.diam, args.thresh
+        params['ch1_diam'] = optimal_diameter
+        params['ch1_thresh'] = optimal_threshold
+        if args.tile_size is not None:
+            params['tile_size'] = args.tile_size if args.tile_size == 'auto' else int(args.tile_size)
+        print(f'Counting with diameter {optimal_diameter} and threshold {optimal_threshold}', file=sys.stderr)
+
+        # Rows are streamed in the order files finish; the file is rewritten in filename order at the end
+        prefix = "Fields" if len(channels) > 1 else channels[0]
+        summary_file = args.csv or os.path.join(os.path.normpath(dirinfo['output']), prefix + "_Counts.csv")
+        with open(summary_file, 'w', newline='') as stream:
+            writers = {}
+
+            def write_row(done, total, row):
+                if not writers:
+                    for out in (stream, rows_out):
+                        writers[out] = csv.DictWriter(out, fieldnames=list(row))
+                        writers[out].writeheader()
+                for out, writer in writers.items():
+                    writer.writerow(row)
+                    out.flush()
+
+            profile = [] if args.profile else None
+            output = cellcounting_batch(
+                dirinfo, channels, params, save_intensities=args.save_intensities,
+                workers=workers, progress=write_row, resume=args.resume, profile=profile,
+                prefetch=args.prefetch
+            )
+
+    if output.empty:
+        print(f"No images to count in {', '.join(channels)} of {args.directory}", file=sys.stderr)
+        return 2
+    output.to_csv(summary_file, index=False)
+    print(f'Summary saved to {summary_file}', file=sys.stderr)
+    if profile:
+        print(profile_summary(profile).to_string(float_format='{:.3f}'.format), file=sys.stderr)
+        read_bytes = sum(file_profile.get('read_bytes', 0) for file_profile in profile)
+        if read_bytes:
+            print(f'Image data read from disk: {read_bytes / 2**20:.1f} MB', file=sys.stderr)
+    counts = output.reindex(columns=[channel + '_Counts' for channel in channels])
+    return 1 if counts.isna().all(axis=1).any() else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
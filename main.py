@@ -91,13 +91,27 @@ class Ui_MainWindow(object):
 
         self.horizontalLayout_3.addWidget(self.watershed_CB)  # Add the combo box to the QHBoxLayout
 
+        self.profile_CB = QCheckBox(self.frame)  # Create a QCheckBox within the frame
+        self.profile_CB.setObjectName(u"profile_CB")  # Set object name for the check box
+
+        self.horizontalLayout_3.addWidget(self.profile_CB)  # Add the check box to the QHBoxLayout
+
         self.gridLayout_3.addLayout(self.horizontalLayout_3, 2, 0, 1, 1)  # Add QHBoxLayout to gridLayout_3
 
         self.horizontalLayout_4 = QHBoxLayout()  # Create another QHBoxLayout
         self.horizontalLayout_4.setObjectName(u"horizontalLayout_4")  # Set object name for the layout
 
-        self.horizontalSpacer = QSpacerItem(478, 20, QSizePolicy.Expanding, QSizePolicy.Minimum)  # Create a spacer item
-        self.horizontalLayout_4.addItem(self.horizontalSpacer)  # Add the spacer item to the QHBoxLayout
+        self.progress_PB = QProgressBar(self.frame)  # Create a QProgressBar within the frame
+        self.progress_PB.setObjectName(u"progress_PB")  # Set object name for the progress bar
+        self.progress_PB.setValue(0)  # Set the initial value of the progress bar to 0
+
+        self.horizontalLayout_4.addWidget(self.progress_PB)  # Add the progress bar to the QHBoxLayout
+
+        self.preview_PB = QPushButton(self.frame)  # Create a QPushButton within the frame
+        self.preview_PB.setObjectName(u"preview_PB")  # Set object name for the button
+        self.preview_PB.setMaximumSize(QSize(60, 16777215))  # Set the maximum size for the button
+
+        self.horizontalLayout_4.addWidget(self.preview_PB)  # Add the button to the QHBoxLayout
 
         self.submit_PB = QPushButton(self.frame)  # Create a QPushButton within the frame
         self.submit_PB.setObjectName(u"submit_PB")  # Set object name for the button
@@ -105,6 +119,13 @@ class Ui_MainWindow(object):
 
         self.horizontalLayout_4.addWidget(self.submit_PB)  # Add the button to the QHBoxLayout
 
+        self.cancel_PB = QPushButton(self.frame)  # Create a QPushButton within the frame
+        self.cancel_PB.setObjectName(u"cancel_PB")  # Set object name for the button
+        self.cancel_PB.setMaximumSize(QSize(60, 16777215))  # Set the maximum size for the button
+        self.cancel_PB.setEnabled(False)  # Disable the button until a run is started
+
+        self.horizontalLayout_4.addWidget(self.cancel_PB)  # Add the button to the QHBoxLayout
+
         self.gridLayout_3.addLayout(self.horizontalLayout_4, 3, 0, 1, 1)  # Add QHBoxLayout to gridLayout_3
 
         self.horizontalLayout = QHBoxLayout()  # Create another QHBoxLayout
@@ -119,6 +140,12 @@ class Ui_MainWindow(object):
                                               QSizePolicy.Minimum)  # Create another spacer item
         self.horizontalLayout.addItem(self.horizontalSpacer_2)  # Add the spacer item to the QHBoxLayout
 
+        self.filter_LE = QLineEdit(self.frame)  # Create a QLineEdit within the frame
+        self.filter_LE.setObjectName(u"filter_LE")  # Set object name for the line edit
+        self.filter_LE.setClearButtonEnabled(True)  # Show a button that clears the filter
+
+        self.horizontalLayout.addWidget(self.filter_LE)  # Add the line edit to the QHBoxLayout
+
         self.gridLayout_3.addLayout(self.horizontalLayout, 4, 0, 1, 1)  # Add QHBoxLayout to gridLayout_3
 
         self.qtable = QTableView(self.frame)  # Create a QTableView within the frame
@@ -157,9 +184,17 @@ class Ui_MainWindow(object):
         self.watershed_CB.setItemText(0, QCoreApplication.translate("MainWindow", u"True", None))
         # Set item text for watershed_CB at index 1
         self.watershed_CB.setItemText(1, QCoreApplication.translate("MainWindow", u"False", None))
+        # Set text for profile_CB
+        self.profile_CB.setText(QCoreApplication.translate("MainWindow", u"Profile stages", None))
+        # Set text for preview_PB
+        self.preview_PB.setText(QCoreApplication.translate("MainWindow", u"Preview", None))
         # Set text for submit_PB
         self.submit_PB.setText(QCoreApplication.translate("MainWindow", u"Submit", None))
+        # Set text for cancel_PB
+        self.cancel_PB.setText(QCoreApplication.translate("MainWindow", u"Cancel", None))
         # Set text for label
         self.label.setText(QCoreApplication.translate("MainWindow", u"RESULTS:", None))
+        # Set placeholder text for filter_LE
+        self.filter_LE.setPlaceholderText(QCoreApplication.translate("MainWindow", u"Filter rows", None))
     # retranslateUi
 